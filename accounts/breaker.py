@@ -0,0 +1,192 @@
+"""
+Circuit breakers for integrations, so an API that is down isn't hit by
+every task and retry while it is.
+
+A breaker opens after NIGHTINGALE_BREAKER_THRESHOLD consecutive failed
+calls to an integration (server errors, throttling, timeouts and connection
+errors, not rejected requests). While it is open callers park their rows
+instead of calling out. After NIGHTINGALE_BREAKER_RESET seconds it is half
+open and lets a single probe call through; a probe that succeeds closes the
+breaker, one that fails opens it again.
+
+Breaker state is kept in redis (NIGHTINGALE_RATELIMIT_REDIS, next to the
+rate limit buckets) so every worker counts the same failures and only one
+of them probes. With NIGHTINGALE_BREAKER_BACKEND set to 'cache' it is kept
+in NIGHTINGALE_CACHE instead, for tests and single worker setups; a per
+process cache leaves each worker with breakers of its own.
+"""
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+from .cache import get_cache
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# in seconds, how long breaker state is kept without any calls
+STATE_TIMEOUT = 24 * 60 * 60
+
+
+def is_outage(exc):
+    """
+    Whether a failed call says the integration is unavailable, rather than
+    that the request was bad
+    """
+    if isinstance(exc, (ConnectionError, Timeout)):
+        return True
+    if isinstance(exc, HTTPError) and exc.response is not None:
+        code = exc.response.status_code
+        return code >= 500 or code == 429
+    return False
+
+
+class RedisStore(object):
+
+    """
+    The cache operations breakers use, on redis
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+
+    def get_many(self, keys):
+        return dict((key, value)
+                    for key, value in zip(keys, self.client.mget(keys))
+                    if value is not None)
+
+    def add(self, key, value, timeout):
+        return bool(self.client.set(key, value, ex=timeout, nx=True))
+
+    def set(self, key, value, timeout=None):
+        self.client.set(key, value, ex=timeout)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_many(self, keys):
+        self.client.delete(*keys)
+
+
+class Breakers(object):
+
+    def __init__(self, store=None):
+        self._store = store
+
+    @property
+    def store(self):
+        if self._store is not None:
+            return self._store
+        if settings.NIGHTINGALE_BREAKER_BACKEND == 'cache':
+            return get_cache()
+        self._store = RedisStore(settings.NIGHTINGALE_RATELIMIT_REDIS)
+        return self._store
+
+    def failures_key(self, integration_id):
+        return "breaker:%s:failures" % integration_id
+
+    def opened_key(self, integration_id):
+        return "breaker:%s:open_until" % integration_id
+
+    def probe_key(self, integration_id):
+        return "breaker:%s:probe" % integration_id
+
+    def state(self, integration_id):
+        """
+        State of the integration's breaker, its consecutive failures and
+        until when it is open (a timestamp, None if it's closed)
+        """
+        values = self.store.get_many([self.failures_key(integration_id),
+                                      self.opened_key(integration_id)])
+        failures = int(values.get(self.failures_key(integration_id), 0))
+        open_until = values.get(self.opened_key(integration_id))
+        if open_until is not None:
+            # redis hands values back as strings
+            open_until = float(open_until)
+        if open_until is None:
+            state = CLOSED
+        elif time.time() < open_until:
+            state = OPEN
+        else:
+            state = HALF_OPEN
+        return state, failures, open_until
+
+    def allow(self, integration_id):
+        """
+        Whether a call to the integration may go ahead. A half open breaker
+        lets the first caller through as its probe.
+        """
+        state, _, _ = self.state(integration_id)
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        return self.store.add(
+            self.probe_key(integration_id), 1,
+            int(settings.NIGHTINGALE_BREAKER_PROBE_TIMEOUT))
+
+    def parked_until(self, integration_id):
+        """
+        When rows held back by the breaker should be looked at again
+        """
+        _, _, open_until = self.state(integration_id)
+        now = time.time()
+        if open_until is None or open_until <= now:
+            # half open, wait for the probe
+            open_until = now + int(settings.NIGHTINGALE_BREAKER_PROBE_TIMEOUT)
+        return datetime.fromtimestamp(open_until, timezone.utc)
+
+    def success(self, integration_id):
+        self.store.delete_many([self.failures_key(integration_id),
+                                self.opened_key(integration_id),
+                                self.probe_key(integration_id)])
+
+    def failure(self, integration_id):
+        """
+        Count a failed call, opening the breaker on the threshold or on a
+        failed probe. Returns whether the breaker is open.
+        """
+        store = self.store
+        key = self.failures_key(integration_id)
+        store.add(key, 0, STATE_TIMEOUT)
+        try:
+            failures = store.incr(key)
+        except ValueError:
+            # expired between the add and the incr
+            store.set(key, 1, STATE_TIMEOUT)
+            failures = 1
+        state, _, _ = self.state(integration_id)
+        if state == OPEN:
+            return True
+        if state == HALF_OPEN or \
+                failures >= int(settings.NIGHTINGALE_BREAKER_THRESHOLD):
+            store.set(self.opened_key(integration_id),
+                      time.time() + int(settings.NIGHTINGALE_BREAKER_RESET),
+                      STATE_TIMEOUT)
+            store.delete(self.probe_key(integration_id))
+            return True
+        return False
+
+    def record(self, integration_id, exc=None):
+        """
+        Record the outcome of a call, ``exc`` being what it raised. Errors
+        that aren't outages don't count either way. Returns whether the
+        breaker is open.
+        """
+        if exc is None:
+            self.success(integration_id)
+            return False
+        if is_outage(exc):
+            return self.failure(integration_id)
+        return False
+
+breakers = Breakers()
@@ -0,0 +1,149 @@
+"""
+Cached lookups of the projects a user posts to and the integrations set up
+on a project. Both change rarely but are needed for every inbound report and
+message. Entries are dropped by the receivers in accounts.models when the
+underlying rows change.
+
+That only reaches other processes when NIGHTINGALE_CACHE is shared (e.g.
+memcached). With a per process cache, like the default LocMem one, the
+receivers only clear the saving process's copy, so entries are kept for at
+most NIGHTINGALE_LOCAL_CACHE_TIMEOUT seconds instead.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .models import UserProject, Integration
+
+
+# per process hit/miss counters
+stats = {"hits": 0, "misses": 0}
+
+
+def get_cache():
+    return caches[settings.NIGHTINGALE_CACHE]
+
+
+def is_shared_cache():
+    return not isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def cache_timeout():
+    """
+    Seconds to keep a lookup, short unless changes can be dropped from
+    every process's cache
+    """
+    timeout = int(settings.NIGHTINGALE_CACHE_TIMEOUT)
+    if is_shared_cache():
+        return timeout
+    return min(timeout, int(settings.NIGHTINGALE_LOCAL_CACHE_TIMEOUT))
+
+
+def cached(key, load, timeout=None):
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        stats["misses"] += 1
+        value = load()
+        if timeout is None:
+            timeout = cache_timeout()
+        cache.set(key, value, int(timeout))
+    else:
+        stats["hits"] += 1
+    return value
+
+
+def user_projects_key(user_id):
+    return "accounts:userprojects:%s" % user_id
+
+
+def project_integrations_key(project_id):
+    return "accounts:integrations:%s" % project_id
+
+
+def get_user_project_ids(user):
+    """
+    Ids of the projects a user has access to. Raises
+    UserProject.DoesNotExist for users without any.
+    """
+    def load():
+        userprojects = UserProject.objects.get(user=user)
+        return list(userprojects.projects.values_list('id', flat=True))
+    return cached(user_projects_key(user.pk), load)
+
+
+def get_posting_project_id(user):
+    """
+    Project a user posts reports and messages to - posting users should only
+    have one project
+    """
+    return get_user_project_ids(user)[0]
+
+
+def get_project_integrations(project_id):
+    """
+    List of dicts with the id, integration_type and active flag of each
+    integration on a project.
+    """
+    def load():
+        return list(Integration.objects.filter(project_id=project_id).values(
+            'id', 'integration_type', 'active'))
+    return cached(project_integrations_key(project_id), load)
+
+
+def get_integration_id(project_id, integration_type):
+    """
+    Id of the project's integration of a type, raising like
+    Integration.objects.get when there isn't exactly one.
+    """
+    ids = [integration["id"]
+           for integration in get_project_integrations(project_id)
+           if integration["integration_type"] == integration_type]
+    if not ids:
+        raise Integration.DoesNotExist(
+            "No %s integration for project %s" % (
+                integration_type, project_id))
+    if len(ids) > 1:
+        raise Integration.MultipleObjectsReturned(
+            "%s %s integrations for project %s" % (
+                len(ids), integration_type, project_id))
+    return ids[0]
+
+
+def get_active_integration_ids(project_id, integration_type):
+    return [integration["id"]
+            for integration in get_project_integrations(project_id)
+            if integration["integration_type"] == integration_type and
+            integration["active"]]
+
+
+def forget_user_projects(user_ids):
+    get_cache().delete_many([user_projects_key(user_id)
+                             for user_id in user_ids])
+
+
+def forget_project_integrations(project_ids):
+    get_cache().delete_many([project_integrations_key(project_id)
+                             for project_id in project_ids])
+
+
+INTEGRATIONS_GENERATION_KEY = "accounts:integrations:generation"
+
+
+def get_integrations_generation():
+    """
+    Counter bumped whenever any integration changes, so long lived copies of
+    the integrations (see accounts.registry) can tell they are stale.
+    """
+    return get_cache().get(INTEGRATIONS_GENERATION_KEY)
+
+
+def bump_integrations_generation():
+    cache = get_cache()
+    cache.add(INTEGRATIONS_GENERATION_KEY, 0, None)
+    try:
+        cache.incr(INTEGRATIONS_GENERATION_KEY)
+    except ValueError:
+        # evicted between add and incr
+        cache.set(INTEGRATIONS_GENERATION_KEY, 1, None)
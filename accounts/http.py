@@ -0,0 +1,84 @@
+"""
+Per worker pool of HTTP sessions for talking to integrations, one per
+integration id. Sessions keep connections alive between tasks, so
+back-to-back sends to the same service reuse the TCP/TLS connection, and
+apply NIGHTINGALE_HTTP_CONNECT_TIMEOUT/NIGHTINGALE_HTTP_READ_TIMEOUT to
+requests that don't set a timeout.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+
+class TimeoutSession(requests.Session):
+
+    def __init__(self, timeout):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+class SessionPool(object):
+
+    def __init__(self):
+        self.sessions = {}
+
+    def build(self):
+        session = TimeoutSession((
+            float(settings.NIGHTINGALE_HTTP_CONNECT_TIMEOUT),
+            float(settings.NIGHTINGALE_HTTP_READ_TIMEOUT)))
+        adapter = HTTPAdapter(
+            pool_connections=int(settings.NIGHTINGALE_HTTP_POOL_CONNECTIONS),
+            pool_maxsize=int(settings.NIGHTINGALE_HTTP_POOL_MAXSIZE))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, integration_id=None):
+        """
+        Session for an integration, or one shared by callers that don't have
+        an integration id.
+        """
+        key = None if integration_id is None else str(integration_id)
+        if key not in self.sessions:
+            self.sessions[key] = self.build()
+        return self.sessions[key]
+
+    def retain(self, integration_ids):
+        """
+        Close the sessions of integrations that aren't in
+        ``integration_ids``, keeping the shared one.
+        """
+        keep = set(str(integration_id) for integration_id in integration_ids)
+        for key in list(self.sessions):
+            if key is not None and key not in keep:
+                self.sessions.pop(key).close()
+
+    def stats(self):
+        """
+        Requests made and connections opened per host, over all sessions.
+        Requests beyond the connections opened reused a connection.
+        """
+        hosts = {}
+        adapters = set()
+        for session in self.sessions.values():
+            adapters.update(session.adapters.values())
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                host = "%s://%s:%s" % (pool.scheme, pool.host, pool.port)
+                host_stats = hosts.setdefault(
+                    host, {"requests": 0, "connections": 0})
+                host_stats["requests"] += pool.num_requests
+                host_stats["connections"] += pool.num_connections
+        for host_stats in hosts.values():
+            host_stats["reused"] = max(
+                0, host_stats["requests"] - host_stats["connections"])
+        return hosts
+
+sessions = SessionPool()
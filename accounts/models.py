@@ -80,3 +80,45 @@ class Integration(models.Model):
     def __str__(self):  # __unicode__ on Python 2
         return "%s integration for %s" % (self.integration_type,
                                           str(self.project.name))
+
+# Drop cached lookups when the rows behind them change
+from django.db.models.signals import (post_save, post_delete, pre_delete,
+                                      m2m_changed)
+from django.dispatch import receiver
+from .cache import (forget_user_projects, forget_project_integrations,
+                    bump_integrations_generation)
+
+
+@receiver([post_save, post_delete], sender=UserProject)
+def forget_cached_user_projects(sender, instance, **kwargs):
+    forget_user_projects([instance.user_id])
+
+
+@receiver(m2m_changed, sender=UserProject.projects.through)
+def forget_cached_user_project_links(sender, instance, action, reverse,
+                                     pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            forget_user_projects([instance.user_id])
+        return
+    # instance is a Project and pk_set holds UserProject ids
+    if action == 'pre_clear':
+        userprojects = UserProject.objects.filter(projects=instance)
+    elif action in ('post_add', 'post_remove'):
+        userprojects = UserProject.objects.filter(pk__in=pk_set)
+    else:
+        return
+    forget_user_projects(userprojects.values_list('user_id', flat=True))
+
+
+@receiver(pre_delete, sender=Project)
+def forget_cached_project(sender, instance, **kwargs):
+    userprojects = UserProject.objects.filter(projects=instance)
+    forget_user_projects(userprojects.values_list('user_id', flat=True))
+    forget_project_integrations([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Integration)
+def forget_cached_integrations(sender, instance, **kwargs):
+    forget_project_integrations([instance.project_id])
+    bump_integrations_generation()
@@ -0,0 +1,154 @@
+"""
+Token buckets for the calls we make to integrations, so we send at the
+partner's rate limit instead of being throttled and retrying.
+
+An integration is limited by ``rate_limit`` (requests a second) and
+``rate_burst`` (bucket size, defaults to a second's worth) in its details;
+integrations without a ``rate_limit`` aren't limited. The buckets live in
+redis (NIGHTINGALE_RATELIMIT_REDIS) so every worker shares them, or in
+process with NIGHTINGALE_RATELIMIT_BACKEND set to 'memory'.
+
+Callers reserve a token and sleep until it is due, which queues them up
+behind each other at the limit. A token more than
+NIGHTINGALE_RATELIMIT_MAX_WAIT seconds away isn't reserved, RateLimited is
+raised instead so a task can be scheduled for later rather than holding a
+worker.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+
+class RateLimited(Exception):
+
+    """
+    No token is due within the maximum wait
+    """
+
+    def __init__(self, wait):
+        super(RateLimited, self).__init__(
+            "Rate limited for %.2f seconds" % wait)
+        self.wait = wait
+
+
+def integration_rate(details):
+    """
+    Rate and burst from integration details, None if it isn't limited
+    """
+    details = details or {}
+    rate = float(details.get("rate_limit") or 0)
+    if rate <= 0:
+        return None
+    burst = float(details.get("rate_burst") or max(1.0, rate))
+    return rate, max(1.0, burst)
+
+
+class MemoryBackend(object):
+
+    """
+    Buckets for this process only, for tests and single worker setups
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def reserve(self, key, rate, burst, max_wait, now):
+        """
+        Reserve the next token of the bucket. Returns whether it was
+        reserved and the seconds until it is due.
+        """
+        with self.lock:
+            tokens, at = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0, now - at) * rate)
+            wait = 0.0
+            if tokens < 1:
+                wait = (1 - tokens) / rate
+            if wait > max_wait:
+                return False, wait
+            self.buckets[key] = (tokens - 1, now)
+            return True, wait
+
+
+# same as MemoryBackend.reserve, with the bucket in a hash that expires
+# once it would have filled up again
+RESERVE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait > max_wait then
+    return {0, tostring(wait)}
+end
+tokens = tokens - 1
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+local ttl = math.ceil((burst - tokens) / rate * 1000) + 1000
+redis.call('PEXPIRE', KEYS[1], ttl)
+return {1, tostring(wait)}
+"""
+
+
+class RedisBackend(object):
+
+    """
+    Buckets shared by every worker using the same redis
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.script = self.client.register_script(RESERVE)
+
+    def reserve(self, key, rate, burst, max_wait, now):
+        reserved, wait = self.script(
+            keys=[key], args=[repr(rate), repr(burst), repr(max_wait),
+                              repr(now)])
+        return bool(reserved), float(wait)
+
+
+class RateLimiter(object):
+
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            if settings.NIGHTINGALE_RATELIMIT_BACKEND == 'memory':
+                self._backend = MemoryBackend()
+            else:
+                self._backend = RedisBackend(
+                    settings.NIGHTINGALE_RATELIMIT_REDIS)
+        return self._backend
+
+    def acquire(self, integration_id, details, max_wait=None):
+        """
+        Take a token for a call to the integration, sleeping until it is
+        due. Returns the seconds slept, raises RateLimited if the token is
+        more than ``max_wait`` (NIGHTINGALE_RATELIMIT_MAX_WAIT) seconds away.
+        """
+        limit = integration_rate(details)
+        if limit is None:
+            return 0.0
+        if max_wait is None:
+            max_wait = float(settings.NIGHTINGALE_RATELIMIT_MAX_WAIT)
+        rate, burst = limit
+        reserved, wait = self.backend.reserve(
+            "ratelimit:%s" % integration_id, rate, burst, max_wait,
+            time.time())
+        if not reserved:
+            raise RateLimited(wait)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+limiter = RateLimiter()
@@ -0,0 +1,83 @@
+"""
+In-process registry of the active integrations, for Celery workers. It is
+loaded when a worker process starts and reloaded when the integrations
+generation in the cache moves on (or after NIGHTINGALE_INTEGRATION_REGISTRY_TTL
+seconds), so tasks can find integrations and their API senders without
+going to the database.
+"""
+import time
+
+from celery.signals import worker_process_init
+from django.conf import settings
+
+from .cache import get_integrations_generation
+from .http import sessions
+from .models import Integration
+
+
+class IntegrationRegistry(object):
+
+    def __init__(self):
+        self.loaded_at = None
+        self.generation = None
+        self.by_id = {}
+        self.by_project = {}
+        self.senders = {}
+
+    def load(self):
+        # read the generation first so a change made while loading still
+        # makes the next lookup reload
+        self.generation = get_integrations_generation()
+        by_id = {}
+        by_project = {}
+        for integration in Integration.objects.filter(active=True):
+            by_id[integration.id] = integration
+            by_project.setdefault(
+                (integration.project_id, integration.integration_type),
+                []).append(integration)
+        self.by_id = by_id
+        self.by_project = by_project
+        self.senders = {}
+        sessions.retain(by_id)
+        self.loaded_at = time.time()
+
+    def refresh_if_stale(self):
+        ttl = int(settings.NIGHTINGALE_INTEGRATION_REGISTRY_TTL)
+        if self.loaded_at is None or \
+                time.time() - self.loaded_at > ttl or \
+                get_integrations_generation() != self.generation:
+            self.load()
+
+    def active(self, project_id, integration_type):
+        """
+        Active integrations of a type on a project
+        """
+        self.refresh_if_stale()
+        return self.by_project.get((project_id, integration_type), [])
+
+    def get(self, integration_id):
+        """
+        Active integration by id, None if it isn't active
+        """
+        self.refresh_if_stale()
+        return self.by_id.get(integration_id)
+
+    def sender(self, integration, factory):
+        """
+        API sender built by ``factory`` from the integration details. Senders
+        for active integrations are kept until the registry reloads.
+        """
+        self.refresh_if_stale()
+        if integration.id not in self.by_id:
+            return factory(integration.details)
+        if integration.id not in self.senders:
+            self.senders[integration.id] = factory(
+                self.by_id[integration.id].details)
+        return self.senders[integration.id]
+
+registry = IntegrationRegistry()
+
+
+@worker_process_init.connect
+def warm_registry(**kwargs):
+    registry.load()
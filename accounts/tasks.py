@@ -1,6 +1,7 @@
 from celery.task import Task
 from celery.utils.log import get_task_logger
 
+from .http import sessions
 
 logger = get_task_logger(__name__)
 
@@ -21,3 +22,24 @@ class The_Incr(Task):
         return int(anum)+1
 
 the_incr = The_Incr()
+
+
+class Http_Stats(Task):
+
+    """
+    Task to report the integration HTTP connection reuse of the worker
+    process that runs it
+    """
+    name = "accounts.tasks.http_stats"
+
+    def run(self, **kwargs):
+        l = self.get_logger(**kwargs)
+
+        stats = sessions.stats()
+        for host, host_stats in sorted(stats.items()):
+            l.info("%s: %s requests, %s connections, %s reused" % (
+                host, host_stats["requests"], host_stats["connections"],
+                host_stats["reused"]))
+        return stats
+
+http_stats = Http_Stats()
@@ -1,13 +1,28 @@
 import json
+import threading
 
+import requests
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
 
-from .models import Project, UserProject
+from .models import Project, UserProject, Integration
+from .registry import IntegrationRegistry
+from .http import SessionPool
+from .breaker import breakers, is_outage, CLOSED, OPEN, HALF_OPEN
+from .ratelimit import (MemoryBackend, RateLimiter, RateLimited,
+                        integration_rate)
+from .tasks import http_stats
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+from .cache import (get_cache, get_posting_project_id, get_integration_id,
+                    get_active_integration_ids, stats, cache_timeout)
 
 
 class APITestCase(TestCase):
@@ -115,3 +130,271 @@ class TestAccountsAPI(AuthenticatedAPITestCase):
         d = UserProject.objects.last()
         self.assertEqual(d.user.username, 'testnormaluser')
         self.assertEqual(d.projects.count(), 2)
+
+
+class TestLookupCache(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestLookupCache, self).setUp()
+        get_cache().clear()
+        self.project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        self.userproject = UserProject.objects.create(user=self.normaluser)
+        self.userproject.projects.add(self.project)
+
+    def test_posting_project_cached(self):
+        misses = stats["misses"]
+        hits = stats["hits"]
+        self.assertEqual(get_posting_project_id(self.normaluser),
+                         self.project.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_posting_project_id(self.normaluser),
+                             self.project.id)
+        self.assertEqual(stats["misses"], misses + 1)
+        self.assertEqual(stats["hits"], hits + 1)
+
+    def test_posting_project_invalidated(self):
+        get_posting_project_id(self.normaluser)
+        self.userproject.projects.clear()
+        project = Project.objects.create(
+            code="TESTPROJ2", name="Test Project 2")
+        self.userproject.projects.add(project)
+        self.assertEqual(get_posting_project_id(self.normaluser), project.id)
+
+    def test_integrations_cached_and_invalidated(self):
+        integration = Integration.objects.create(
+            project=self.project, integration_type="Snappy", active=False)
+        self.assertEqual(get_integration_id(self.project.id, "Snappy"),
+                         integration.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_active_integration_ids(self.project.id, "Snappy"), [])
+        integration.active = True
+        integration.save()
+        self.assertEqual(
+            get_active_integration_ids(self.project.id, "Snappy"),
+            [integration.id])
+        self.assertRaises(Integration.DoesNotExist,
+                          get_integration_id, self.project.id, "Vumi")
+
+    @override_settings(NIGHTINGALE_CACHE_TIMEOUT=3600,
+                       NIGHTINGALE_LOCAL_CACHE_TIMEOUT=30)
+    def test_local_cache_timeout(self):
+        # other processes can't see entries dropped from a LocMem cache
+        self.assertEqual(cache_timeout(), 30)
+
+    def test_cache_stats_admin_only(self):
+        response = self.adminclient.get('/api/v1/sys/cachestats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("hits", response.data)
+        self.assertIn("misses", response.data)
+        response = self.normalclient.get('/api/v1/sys/cachestats/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TestIntegrationRegistry(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestIntegrationRegistry, self).setUp()
+        self.project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        self.snappy = Integration.objects.create(
+            project=self.project, integration_type="Snappy",
+            details={"snappy_api_key": "blah"}, active=True)
+        Integration.objects.create(
+            project=self.project, integration_type="Vumi", active=False)
+        self.registry = IntegrationRegistry()
+        self.registry.load()
+
+    def test_lookups_skip_database(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.registry.active(self.project.id, "Snappy"),
+                [self.snappy])
+            self.assertEqual(
+                self.registry.active(self.project.id, "Vumi"), [])
+            self.assertEqual(self.registry.get(self.snappy.id), self.snappy)
+
+    def test_reloads_on_change(self):
+        vumi = Integration.objects.create(
+            project=self.project, integration_type="Vumi", active=True)
+        self.assertEqual(self.registry.active(self.project.id, "Vumi"),
+                         [vumi])
+        self.snappy.active = False
+        self.snappy.save()
+        self.assertEqual(self.registry.get(self.snappy.id), None)
+
+    def test_senders_cached_until_reload(self):
+        built = []
+
+        def factory(details):
+            built.append(details)
+            return object()
+
+        sender = self.registry.sender(self.snappy, factory)
+        self.assertIs(self.registry.sender(self.snappy, factory), sender)
+        self.assertEqual(built, [{"snappy_api_key": "blah"}])
+        self.snappy.save()
+        self.assertIsNot(self.registry.sender(self.snappy, factory), sender)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"message": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSessionPool(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.pool = SessionPool()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_reused(self):
+        session = self.pool.get("integration-1")
+        self.assertIs(self.pool.get("integration-1"), session)
+        for _ in range(3):
+            response = session.post(self.url, data="{}")
+            self.assertEqual(response.json(), {"message": "ok"})
+        self.assertEqual(self.pool.stats(), {
+            "http://127.0.0.1:%s" % self.server.server_port: {
+                "requests": 3, "connections": 1, "reused": 2}})
+
+    def test_default_timeout(self):
+        session = self.pool.get()
+        self.assertEqual(session.timeout, (5.0, 30.0))
+
+    def test_retain(self):
+        shared = self.pool.get()
+        self.pool.get("integration-1")
+        self.pool.get("integration-2")
+        self.pool.retain(["integration-2"])
+        self.assertEqual(sorted(self.pool.sessions, key=str),
+                         sorted([None, "integration-2"], key=str))
+        self.assertIs(self.pool.get(), shared)
+
+    def test_stats_task(self):
+        self.assertIsInstance(http_stats.apply().get(), dict)
+
+
+class TestRateLimiter(TestCase):
+
+    def test_integration_rate(self):
+        self.assertIsNone(integration_rate({}))
+        self.assertIsNone(integration_rate(None))
+        self.assertEqual(integration_rate({"rate_limit": "5"}), (5.0, 5.0))
+        self.assertEqual(integration_rate(
+            {"rate_limit": "0.5", "rate_burst": "3"}), (0.5, 3.0))
+
+    def test_bucket(self):
+        backend = MemoryBackend()
+        # the burst is free, then tokens are handed out at the rate
+        self.assertEqual(
+            [backend.reserve("k", 2.0, 2.0, 10, 100.0) for _ in range(4)],
+            [(True, 0.0), (True, 0.0), (True, 0.5), (True, 1.0)])
+        # too far off to reserve
+        self.assertEqual(backend.reserve("k", 2.0, 2.0, 1, 100.0),
+                         (False, 1.5))
+        # refilled, but only up to the burst
+        self.assertEqual(backend.reserve("k", 2.0, 2.0, 10, 110.0),
+                         (True, 0.0))
+        self.assertEqual(backend.reserve("k", 2.0, 2.0, 10, 110.0),
+                         (True, 0.0))
+        self.assertEqual(backend.reserve("k", 2.0, 2.0, 10, 110.0),
+                         (True, 0.5))
+
+    def test_acquire(self):
+        limiter = RateLimiter(MemoryBackend())
+        self.assertEqual(limiter.acquire("integration-1", {}), 0.0)
+        details = {"rate_limit": "0.01"}
+        self.assertEqual(limiter.acquire("integration-1", details), 0.0)
+        with self.assertRaises(RateLimited) as cm:
+            limiter.acquire("integration-1", details, max_wait=1)
+        self.assertAlmostEqual(cm.exception.wait, 100.0, places=0)
+        # buckets are per integration
+        self.assertEqual(limiter.acquire("integration-2", details), 0.0)
+
+
+@override_settings(NIGHTINGALE_BREAKER_THRESHOLD=2)
+class TestBreakers(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestBreakers, self).setUp()
+        self.project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        self.snappy = Integration.objects.create(
+            project=self.project, integration_type="Snappy",
+            details={"snappy_api_key": "blah"}, active=True)
+
+    def http_error(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return requests.exceptions.HTTPError(response=response)
+
+    def test_is_outage(self):
+        self.assertTrue(is_outage(self.http_error(500)))
+        self.assertTrue(is_outage(self.http_error(503)))
+        self.assertTrue(is_outage(self.http_error(429)))
+        self.assertTrue(is_outage(requests.exceptions.ConnectionError()))
+        self.assertTrue(is_outage(requests.exceptions.ReadTimeout()))
+        self.assertFalse(is_outage(self.http_error(400)))
+        self.assertFalse(is_outage(ValueError()))
+
+    def test_open_half_open_close(self):
+        integration_id = self.snappy.id
+        self.assertTrue(breakers.allow(integration_id))
+        # rejected requests don't count
+        self.assertFalse(breakers.record(integration_id,
+                                         self.http_error(400)))
+        self.assertFalse(breakers.record(integration_id,
+                                         self.http_error(500)))
+        self.assertTrue(breakers.allow(integration_id))
+        self.assertTrue(breakers.record(integration_id,
+                                        self.http_error(500)))
+        self.assertEqual(breakers.state(integration_id)[0], OPEN)
+        self.assertFalse(breakers.allow(integration_id))
+
+        # once the reset is up a single probe goes through
+        breakers.store.set(breakers.opened_key(integration_id), 0)
+        self.assertEqual(breakers.state(integration_id)[0], HALF_OPEN)
+        self.assertTrue(breakers.allow(integration_id))
+        self.assertFalse(breakers.allow(integration_id))
+        # a failed probe opens it again
+        self.assertTrue(breakers.record(integration_id,
+                                        self.http_error(503)))
+        self.assertEqual(breakers.state(integration_id)[0], OPEN)
+
+        breakers.store.set(breakers.opened_key(integration_id), 0)
+        self.assertTrue(breakers.allow(integration_id))
+        breakers.record(integration_id)
+        self.assertEqual(breakers.state(integration_id), (CLOSED, 0, None))
+        self.assertTrue(breakers.allow(integration_id))
+
+    def test_breakers_endpoint(self):
+        breakers.record(self.snappy.id, self.http_error(500))
+        response = self.adminclient.get('/api/v1/sys/breakers/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]["integration"], self.snappy.id)
+        self.assertEqual(response.data[0]["state"], CLOSED)
+        self.assertEqual(response.data[0]["failures"], 1)
+        response = self.normalclient.get('/api/v1/sys/breakers/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -13,4 +13,6 @@ router.register(r'integrations', views.IntegrationViewSet)
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = [
     url(r'^sys/', include(router.urls)),
+    url(r'^sys/cachestats/$', views.CacheStatsView.as_view()),
+    url(r'^sys/breakers/$', views.BreakerStateView.as_view()),
 ]
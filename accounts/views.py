@@ -1,7 +1,14 @@
+from datetime import datetime
+
 from django.contrib.auth.models import User, Group
+from django.utils import timezone
 from .models import Project, UserProject, Integration
 from rest_framework import viewsets
 from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .cache import stats
+from .breaker import breakers
 from .serializers import (UserSerializer, GroupSerializer,
                           ProjectSerializer, UserProjectSerializer,
                           IntegrationSerializer)
@@ -55,3 +62,41 @@ class IntegrationViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAdminUser,)
     queryset = Integration.objects.all()
     serializer_class = IntegrationSerializer
+
+
+class CacheStatsView(APIView):
+
+    """
+    API endpoint that shows the project/integration lookup cache hit and miss
+    counts of the process serving the request.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(dict(stats))
+
+
+class BreakerStateView(APIView):
+
+    """
+    API endpoint that shows the circuit breaker of each active integration,
+    so it's clear which partner is failing.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        results = []
+        for integration in Integration.objects.filter(active=True) \
+                .order_by('project__code', 'integration_type'):
+            state, failures, open_until = breakers.state(integration.id)
+            if open_until is not None:
+                open_until = datetime.fromtimestamp(open_until, timezone.utc)
+            results.append({
+                "integration": integration.id,
+                "project": integration.project_id,
+                "integration_type": integration.integration_type,
+                "state": state,
+                "failures": failures,
+                "open_until": open_until,
+            })
+        return Response(results)
@@ -0,0 +1,442 @@
+"""
+Delivery engine for outbound Messages and Submissions, an alternative to
+a Celery task per row that blocks a worker on every HTTP request.
+
+A run claims a batch of undelivered rows by leasing them for
+NIGHTINGALE_DELIVERY_LEASE seconds (claimed_until), sends them from a pool
+of threads with at most NIGHTINGALE_DELIVERY_PER_INTEGRATION requests in
+flight per integration and NIGHTINGALE_DELIVERY_CONCURRENCY overall, and
+then marks what was sent delivered/submitted in bulk. The threads only make
+HTTP requests, everything touching the database happens on the calling
+thread. A row that fails to send is leased for as long as delivery.policy
+backs it off, or dead lettered if it is given up on. Calls wait for the
+integration's rate limit (accounts.ratelimit), a row whose token is too far
+off is handed back. Rows of integrations whose breaker is open
+(accounts.breaker) are parked by leasing them until it may let them through.
+"""
+import logging
+import sys
+import threading
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from accounts.http import sessions
+from accounts.ratelimit import limiter, RateLimited
+from accounts.breaker import breakers, CLOSED
+from accounts.registry import registry
+from ona.models import Submission
+from ona.tasks import post_submission, send_submission
+from outbox.dispatch import enqueue
+from snappy.models import Message
+from snappy.tasks import send_message, add_tags, post_tags, strip_tags
+from .policy import retry_delay, dead_letter
+
+logger = logging.getLogger(__name__)
+
+
+CLAIM = (
+    "UPDATE {table} SET claimed_until = %s WHERE id IN ("
+    "SELECT id FROM {table} WHERE NOT {done} "
+    "AND (claimed_until IS NULL OR claimed_until < %s) "
+    "AND NOT EXISTS (SELECT 1 FROM delivery_deadletter AS dead "
+    "WHERE dead.kind = %s AND dead.object_id = {table}.id "
+    "AND dead.requeued_at IS NULL) "
+    "ORDER BY COALESCE({table}.metadata -> 'priority' = 'urgent', false) "
+    "DESC, id LIMIT %s FOR UPDATE SKIP LOCKED) RETURNING id")
+
+# dead letter kind, task and task argument of each model
+DEAD_LETTERS = {
+    Message: ("message", send_message, "message_id"),
+    Submission: ("submission", send_submission, "submission_id"),
+}
+
+
+def claim(model, done, batch_size, lease):
+    """
+    Lease up to ``batch_size`` rows of ``model`` that aren't ``done``,
+    leased already or dead lettered, urgent ones first. Returns their ids.
+    """
+    now = timezone.now()
+    kind = DEAD_LETTERS[model][0]
+    query = CLAIM.format(table=model._meta.db_table, done=done)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(query, [now + timedelta(seconds=lease), now, kind,
+                               batch_size])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def give_up(row, exc, attempts):
+    kind, task, param = DEAD_LETTERS[type(row)]
+    with transaction.atomic():
+        dead_letter(kind, task, {param: row.id}, exc, attempts,
+                    object_id=row.id)
+        type(row).objects.filter(id=row.id).update(
+            attempts=attempts, claimed_until=None)
+
+
+def retry_later(jobs):
+    """
+    Lease the rows that failed to send until they should be tried again,
+    dead lettering those that are given up on.
+    """
+    now = timezone.now()
+    for job in jobs:
+        if job.error is None:
+            continue
+        attempts = job.row.attempts + 1
+        delay = retry_delay(job.error[1], attempts)
+        if delay is None:
+            give_up(job.row, job.error[1], attempts)
+        else:
+            type(job.row).objects.filter(id=job.row.id).update(
+                attempts=attempts,
+                claimed_until=now + timedelta(seconds=delay))
+
+
+def set_metadata(table, key, values, column=None):
+    """
+    Set ``key`` in the metadata of the rows of ``table`` from ``values``, a
+    dict of id to value, and ``column`` to the value too if given.
+    """
+    if not values:
+        return
+    assignments = ["metadata = COALESCE(t.metadata, ''::hstore)"
+                   " || hstore(%s, v.value)", "updated_at = %s"]
+    if column is not None:
+        assignments.append("%s = v.value" % column)
+    rows = ", ".join(["(%s, %s)"] * len(values))
+    params = [key, timezone.now()]
+    for pk, value in values.items():
+        params.extend([pk, value])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE %s AS t SET %s FROM (VALUES %s) AS v (id, value)"
+            " WHERE t.id = v.id" % (table, ", ".join(assignments), rows),
+            params)
+
+
+class Job(object):
+
+    """
+    A claimed row to send. Jobs are built on the calling thread so ``send``
+    only has to make HTTP requests.
+    """
+
+    def __init__(self, row):
+        self.row = row
+        self.integration = registry.get(row.integration_id) or \
+            row.integration
+        self.details = self.integration.details
+        self.session = sessions.get(row.integration_id)
+        self.result = None
+        self.error = None
+        self.throttled = False
+
+    @property
+    def sent(self):
+        return self.error is None and not self.throttled
+
+    def throttle(self):
+        limiter.acquire(self.row.integration_id, self.details)
+
+    def run(self):
+        try:
+            self.result = self.send()
+        except RateLimited:
+            self.throttled = True
+        except Exception:
+            self.error = sys.exc_info()
+
+    def send(self):
+        raise NotImplementedError()
+
+
+class VumiJob(Job):
+
+    def __init__(self, row):
+        super(VumiJob, self).__init__(row)
+        self.sender = registry.sender(
+            self.integration,
+            partial(send_message.vumi_client, session=self.session))
+
+    def send(self):
+        self.throttle()
+        response = self.sender.send_text(
+            self.row.to_addr, strip_tags(self.row.message))
+        return response["message_id"]
+
+
+class SnappyJob(Job):
+
+    def __init__(self, row):
+        super(SnappyJob, self).__init__(row)
+        self.sender = registry.sender(
+            self.integration,
+            partial(send_message.snappy_client, session=self.session))
+        report = row.report
+        self.ticket = (report.metadata or {}).get("snappy_nonce")
+        self.tags = [category.name for category in report.categories.all()]
+        self.tagged = False
+
+    @property
+    def opens_ticket(self):
+        return self.ticket is None
+
+    def send(self):
+        message = self.row
+        # from_email should be "user+%s@domain.org"
+        from_addr = [{"name": message.from_addr,
+                      "address": self.details["snappy_from_email"] %
+                      message.id}]
+        self.throttle()
+        if self.opens_ticket:
+            ticket = self.sender.create_note(
+                mailbox_id=self.details["snappy_mailbox_id"],
+                subject="Report from %s" % message.from_addr,
+                message=message.message,
+                to_addr=None,
+                from_addr=from_addr)
+            try:
+                self.throttle()
+                post_tags(self.session, self.details, ticket, self.tags)
+                self.tagged = True
+            except Exception:
+                # the note is in, leave the tags to add_tags
+                logger.warning("Failed tagging Snappy ticket %s" % ticket,
+                               exc_info=True)
+            return ticket
+        return self.sender.create_note(
+            mailbox_id=self.details["snappy_mailbox_id"],
+            ticket_id=self.ticket,
+            subject="Update from %s" % message.from_addr,
+            message=message.message,
+            to_addr=None,
+            from_addr=from_addr)
+
+
+class OnaJob(Job):
+
+    def send(self):
+        self.throttle()
+        response = post_submission(
+            self.session, self.details, self.row.content)
+        if "error" in response:
+            return response["error"]
+        return response["message"]
+
+
+def build(job_class, row, jobs):
+    try:
+        job = job_class(row)
+    except Exception as e:
+        # nothing to retry, it can't be sent as it is
+        logger.error("Failed preparing %s %s" % (
+            row._meta.model_name, row.id), exc_info=True)
+        give_up(row, e, row.attempts + 1)
+        return None
+    jobs.append(job)
+    return job
+
+
+class BreakerGate(object):
+
+    """
+    Lets the rows of a batch through their integrations' breakers and parks
+    the rest. A half open breaker lets one row through as its probe.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.parked = []
+
+    def admit(self, row):
+        integration_id = row.integration_id
+        if integration_id not in self.states:
+            self.states[integration_id] = breakers.state(integration_id)[0]
+            if self.states[integration_id] != CLOSED and \
+                    breakers.allow(integration_id):
+                return True
+        if self.states[integration_id] == CLOSED:
+            return True
+        self.parked.append(row)
+        return False
+
+    def park(self):
+        groups = {}
+        for row in self.parked:
+            groups.setdefault((type(row), row.integration_id), []).append(
+                row.id)
+        for (model, integration_id), ids in groups.items():
+            model.objects.filter(id__in=ids).update(
+                claimed_until=breakers.parked_until(integration_id))
+
+
+def message_jobs(ids, gate):
+    """
+    Jobs for the claimed messages, and the ids of messages to hand back
+    because an earlier message in the batch is opening their report's
+    Snappy ticket.
+    """
+    jobs = []
+    deferred = []
+    opening = set()
+    messages = Message.objects.filter(id__in=ids).order_by('id') \
+        .select_related('integration', 'report') \
+        .prefetch_related('report__categories')
+    for message in messages:
+        if not gate.admit(message):
+            continue
+        if message.target == "VUMI":
+            build(VumiJob, message, jobs)
+        elif message.report_id in opening:
+            deferred.append(message.id)
+        else:
+            job = build(SnappyJob, message, jobs)
+            if job is not None and job.opens_ticket:
+                opening.add(message.report_id)
+    return jobs, deferred
+
+
+def submission_jobs(ids, gate):
+    submissions = Submission.objects.filter(id__in=ids).order_by('id') \
+        .select_related('integration', 'report')
+    jobs = []
+    for submission in submissions:
+        if gate.admit(submission):
+            build(OnaJob, submission, jobs)
+    return jobs
+
+
+def work(pending, slots):
+    while True:
+        try:
+            job = pending.get_nowait()
+        except queue.Empty:
+            return
+        with slots:
+            job.run()
+
+
+def run_jobs(jobs, concurrency, per_integration):
+    """
+    Send the jobs from threads, at most ``per_integration`` at a time per
+    integration and ``concurrency`` at a time overall.
+    """
+    slots = threading.BoundedSemaphore(concurrency)
+    by_integration = {}
+    for job in jobs:
+        by_integration.setdefault(job.row.integration_id, []).append(job)
+    threads = []
+    for group in by_integration.values():
+        pending = queue.Queue()
+        for job in group:
+            pending.put(job)
+        for _ in range(min(per_integration, len(group))):
+            thread = threading.Thread(target=work, args=(pending, slots))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def record_outcomes(jobs):
+    """
+    Tell the breakers how the calls to their integrations went
+    """
+    succeeded = set(job.row.integration_id for job in jobs if job.sent)
+    for integration_id in succeeded:
+        breakers.record(integration_id)
+    for job in jobs:
+        if job.error is not None:
+            breakers.record(job.row.integration_id, job.error[1])
+
+
+def record_messages(jobs):
+    sent = [job for job in jobs if job.sent]
+    now = timezone.now()
+    with transaction.atomic():
+        Message.objects.filter(id__in=[job.row.id for job in sent]).update(
+            delivered=True, delivered_at=now, claimed_until=None,
+            updated_at=now)
+        set_metadata("snappy_message", "vumi_message_id", dict(
+            (job.row.id, job.result) for job in sent
+            if isinstance(job, VumiJob)))
+        opened = [job for job in sent
+                  if isinstance(job, SnappyJob) and job.opens_ticket]
+        # Log the snappy tickets on the reports
+        set_metadata("reports_report", "snappy_nonce", dict(
+            (job.row.report_id, job.result) for job in opened),
+            column="snappy_nonce")
+        for job in opened:
+            if not job.tagged:
+                enqueue(add_tags, {
+                    "snappysettings": job.details,
+                    "snappynonce": job.result,
+                    "tags": job.tags,
+                    "integration_id": str(job.row.integration_id)})
+    return len(sent)
+
+
+def record_submissions(jobs):
+    sent = [job for job in jobs if job.sent]
+    with transaction.atomic():
+        Submission.objects.filter(id__in=[job.row.id for job in sent]) \
+            .update(submitted=True, claimed_until=None)
+        # Log the Ona responses on the reports
+        set_metadata("reports_report", "ona_response", dict(
+            (job.row.report_id, job.result) for job in sent
+            if job.row.report_id is not None))
+    return len(sent)
+
+
+def deliver_batch(batch_size=None, lease=None, concurrency=None,
+                  per_integration=None):
+    """
+    Claim, send and record one batch of messages and one of submissions.
+    Returns the number of rows delivered and whether either batch was full,
+    so there may be more waiting.
+    """
+    if batch_size is None:
+        batch_size = int(settings.NIGHTINGALE_DELIVERY_BATCH_SIZE)
+    if lease is None:
+        lease = int(settings.NIGHTINGALE_DELIVERY_LEASE)
+    if concurrency is None:
+        concurrency = int(settings.NIGHTINGALE_DELIVERY_CONCURRENCY)
+    if per_integration is None:
+        per_integration = int(settings.NIGHTINGALE_DELIVERY_PER_INTEGRATION)
+
+    message_ids = claim(Message, "delivered", batch_size, lease)
+    submission_ids = claim(Submission, "submitted", batch_size, lease)
+    gate = BreakerGate()
+    messages, deferred = message_jobs(message_ids, gate)
+    Message.objects.filter(id__in=deferred).update(claimed_until=None)
+    submissions = submission_jobs(submission_ids, gate)
+    gate.park()
+
+    run_jobs(messages + submissions, concurrency, per_integration)
+    record_outcomes(messages + submissions)
+
+    # hand back what the rate limits held up
+    Message.objects.filter(id__in=[
+        job.row.id for job in messages if job.throttled]).update(
+        claimed_until=None)
+    Submission.objects.filter(id__in=[
+        job.row.id for job in submissions if job.throttled]).update(
+        claimed_until=None)
+
+    for job in messages + submissions:
+        if job.error is not None:
+            logger.error("Failed delivering %s %s" % (
+                job.row._meta.model_name, job.row.id), exc_info=job.error)
+    retry_later(messages + submissions)
+    delivered = record_messages(messages) + record_submissions(submissions)
+    # stop at a throttled batch rather than claim it straight back
+    more = batch_size in (len(message_ids), len(submission_ids)) and \
+        not any(job.throttled for job in messages + submissions)
+    return delivered, more
@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from delivery.engine import deliver_batch
+
+
+class Command(BaseCommand):
+    help = ("Run the delivery engine, sending undelivered messages and "
+            "submissions as they come in")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', dest='once',
+                            default=False,
+                            help="Deliver what is waiting and stop")
+        parser.add_argument('--idle', dest='idle', type=float, default=1.0,
+                            help="Seconds to wait when there is no work")
+
+    def handle(self, *args, **options):
+        if not settings.NIGHTINGALE_DELIVERY_ENGINE:
+            # the post_save hooks send every row themselves
+            raise CommandError(
+                "NIGHTINGALE_DELIVERY_ENGINE is off, rows would be sent twice")
+        while True:
+            delivered, more = deliver_batch()
+            if delivered:
+                self.stdout.write("Delivered %s" % delivered)
+            if not more:
+                if options['once']:
+                    break
+                time.sleep(options['idle'])
@@ -0,0 +1,91 @@
+import json
+import time
+
+from celery import current_app
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from delivery.models import DeadLetter
+from ona.models import Submission
+from outbox.dispatch import enqueue
+from outbox.routing import message_queue, submission_queue
+from snappy.models import Message
+
+# rows the delivery engine sends itself once their dead letter is requeued
+ENGINE_MODELS = {
+    "message": Message,
+    "submission": Submission,
+}
+
+
+def queue(dead):
+    """
+    Messages and submissions go back to the queue they'd be sent on, tags
+    follow their task's route
+    """
+    if dead.kind == "message":
+        message = Message.objects.filter(id=dead.object_id).first()
+        if message is not None:
+            return message_queue(message)
+    if dead.kind == "submission":
+        submission = Submission.objects.filter(id=dead.object_id).first()
+        if submission is not None:
+            return submission_queue(submission)
+    return None
+
+
+def requeue(dead_letters):
+    """
+    Send dead letters again, as their task or, for rows the delivery engine
+    sends, by handing the row back to it.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        for dead in dead_letters:
+            model = ENGINE_MODELS.get(dead.kind)
+            if settings.NIGHTINGALE_DELIVERY_ENGINE and model is not None:
+                model.objects.filter(id=dead.object_id).update(
+                    attempts=0, claimed_until=None)
+            else:
+                enqueue(current_app.tasks[dead.task],
+                        json.loads(dead.payload), queue=queue(dead))
+        DeadLetter.objects.filter(
+            id__in=[dead.id for dead in dead_letters]).update(
+            requeued_at=now)
+
+
+class Command(BaseCommand):
+    help = ("Send dead lettered deliveries again, --batch-size at a time "
+            "with --pause seconds between batches")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', dest='kind', default=None,
+                            choices=[kind for kind, _ in DeadLetter.KINDS])
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                            default=100)
+        parser.add_argument('--pause', dest='pause', type=float, default=1.0)
+        parser.add_argument('--limit', dest='limit', type=int, default=None,
+                            help="Requeue at most this many")
+
+    def handle(self, *args, **options):
+        pending = DeadLetter.objects.filter(requeued_at__isnull=True)
+        if options['kind'] is not None:
+            pending = pending.filter(kind=options['kind'])
+        limit = options['limit']
+        requeued = 0
+        while limit is None or requeued < limit:
+            size = options['batch_size']
+            if limit is not None:
+                size = min(size, limit - requeued)
+            batch = list(pending.order_by('id')[:size])
+            if not batch:
+                break
+            requeue(batch)
+            requeued += len(batch)
+            self.stdout.write("Requeued %s dead letters" % requeued)
+            if len(batch) < size:
+                break
+            time.sleep(options['pause'])
+        self.stdout.write("Done, requeued %s dead letters" % requeued)
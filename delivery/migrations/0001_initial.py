@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadLetter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=10, choices=[('message', 'Message'), ('submission', 'Submission'), ('tags', 'Tags')])),
+                ('object_id', models.IntegerField(null=True, blank=True)),
+                ('task', models.CharField(max_length=255)),
+                ('payload', models.TextField()),
+                ('error', models.TextField()),
+                ('status_code', models.IntegerField(null=True, blank=True)),
+                ('attempts', models.IntegerField(default=1)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('requeued_at', models.DateTimeField(null=True, blank=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='deadletter',
+            index_together=set([('kind', 'object_id')]),
+        ),
+    ]
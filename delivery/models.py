@@ -0,0 +1,56 @@
+from django.db import models
+
+
+class DeadLetter(models.Model):
+
+    """
+    Delivery given up on, by delivery.policy, once its failure was permanent
+    or it ran out of retries. ``manage.py requeue_dead_letters`` sends them
+    again.
+
+    :param str kind:
+        What failed to be delivered (message, submission or tags)
+
+    :param int object_id:
+        The Message or Submission, if any
+
+    :param str task:
+        Registered name of the Celery task that sends it
+
+    :param str payload:
+        JSON encoded keyword arguments for the task
+
+    :param str error:
+        The final failure
+
+    :param int status_code:
+        HTTP status of the final failure, if it was a response
+
+    :param int attempts:
+        Number of times delivery was tried
+
+    :param datetime requeued_at:
+        When it was sent again, pending dead letters have none
+
+    """
+    KINDS = (
+        ('message', 'Message'),
+        ('submission', 'Submission'),
+        ('tags', 'Tags'),
+    )
+    kind = models.CharField(max_length=10, choices=KINDS)
+    object_id = models.IntegerField(null=True, blank=True)
+    task = models.CharField(max_length=255)
+    payload = models.TextField()
+    error = models.TextField()
+    status_code = models.IntegerField(null=True, blank=True)
+    attempts = models.IntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    requeued_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('kind', 'object_id')]
+
+    def __str__(self):
+        return "%s %s failed after %s attempts" % (
+            self.kind, self.object_id or "", self.attempts)
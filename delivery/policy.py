@@ -0,0 +1,66 @@
+"""
+When to retry a failed delivery and when to give up on it.
+
+Outages (server errors including 500, 429s, timeouts and connection
+errors, see accounts.breaker.is_outage) are retried with exponential
+backoff and full jitter: a random delay of up to NIGHTINGALE_RETRY_BASE
+seconds doubled per attempt, capped at NIGHTINGALE_RETRY_CAP, and no
+sooner than a Retry-After header asks. Anything else, or an outage that
+lasts NIGHTINGALE_RETRY_ATTEMPTS tries, is given up on and kept as a
+DeadLetter.
+"""
+import json
+import random
+
+from django.conf import settings
+
+from accounts.breaker import is_outage
+from .models import DeadLetter
+
+
+def retry_after(exc):
+    """
+    Seconds a response's Retry-After header asks us to wait, if any
+    """
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    try:
+        return max(0.0, float(response.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        # missing, or an HTTP date which partners don't send us
+        return None
+
+
+def backoff(attempt):
+    """
+    Random delay before retry ``attempt`` (0 for the first retry)
+    """
+    base = float(settings.NIGHTINGALE_RETRY_BASE)
+    cap = float(settings.NIGHTINGALE_RETRY_CAP)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_delay(exc, attempts):
+    """
+    Seconds to wait before trying again after ``attempts`` tries, the last
+    of which raised ``exc``. None if it should be given up on.
+    """
+    if not is_outage(exc) or \
+            attempts >= int(settings.NIGHTINGALE_RETRY_ATTEMPTS):
+        return None
+    return max(backoff(attempts - 1), retry_after(exc) or 0)
+
+
+def dead_letter(kind, task, kwargs, exc, attempts, object_id=None):
+    """
+    Keep a delivery that was given up on so it can be requeued with
+    ``task`` and ``kwargs``.
+    """
+    response = getattr(exc, 'response', None)
+    return DeadLetter.objects.create(
+        kind=kind, object_id=object_id, task=task.name,
+        payload=json.dumps(kwargs),
+        error="%s: %s" % (type(exc).__name__, exc),
+        status_code=getattr(response, 'status_code', None),
+        attempts=attempts)
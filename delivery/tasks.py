@@ -0,0 +1,101 @@
+from celery.task import Task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.breaker import breakers, OPEN, HALF_OPEN
+from accounts.registry import registry
+from ona.models import Submission
+from ona.tasks import send_submission
+from outbox.dispatch import enqueue
+from outbox.routing import integration_queue
+from snappy.models import Message
+from snappy.tasks import send_message
+from .engine import deliver_batch
+
+logger = get_task_logger(__name__)
+
+
+class Deliver(Task):
+
+    """
+    Task to run the delivery engine until it runs out of work
+    """
+    name = "delivery.tasks.deliver"
+
+    def run(self, **kwargs):
+        """
+        Deliver batches until one comes back short. Does nothing unless
+        NIGHTINGALE_DELIVERY_ENGINE is on, as the post_save hooks are
+        sending then.
+        """
+        l = self.get_logger(**kwargs)
+
+        if not settings.NIGHTINGALE_DELIVERY_ENGINE:
+            return 0
+        delivered = 0
+        more = True
+        while more:
+            sent, more = deliver_batch()
+            delivered += sent
+        l.info("Delivered %s messages and submissions" % delivered)
+        return delivered
+
+deliver = Deliver()
+
+
+def release(model, done, task, param):
+    """
+    Send the parked rows of ``model`` whose integrations' breakers are
+    closed again with ``task``, one row per integration if it is half open.
+    Returns the number of rows released.
+    """
+    batch_size = int(settings.NIGHTINGALE_DELIVERY_BATCH_SIZE)
+    parked = model.objects.filter(**{
+        done: False, "claimed_until__lte": timezone.now()}) \
+        .order_by('id').values_list('id', 'integration_id')[:batch_size]
+    by_integration = {}
+    for pk, integration_id in parked:
+        by_integration.setdefault(integration_id, []).append(pk)
+    released = []
+    for integration_id, ids in by_integration.items():
+        state, _, _ = breakers.state(integration_id)
+        if state == OPEN:
+            continue
+        if state == HALF_OPEN:
+            # just the probe
+            ids = ids[:1]
+        integration = registry.get(integration_id)
+        queue = integration and integration_queue(
+            integration.integration_type)
+        released.extend((pk, queue) for pk in ids)
+    with transaction.atomic():
+        model.objects.filter(id__in=[pk for pk, _ in released]).update(
+            claimed_until=None)
+        for pk, queue in released:
+            enqueue(task, {param: pk}, queue=queue)
+    return len(released)
+
+
+class Release_Parked(Task):
+
+    """
+    Task to send the messages and submissions parked while their
+    integration's breaker was open
+    """
+    name = "delivery.tasks.release_parked"
+
+    def run(self, **kwargs):
+        l = self.get_logger(**kwargs)
+
+        if settings.NIGHTINGALE_DELIVERY_ENGINE:
+            # the engine claims parked rows itself once they're due
+            return 0
+        released = \
+            release(Message, "delivered", send_message, "message_id") + \
+            release(Submission, "submitted", send_submission, "submission_id")
+        l.info("Released %s parked messages and submissions" % released)
+        return released
+
+release_parked = Release_Parked()
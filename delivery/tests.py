@@ -0,0 +1,272 @@
+import json
+import threading
+import time
+
+import requests
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
+from django.utils.six.moves import socketserver
+
+from accounts.models import Project, Integration
+from reports.models import Report, Category, Location
+from snappy.models import Message
+from ona.models import Submission
+from .engine import deliver_batch, claim
+from .models import DeadLetter
+from .policy import retry_delay, backoff
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fail = False
+        self.delay = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    """
+    Answers like Vumi, Snappy and Ona, by path
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with server.lock:
+            server.requests.append((self.command, self.path, body))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+            count = len(server.requests)
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+        if server.fail:
+            status, content = 500, b'Internal Server Error'
+        elif self.path.startswith('/vumi/'):
+            status, content = 200, json.dumps(
+                {"message_id": "vumi-%s" % count}).encode('utf-8')
+        elif self.path.endswith('/tags'):
+            status, content = 200, b'OK'
+        elif self.path.startswith('/snappy/'):
+            status, content = 200, ('nonce-%s' % count).encode('utf-8')
+        else:
+            status, content = 200, b'{"message": "Successful submission"}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_PUT = respond
+    do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(NIGHTINGALE_DELIVERY_ENGINE=True)
+class TestDeliveryEngine(TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        self.vumi = Integration.objects.create(
+            project=self.project, integration_type="Vumi", details={
+                "vumi_api_url": url + "/vumi",
+                "vumi_account_key": "acc-key",
+                "vumi_conversation_key": "conv",
+                "vumi_conversation_token": "conv-token"
+            }, active=True)
+        self.snappy = Integration.objects.create(
+            project=self.project, integration_type="Snappy", details={
+                "snappy_api_key": "blah",
+                "snappy_mailbox_id": "10",
+                "snappy_api_url": url + "/snappy",
+                "snappy_from_email": "mike+%s@example.org"
+            }, active=True)
+        self.ona = Integration.objects.create(
+            project=self.project, integration_type="Ona", details={
+                "url": url + "/ona",
+                "username": "testuser",
+                "password": "testuserpass",
+                "form_id": "test_form"
+            }, active=True)
+        # no categories, so no bounce
+        self.report = Report.objects.create(
+            project=self.project, contact_key="contact",
+            to_addr="+27845001001",
+            location=Location.objects.create(point=Point(18.0, -33.0)))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_message(self, target="VUMI", integration=None):
+        return Message.objects.create(
+            integration=integration or self.vumi, report=self.report,
+            target=target, message="<b>Hello</b>", to_addr="+27845001001",
+            from_addr="+27845001001")
+
+    def test_deliver_batch(self):
+        category = Category.objects.create(name="Fire", metadata={})
+        self.report.categories.add(category)
+        vumi = self.make_message()
+        snappy = self.make_message("SNAPPY", self.snappy)
+        reply = self.make_message("SNAPPY", self.snappy)
+        submission = Submission.objects.create(
+            integration=self.ona, report=self.report, content='{"a": 1}')
+
+        # the reply waits for the ticket its report is opening
+        self.assertEqual(deliver_batch(), (3, False))
+        self.assertEqual(deliver_batch(), (1, False))
+
+        vumi = Message.objects.get(pk=vumi.pk)
+        self.assertTrue(vumi.delivered)
+        self.assertIsNotNone(vumi.delivered_at)
+        self.assertIsNone(vumi.claimed_until)
+        self.assertTrue(vumi.metadata["vumi_message_id"].startswith("vumi-"))
+        self.assertTrue(Message.objects.get(pk=snappy.pk).delivered)
+        self.assertTrue(Message.objects.get(pk=reply.pk).delivered)
+        self.assertTrue(Submission.objects.get(pk=submission.pk).submitted)
+        report = Report.objects.get(pk=self.report.pk)
+        self.assertTrue(report.snappy_nonce.startswith("nonce-"))
+        self.assertEqual(report.metadata["snappy_nonce"], report.snappy_nonce)
+        self.assertEqual(report.metadata["ona_response"],
+                         "Successful submission")
+
+        paths = [(method, path) for method, path, _ in self.server.requests]
+        self.assertIn(("PUT", "/vumi/conv/messages.json"), paths)
+        self.assertIn(("POST", "/snappy/ticket/%s/tags" %
+                       report.snappy_nonce), paths)
+        self.assertEqual(paths.count(("POST", "/snappy/note")), 2)
+        sent = [json.loads(body.decode('utf-8'))
+                for method, path, body in self.server.requests
+                if path.startswith('/vumi/')]
+        self.assertEqual(sent[0]["content"], "Hello")
+
+    @override_settings(NIGHTINGALE_RETRY_ATTEMPTS=2)
+    def test_failed_delivery_backs_off(self):
+        self.server.fail = True
+        message = self.make_message()
+        self.assertEqual(deliver_batch(), (0, False))
+        message = Message.objects.get(pk=message.pk)
+        self.assertFalse(message.delivered)
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNotNone(message.claimed_until)
+
+        # given up on after the last attempt, and not claimed again
+        Message.objects.filter(pk=message.pk).update(claimed_until=None)
+        self.assertEqual(deliver_batch(), (0, False))
+        dead = DeadLetter.objects.get()
+        self.assertEqual((dead.kind, dead.object_id, dead.attempts,
+                          dead.status_code), ("message", message.id, 2, 500))
+        self.assertEqual(json.loads(dead.payload), {"message_id": message.id})
+        self.server.fail = False
+        self.assertEqual(deliver_batch(), (0, False))
+
+        # until it's requeued
+        call_command('requeue_dead_letters', pause=0, stdout=StringIO())
+        self.assertIsNotNone(DeadLetter.objects.get().requeued_at)
+        self.assertEqual(deliver_batch(), (1, False))
+        self.assertTrue(Message.objects.get(pk=message.pk).delivered)
+
+    def test_claim_urgent_first(self):
+        normal = self.make_message()
+        urgent = self.make_message()
+        urgent.metadata = {"priority": "urgent"}
+        urgent.save()
+        self.assertEqual(claim(Message, "delivered", 1, 60), [urgent.id])
+        self.assertEqual(claim(Message, "delivered", 1, 60), [normal.id])
+
+    def test_per_integration_concurrency(self):
+        self.server.delay = 0.05
+        for _ in range(6):
+            self.make_message()
+        self.assertEqual(deliver_batch(batch_size=5, per_integration=2),
+                         (5, True))
+        self.assertEqual(self.server.max_in_flight, 2)
+        self.assertEqual(deliver_batch(batch_size=5, per_integration=2),
+                         (1, False))
+        self.assertEqual(Message.objects.filter(delivered=False).count(), 0)
+
+    def test_rate_limited_rows_handed_back(self):
+        self.vumi.details["rate_limit"] = "0.001"
+        self.vumi.details["rate_burst"] = "1"
+        self.vumi.save()
+        first = self.make_message()
+        second = self.make_message()
+        self.assertEqual(deliver_batch(per_integration=1), (1, False))
+        self.assertTrue(Message.objects.get(pk=first.pk).delivered)
+        second = Message.objects.get(pk=second.pk)
+        self.assertFalse(second.delivered)
+        self.assertIsNone(second.claimed_until)
+
+    def test_post_save_leaves_delivery_to_engine(self):
+        self.make_message()
+        self.assertEqual(self.server.requests, [])
+
+    def test_deliver_command(self):
+        message = self.make_message()
+        call_command('deliver', once=True, stdout=StringIO())
+        self.assertTrue(Message.objects.get(pk=message.pk).delivered)
+
+        with override_settings(NIGHTINGALE_DELIVERY_ENGINE=False):
+            self.assertRaises(CommandError, call_command, 'deliver',
+                              once=True, stdout=StringIO())
+
+
+class TestDeliveryPolicy(TestCase):
+
+    def http_error(self, status_code, headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers or {})
+        return requests.exceptions.HTTPError(response=response)
+
+    def test_retry_delay(self):
+        for status_code in (500, 502, 503, 599, 429):
+            self.assertIsNotNone(
+                retry_delay(self.http_error(status_code), 1))
+        self.assertIsNotNone(
+            retry_delay(requests.exceptions.ConnectionError(), 1))
+        self.assertIsNotNone(
+            retry_delay(requests.exceptions.ReadTimeout(), 1))
+        # rejected requests aren't retried
+        self.assertIsNone(retry_delay(self.http_error(400), 1))
+        self.assertIsNone(retry_delay(ValueError(), 1))
+        # nor is anything after the last attempt
+        self.assertIsNone(retry_delay(self.http_error(500), 8))
+
+    def test_retry_after(self):
+        delay = retry_delay(
+            self.http_error(429, {"Retry-After": "120"}), 1)
+        self.assertGreaterEqual(delay, 120)
+
+    @override_settings(NIGHTINGALE_RETRY_BASE=10, NIGHTINGALE_RETRY_CAP=60)
+    def test_backoff(self):
+        for attempt, ceiling in ((0, 10), (1, 20), (2, 40), (3, 60),
+                                 (10, 60)):
+            for _ in range(20):
+                delay = backoff(attempt)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, ceiling)
@@ -0,0 +1,81 @@
+import base64
+from collections import OrderedDict
+
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes, force_text
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CreatedCursorPagination(BasePagination):
+
+    """
+    Keyset pagination over ``(created_at, id)``, newest first. The cursor is
+    the key of the last row on the page, so each page is a range scan of the
+    ``(created_at, id)`` index however deep it is, and rows inserted while
+    paging never shift or repeat rows on later pages.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        queryset = queryset.order_by('-created_at', '-id')
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            table = queryset.model._meta.db_table
+            queryset = queryset.extra(
+                where=['("%s"."created_at", "%s"."id") < (%%s, %%s)' % (
+                    table, table)],
+                params=list(cursor))
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        self.has_next = len(results) > self.page_size
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            created_at, pk = force_text(
+                base64.urlsafe_b64decode(force_bytes(encoded))).split('|')
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return (created_at, pk)
+
+    def encode_cursor(self, instance):
+        key = '%s|%s' % (instance.created_at.isoformat(), instance.pk)
+        return force_text(base64.urlsafe_b64encode(force_bytes(key)))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param,
+            self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
@@ -0,0 +1,20 @@
+class SparseFieldsMixin(object):
+
+    """
+    Serializer mixin that drops every field not named in the request's
+    ``?fields=`` parameter (comma separated). Without the parameter all the
+    fields are kept.
+    """
+    fields_query_param = 'fields'
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None:
+            return
+        wanted = request.query_params.get(self.fields_query_param)
+        if not wanted:
+            return
+        wanted = set(name.strip() for name in wanted.split(','))
+        for name in set(self.fields.keys()) - wanted:
+            self.fields.pop(name)
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 """
 
 import os
+from datetime import timedelta
 
 import dj_database_url
 
@@ -55,6 +56,8 @@ INSTALLED_APPS = (
     'reports',
     'snappy',
     'ona',
+    'outbox',
+    'delivery',
 )
 
 MIDDLEWARE_CLASSES = (
@@ -114,6 +117,54 @@ STATIC_URL = '/static/'
 
 GRAPPELLI_ADMIN_TITLE = "NIGHTINGALE"
 
+# Caches - point NIGHTINGALE_CACHE at a shared backend (e.g. memcached
+# configured in local_settings) to share lookups between processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+NIGHTINGALE_CACHE = os.environ.get('NIGHTINGALE_CACHE', 'default')
+# in seconds
+NIGHTINGALE_CACHE_TIMEOUT = os.environ.get('NIGHTINGALE_CACHE_TIMEOUT', 3600)
+# in seconds, the most lookups are cached for when NIGHTINGALE_CACHE isn't
+# shared, as other processes don't see them being dropped on changes
+NIGHTINGALE_LOCAL_CACHE_TIMEOUT = os.environ.get(
+    'NIGHTINGALE_LOCAL_CACHE_TIMEOUT', 30)
+# in seconds, how long a worker trusts its integration registry when the
+# cache can't tell it about changes (i.e. NIGHTINGALE_CACHE isn't shared)
+NIGHTINGALE_INTEGRATION_REGISTRY_TTL = os.environ.get(
+    'NIGHTINGALE_INTEGRATION_REGISTRY_TTL', 300)
+
+# in seconds, how long field clients may reuse the category catalog
+NIGHTINGALE_CATALOG_MAX_AGE = os.environ.get(
+    'NIGHTINGALE_CATALOG_MAX_AGE', 300)
+
+# in seconds, how long a map tile's report clusters are cached
+NIGHTINGALE_CLUSTER_CACHE_TIMEOUT = os.environ.get(
+    'NIGHTINGALE_CLUSTER_CACHE_TIMEOUT', 60)
+
+# vector tiles up to this zoom are cached on disk until a report in them
+# changes, or for at most MAX_AGE seconds
+NIGHTINGALE_TILE_CACHE_DIR = os.environ.get(
+    'NIGHTINGALE_TILE_CACHE_DIR', os.path.join(BASE_DIR, 'tilecache'))
+NIGHTINGALE_TILE_CACHE_MAX_ZOOM = os.environ.get(
+    'NIGHTINGALE_TILE_CACHE_MAX_ZOOM', 16)
+NIGHTINGALE_TILE_CACHE_MAX_AGE = os.environ.get(
+    'NIGHTINGALE_TILE_CACHE_MAX_AGE', 3600)
+
+# HTTP connections to integrations, per worker process and integration.
+# Timeouts are in seconds and apply to requests that don't set their own.
+NIGHTINGALE_HTTP_CONNECT_TIMEOUT = os.environ.get(
+    'NIGHTINGALE_HTTP_CONNECT_TIMEOUT', 5)
+NIGHTINGALE_HTTP_READ_TIMEOUT = os.environ.get(
+    'NIGHTINGALE_HTTP_READ_TIMEOUT', 30)
+NIGHTINGALE_HTTP_POOL_CONNECTIONS = os.environ.get(
+    'NIGHTINGALE_HTTP_POOL_CONNECTIONS', 10)
+NIGHTINGALE_HTTP_POOL_MAXSIZE = os.environ.get(
+    'NIGHTINGALE_HTTP_POOL_MAXSIZE', 10)
+
 # Sentry configuration
 RAVEN_CONFIG = {
     # DevOps will supply you with this.
@@ -141,13 +192,25 @@ CELERYBEAT_SCHEDULER = 'djcelery.schedulers.DatabaseScheduler'
 BROKER_URL = os.environ.get('NIGHTINGALE_REDIS', 'redis://localhost:6379/0')
 
 from kombu import Exchange, Queue
-
-CELERY_DEFAULT_QUEUE = 'nightingale'
-CELERY_QUEUES = (
-    Queue('nightingale',
-          Exchange('nightingale'),
-          routing_key='nightingale'),
-)
+from outbox import routing
+
+# a queue per kind of outbound task, see outbox.routing. Sends are routed
+# by integration when they're enqueued, these are the static routes.
+CELERY_DEFAULT_QUEUE = routing.DEFAULT_QUEUE
+CELERY_QUEUES = tuple(
+    Queue(name, Exchange('nightingale'), routing_key=name)
+    for name in routing.QUEUES)
+CELERY_ROUTES = {
+    'reports.tasks.bounce_report': {'queue': routing.BOUNCE_QUEUE},
+    'snappy.tasks.send_message': {
+        'queue': routing.integration_queue('Snappy')},
+    'snappy.tasks.add_tags': {'queue': routing.TAGS_QUEUE},
+    'ona.tasks.send_submission': {'queue': routing.integration_queue('Ona')},
+}
+# workers run one queue or a few, so this can be set per worker: 1 for
+# queues of slow calls, higher for quick ones
+CELERYD_PREFETCH_MULTIPLIER = int(
+    os.environ.get('NIGHTINGALE_PREFETCH_MULTIPLIER', 4))
 
 CELERY_ALWAYS_EAGER = False
 
@@ -156,6 +219,37 @@ CELERY_IMPORTS = (
     'accounts.tasks',
 )
 
+CELERYBEAT_SCHEDULE = {
+    'relay-outbox': {
+        'task': 'outbox.tasks.relay_outbox',
+        'schedule': timedelta(seconds=5),
+    },
+    'sweep-bounces': {
+        'task': 'reports.tasks.sweep_bounces',
+        'schedule': timedelta(seconds=15),
+    },
+    'fold-rollups': {
+        'task': 'reports.tasks.fold_rollups',
+        'schedule': timedelta(minutes=1),
+    },
+    'process-webhook-inbox': {
+        'task': 'snappy.tasks.process_webhook_inbox',
+        'schedule': timedelta(seconds=5),
+    },
+    'purge-processed-events': {
+        'task': 'snappy.tasks.purge_processed_events',
+        'schedule': timedelta(hours=1),
+    },
+    'deliver': {
+        'task': 'delivery.tasks.deliver',
+        'schedule': timedelta(seconds=5),
+    },
+    'release-parked': {
+        'task': 'delivery.tasks.release_parked',
+        'schedule': timedelta(seconds=30),
+    },
+}
+
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
@@ -163,6 +257,82 @@ CELERY_ACCEPT_CONTENT = ['json']
 # in minutes
 NIGHTINGALE_BOUNCE_DELAY = os.environ.get('NIGHTINGALE_BOUNCE_DELAY', 5)
 
+# hold delayed bounces in reports.PendingBounce for
+# reports.tasks.sweep_bounces instead of as countdown tasks
+NIGHTINGALE_BOUNCE_SCHEDULER = os.environ.get(
+    'NIGHTINGALE_BOUNCE_SCHEDULER', 'true').lower() == 'true'
+NIGHTINGALE_BOUNCE_BATCH_SIZE = int(
+    os.environ.get('NIGHTINGALE_BOUNCE_BATCH_SIZE', 100))
+
+# record task dispatches in the outbox table and publish them from
+# outbox.tasks.relay_outbox instead of straight from post_save
+NIGHTINGALE_OUTBOX = os.environ.get(
+    'NIGHTINGALE_OUTBOX', 'true').lower() == 'true'
+NIGHTINGALE_OUTBOX_BATCH_SIZE = int(
+    os.environ.get('NIGHTINGALE_OUTBOX_BATCH_SIZE', 100))
+
+# reports per transaction when streaming NDJSON reports in
+NIGHTINGALE_INGEST_CHUNK_SIZE = int(
+    os.environ.get('NIGHTINGALE_INGEST_CHUNK_SIZE', 500))
+
+# in seconds, how old a report has to be before it's counted in the rollups
+NIGHTINGALE_ROLLUP_LAG = os.environ.get('NIGHTINGALE_ROLLUP_LAG', 60)
+
+# only store Snappy webhook events in the inbox table and handle them from
+# snappy.tasks.process_webhook_inbox
+NIGHTINGALE_SNAPPY_WEBHOOK_INBOX = os.environ.get(
+    'NIGHTINGALE_SNAPPY_WEBHOOK_INBOX', 'false').lower() == 'true'
+NIGHTINGALE_SNAPPY_INBOX_BATCH_SIZE = int(
+    os.environ.get('NIGHTINGALE_SNAPPY_INBOX_BATCH_SIZE', 100))
+# in seconds, how long handled Snappy webhook events are remembered so
+# redeliveries can be ignored
+NIGHTINGALE_SNAPPY_EVENT_TTL = os.environ.get(
+    'NIGHTINGALE_SNAPPY_EVENT_TTL', 7 * 24 * 60 * 60)
+
+# send undelivered messages and submissions from the delivery engine
+# (delivery.tasks.deliver or manage.py deliver) instead of a task each
+NIGHTINGALE_DELIVERY_ENGINE = os.environ.get(
+    'NIGHTINGALE_DELIVERY_ENGINE', 'false').lower() == 'true'
+NIGHTINGALE_DELIVERY_BATCH_SIZE = int(
+    os.environ.get('NIGHTINGALE_DELIVERY_BATCH_SIZE', 100))
+# requests in flight overall and per integration
+NIGHTINGALE_DELIVERY_CONCURRENCY = int(
+    os.environ.get('NIGHTINGALE_DELIVERY_CONCURRENCY', 20))
+NIGHTINGALE_DELIVERY_PER_INTEGRATION = int(
+    os.environ.get('NIGHTINGALE_DELIVERY_PER_INTEGRATION', 4))
+# in seconds, how long a claimed row is left alone before it's tried again
+NIGHTINGALE_DELIVERY_LEASE = int(
+    os.environ.get('NIGHTINGALE_DELIVERY_LEASE', 300))
+
+# token buckets for the integrations' rate_limit/rate_burst details, shared
+# between workers in redis ('memory' keeps them per process)
+NIGHTINGALE_RATELIMIT_BACKEND = os.environ.get(
+    'NIGHTINGALE_RATELIMIT_BACKEND', 'redis')
+NIGHTINGALE_RATELIMIT_REDIS = os.environ.get(
+    'NIGHTINGALE_RATELIMIT_REDIS', BROKER_URL)
+# in seconds, longest a task sleeps for a token before rescheduling itself
+NIGHTINGALE_RATELIMIT_MAX_WAIT = os.environ.get(
+    'NIGHTINGALE_RATELIMIT_MAX_WAIT', 30)
+
+# circuit breakers per integration, kept in NIGHTINGALE_RATELIMIT_REDIS
+# ('cache' keeps them in NIGHTINGALE_CACHE): consecutive failed calls that
+# open one, and in seconds how long it stays open before letting a probe
+# through and how long that probe has
+NIGHTINGALE_BREAKER_BACKEND = os.environ.get(
+    'NIGHTINGALE_BREAKER_BACKEND', 'redis')
+NIGHTINGALE_BREAKER_THRESHOLD = os.environ.get(
+    'NIGHTINGALE_BREAKER_THRESHOLD', 5)
+NIGHTINGALE_BREAKER_RESET = os.environ.get('NIGHTINGALE_BREAKER_RESET', 60)
+NIGHTINGALE_BREAKER_PROBE_TIMEOUT = os.environ.get(
+    'NIGHTINGALE_BREAKER_PROBE_TIMEOUT', 30)
+
+# retries of failed deliveries, see delivery.policy: tries before a
+# delivery is dead lettered, and in seconds the first retry's backoff and
+# the most any retry backs off
+NIGHTINGALE_RETRY_ATTEMPTS = os.environ.get('NIGHTINGALE_RETRY_ATTEMPTS', 8)
+NIGHTINGALE_RETRY_BASE = os.environ.get('NIGHTINGALE_RETRY_BASE', 10)
+NIGHTINGALE_RETRY_CAP = os.environ.get('NIGHTINGALE_RETRY_CAP', 3600)
+
 import djcelery
 djcelery.setup_loader()
 
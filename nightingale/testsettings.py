@@ -1,5 +1,7 @@
 from nightingale.settings import *  # flake8: noqa
 
+import tempfile
+
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'TESTSEKRET'
 
@@ -13,3 +15,8 @@ CELERY_ALWAYS_EAGER = True
 BROKER_BACKEND = 'memory'
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 RAVEN_CONFIG = {'dsn': None}
+NIGHTINGALE_OUTBOX = False
+NIGHTINGALE_BOUNCE_SCHEDULER = False
+NIGHTINGALE_TILE_CACHE_DIR = tempfile.mkdtemp(prefix='nightingale-tiles-')
+NIGHTINGALE_RATELIMIT_BACKEND = 'memory'
+NIGHTINGALE_BREAKER_BACKEND = 'cache'
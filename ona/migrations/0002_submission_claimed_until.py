@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='claimed_until',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        # the delivery engine claims from the unsubmitted submissions only
+        migrations.RunSQL(
+            "CREATE INDEX ona_submission_unsubmitted "
+            "ON ona_submission (id) WHERE NOT submitted;",
+            "DROP INDEX ona_submission_unsubmitted;"),
+    ]
@@ -1,9 +1,12 @@
+from django.conf import settings
 from django.contrib.postgres.fields import HStoreField
 from django.db import models
 from accounts.models import Integration
 from reports.models import Report
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from outbox.dispatch import enqueue
+from outbox.routing import submission_queue
 
 
 class Submission(models.Model):
@@ -18,6 +21,10 @@ class Submission(models.Model):
     metadata = HStoreField(null=True, blank=True, default={})
     created_at = models.DateTimeField(auto_now_add=True)
     submitted = models.BooleanField(default=False)
+    # set while the delivery engine is submitting it
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    # failed delivery engine sends, for its backoff
+    attempts = models.IntegerField(default=0)
 
     def __str__(self):
         return self.content
@@ -28,5 +35,7 @@ class Submission(models.Model):
           dispatch_uid="ona.post_save.submission")
 def fire_subm_action_if_undelivered(sender, instance, created, **kwargs):
     from .tasks import send_submission
-    if not instance.submitted:
-        send_submission.delay(instance.id)
+    # the delivery engine picks unsubmitted submissions up itself
+    if not instance.submitted and not settings.NIGHTINGALE_DELIVERY_ENGINE:
+        enqueue(send_submission, {"submission_id": instance.id},
+                queue=submission_queue(instance))
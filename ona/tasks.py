@@ -2,20 +2,58 @@ from celery.task import Task
 from celery.utils.log import get_task_logger
 from celery.exceptions import SoftTimeLimitExceeded
 from django.core.exceptions import ObjectDoesNotExist
-import requests
 import json
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, ConnectionError, Timeout
 from .models import Submission
+from accounts.http import sessions
+from accounts.ratelimit import limiter, RateLimited
+from accounts.breaker import breakers
+from delivery.policy import retry_delay, dead_letter
+from outbox.routing import submission_queue
 
 logger = get_task_logger(__name__)
 
 
+def park_submission(submission):
+    """
+    Hold a submission back while its integration's breaker is open, for
+    delivery.tasks.release_parked (or the delivery engine) to pick up
+    """
+    Submission.objects.filter(pk=submission.pk).update(
+        claimed_until=breakers.parked_until(submission.integration_id))
+
+
+def post_submission(session, integration, content):
+    """
+    Submit a form to Ona, returns Ona's decoded response
+    """
+    data = json.dumps({
+        "submission": json.loads(content),
+        "id": integration["form_id"]
+    })
+    r = session.post(
+        integration["url"],
+        data=data,
+        auth=(integration["username"],
+              integration["password"]),
+        headers={
+            "Content-Type": "application/json",
+        }
+    )
+    # Ona explains rejected submissions in the body, but not outages
+    if r.status_code >= 500 or r.status_code == 429:
+        r.raise_for_status()
+    return r.json()
+
+
 class SendSubmission(Task):
 
     """
     Task to load and construct submission and send it off
     """
     name = "ona.tasks.send_submission"
+    # delivery.policy decides when to give up
+    max_retries = None
 
     class FailedEventRequest(Exception):
 
@@ -32,28 +70,38 @@ class SendSubmission(Task):
 
             if submission.submitted is False:
                 integration = submission.integration.details
-                data = json.dumps({
-                    "submission": json.loads(submission.content),
-                    "id": integration["form_id"]
-                })
+                if not breakers.allow(submission.integration_id):
+                    # the integration is down, don't tie up a worker on it
+                    park_submission(submission)
+                    return
+                try:
+                    limiter.acquire(submission.integration_id, integration)
+                except RateLimited as e:
+                    # come back when a token is due rather than spend a retry
+                    logger.info("Rate limited, submitting in %.1fs" % e.wait)
+                    self.apply_async(kwargs={"submission_id": submission_id},
+                                     countdown=e.wait,
+                                     queue=submission_queue(submission))
+                    return
                 try:
-                    r = requests.post(
-                        integration["url"],
-                        data=data,
-                        auth=(integration["username"],
-                              integration["password"]),
-                        headers={
-                            "Content-Type": "application/json",
-                        }
-                    )
-
-                    response = r.json()
-                except HTTPError as e:
-                    # retry message sending if in 500 range (3 default retries)
-                    if 500 < e.response.status_code < 599:
-                        raise self.retry(exc=e)
-                    else:
-                        raise e
+                    response = post_submission(
+                        sessions.get(submission.integration_id),
+                        integration, submission.content)
+                    breakers.record(submission.integration_id)
+                except (HTTPError, ConnectionError, Timeout) as e:
+                    if breakers.record(submission.integration_id, e):
+                        park_submission(submission)
+                        return
+                    attempts = self.request.retries + 1
+                    delay = retry_delay(e, attempts)
+                    if delay is not None:
+                        raise self.retry(exc=e, countdown=delay)
+                    logger.error("Giving up on submission %s" % (
+                        submission.id,), exc_info=True)
+                    dead_letter("submission", self,
+                                {"submission_id": submission.id}, e,
+                                attempts, object_id=submission.id)
+                    return
 
                 # Log the Ona response on the report
                 report = submission.report
@@ -61,7 +109,8 @@ class SendSubmission(Task):
                     report.metadata["ona_response"] = response["error"]
                 else:
                     report.metadata["ona_response"] = response["message"]
-                report.save()
+                # leave snappy_replies to the webhook's increments
+                report.save(update_fields=['metadata', 'updated_at'])
 
                 # Mark the submission as submitted
                 submission.submitted = True
@@ -0,0 +1,40 @@
+import json
+from datetime import timedelta
+
+from celery import current_app
+from django.conf import settings
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+
+def routing(queue):
+    return {} if queue is None else {"queue": queue}
+
+
+def enqueue(task, kwargs, countdown=0, queue=None):
+    """
+    Dispatch ``task`` with ``kwargs``, to ``queue`` if given rather than the
+    task's route (see outbox.routing). With NIGHTINGALE_OUTBOX on this only
+    records an OutboxMessage in the current transaction and the relay
+    publishes it after commit, otherwise the task is published straight away.
+    """
+    if not settings.NIGHTINGALE_OUTBOX:
+        return task.apply_async(kwargs=kwargs, countdown=countdown,
+                                **routing(queue))
+    eta = None
+    if countdown:
+        eta = timezone.now() + timedelta(seconds=countdown)
+    return OutboxMessage.objects.create(
+        task=task.name, kwargs=json.dumps(kwargs), eta=eta, queue=queue)
+
+
+def publish(messages):
+    """
+    Publish outbox messages to the broker over a single producer connection.
+    """
+    with current_app.producer_or_acquire() as producer:
+        for message in messages:
+            current_app.tasks[message.task].apply_async(
+                kwargs=json.loads(message.kwargs), eta=message.eta,
+                producer=producer, **routing(message.queue))
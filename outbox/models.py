@@ -0,0 +1,31 @@
+from django.db import models
+
+
+class OutboxMessage(models.Model):
+
+    """
+    Task dispatch waiting to be published to the broker. Rows are written in
+    the same transaction as the change that triggered them, so they only
+    become visible to the relay once that change has committed.
+
+    :param str task:
+        Registered name of the Celery task
+
+    :param str kwargs:
+        JSON encoded keyword arguments for the task
+
+    :param datetime eta:
+        Optional earliest time the task should run
+
+    :param str queue:
+        Optional queue to publish to instead of the task's route
+
+    """
+    task = models.CharField(max_length=255)
+    kwargs = models.TextField(null=False, blank=False)
+    eta = models.DateTimeField(null=True, blank=True)
+    queue = models.CharField(max_length=100, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "%s %s" % (self.task, self.kwargs)
@@ -0,0 +1,68 @@
+"""
+Which Celery queue each outbound task goes to, so slow or backed up work
+for one partner doesn't hold up another. Sends are routed by the
+integration they go to: replies to citizens over Vumi don't wait behind
+Snappy ticket creation. Bounces, with their ETAs, get a queue of their own,
+everything else stays on the default 'nightingale' queue. The settings
+declare CELERY_QUEUES from QUEUES and use these names for the static
+CELERY_ROUTES, so this module is imported by the settings and mustn't
+import anything that needs them.
+
+Bounces of reports in an urgent category, and the messages and submissions
+they create (marked with priority "urgent" in their metadata), skip all of
+that for the 'urgent' queue.
+"""
+DEFAULT_QUEUE = "nightingale"
+BOUNCE_QUEUE = "bounces"
+TAGS_QUEUE = "snappy_tags"
+URGENT_QUEUE = "urgent"
+
+INTEGRATION_QUEUES = {
+    "Vumi": "vumi",
+    "Snappy": "snappy",
+    "Ona": "ona",
+}
+
+# the integration type each Message.target is delivered through
+TARGET_INTEGRATIONS = {
+    "VUMI": "Vumi",
+    "SNAPPY": "Snappy",
+}
+
+QUEUES = (DEFAULT_QUEUE, BOUNCE_QUEUE, TAGS_QUEUE, URGENT_QUEUE) + tuple(
+    sorted(INTEGRATION_QUEUES.values()))
+
+
+def integration_queue(integration_type):
+    return INTEGRATION_QUEUES.get(integration_type, DEFAULT_QUEUE)
+
+
+def target_queue(target):
+    """
+    Queue for sending a Message to ``target`` (Message.target)
+    """
+    return integration_queue(TARGET_INTEGRATIONS.get(target))
+
+
+def is_urgent(metadata):
+    # imported here as the settings import this module
+    from reports.models import Category
+    return (metadata or {}).get("priority") == Category.URGENT
+
+
+def message_queue(message):
+    """
+    Queue for sending a Message, urgent ones skip their target's queue
+    """
+    if is_urgent(message.metadata):
+        return URGENT_QUEUE
+    return target_queue(message.target)
+
+
+def submission_queue(submission):
+    """
+    Queue for sending a Submission, None for its task's route
+    """
+    if is_urgent(submission.metadata):
+        return URGENT_QUEUE
+    return None
@@ -0,0 +1,43 @@
+from celery.task import Task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import transaction
+
+from .models import OutboxMessage
+from .dispatch import publish
+
+logger = get_task_logger(__name__)
+
+
+class Relay_Outbox(Task):
+
+    """
+    Task to drain the outbox to the broker in batches
+    """
+    name = "outbox.tasks.relay_outbox"
+
+    def run(self, **kwargs):
+        """
+        Publish and remove pending outbox messages a batch at a time. A batch
+        is only removed if publishing all of it succeeded, so a broker failure
+        leaves the rows for the next run.
+        """
+        l = self.get_logger(**kwargs)
+
+        batch_size = int(settings.NIGHTINGALE_OUTBOX_BATCH_SIZE)
+        published = 0
+        while True:
+            with transaction.atomic():
+                batch = list(OutboxMessage.objects.select_for_update()
+                             .order_by('id')[:batch_size])
+                if batch:
+                    publish(batch)
+                    OutboxMessage.objects.filter(
+                        id__in=[message.id for message in batch]).delete()
+            published += len(batch)
+            if len(batch) < batch_size:
+                break
+        l.info("Published %s outbox messages" % published)
+        return published
+
+relay_outbox = Relay_Outbox()
@@ -0,0 +1,81 @@
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from accounts.models import Project
+from accounts.tasks import the_incr
+from reports.models import Category
+from reports.ingest import create_report
+from .models import OutboxMessage
+from .dispatch import enqueue
+from .routing import target_queue, integration_queue, QUEUES
+from .tasks import relay_outbox
+
+
+@override_settings(NIGHTINGALE_OUTBOX=True)
+class TestOutbox(TestCase):
+
+    def make_report(self, description=None):
+        project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        return create_report({
+            "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+            "to_addr": "+27845001001",
+            "project": project,
+            "categories": [Category.objects.create(name="Test Cat 1")],
+            "location": {"point": Point(18.0000000, -33.0000000)},
+            "description": description,
+        })
+
+    def test_enqueue_records_message(self):
+        message = enqueue(the_incr, {"anum": 1}, countdown=60)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        self.assertEqual(message.task, "nightingale.reports.tasks.the_incr")
+        self.assertEqual(json.loads(message.kwargs), {"anum": 1})
+        self.assertTrue(
+            message.eta > timezone.now() + timedelta(seconds=50))
+
+    @override_settings(NIGHTINGALE_OUTBOX=False)
+    def test_enqueue_without_outbox_publishes(self):
+        result = enqueue(the_incr, {"anum": 1})
+        self.assertEqual(result.get(), 2)
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+
+    def test_report_bounce_recorded_in_outbox(self):
+        report = self.make_report(description="Test incident")
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task, "reports.tasks.bounce_report")
+        self.assertEqual(json.loads(message.kwargs),
+                         {"report_id": report.id})
+        self.assertEqual(message.eta, None)
+
+    @override_settings(NIGHTINGALE_OUTBOX_BATCH_SIZE=2)
+    def test_relay_publishes_and_removes_in_batches(self):
+        for anum in range(5):
+            enqueue(the_incr, {"anum": anum})
+        self.make_report()
+        self.assertEqual(relay_outbox.apply().get(), 6)
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+        self.assertEqual(relay_outbox.apply().get(), 0)
+
+    def test_enqueue_records_queue(self):
+        message = enqueue(the_incr, {"anum": 1}, queue="vumi")
+        self.assertEqual(message.queue, "vumi")
+        self.assertEqual(enqueue(the_incr, {"anum": 1}).queue, None)
+        self.assertEqual(relay_outbox.apply().get(), 2)
+
+    def test_routing(self):
+        self.assertEqual(target_queue("VUMI"), "vumi")
+        self.assertEqual(target_queue("SNAPPY"), "snappy")
+        self.assertEqual(integration_queue("Ona"), "ona")
+        self.assertEqual(integration_queue("Unknown"), "nightingale")
+        # every queue tasks are routed to is declared
+        self.assertEqual(
+            sorted(queue.name for queue in settings.CELERY_QUEUES),
+            sorted(QUEUES))
+        for route in settings.CELERY_ROUTES.values():
+            self.assertIn(route['queue'], QUEUES)
@@ -2,7 +2,12 @@ from django.contrib import admin
 
 from .models import Category, ProjectCategory, Report, Location
 
+
+class ReportAdmin(admin.ModelAdmin):
+    # Report.__str__ uses the project name
+    list_select_related = ('project',)
+
 admin.site.register(Category)
 admin.site.register(ProjectCategory)
-admin.site.register(Report)
+admin.site.register(Report, ReportAdmin)
 admin.site.register(Location)
@@ -0,0 +1,86 @@
+"""
+Cached category payloads for the field client endpoints. Payloads are keyed
+on a catalog version that changes whenever a Category or ProjectCategory
+does, and the same version feeds the ETags so an unchanged catalog can be
+answered with a 304 without loading it.
+
+The version is read from the database (latest update and row counts of the
+catalog tables) rather than kept in the cache, so every process agrees on
+it whatever NIGHTINGALE_CACHE is and a change is seen straight away.
+"""
+import hashlib
+import json
+
+from django.db import connection
+from rest_framework.generics import get_object_or_404
+from rest_framework.utils.encoders import JSONEncoder
+
+from accounts.cache import cached
+from .models import Category, ProjectCategory
+from .serializers import (CategorySimpleSerializer,
+                          ProjectCategoryListSerializer)
+
+
+# links are counted and their highest id taken, since swapping a project's
+# categories doesn't touch ProjectCategory.updated_at
+CATALOG_VERSION = (
+    "SELECT (SELECT max(updated_at) FROM {category}), "
+    "(SELECT count(*) FROM {category}), "
+    "(SELECT max(updated_at) FROM {project}), "
+    "(SELECT count(*) FROM {project}), "
+    "(SELECT max(id) FROM {link}), "
+    "(SELECT count(*) FROM {link})")
+
+
+def get_catalog_version():
+    """
+    Version of the category catalog, in a single query
+    """
+    query = CATALOG_VERSION.format(
+        category=Category._meta.db_table,
+        project=ProjectCategory._meta.db_table,
+        link=ProjectCategory.categories.through._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        row = cursor.fetchone()
+    state = "|".join(
+        value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        for value in row)
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+def catalog_etag(version, keys):
+    digest = hashlib.sha1(version.encode('utf-8'))
+    for key in sorted(str(key) for key in keys):
+        digest.update(key.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def plain(data):
+    # drop serializer return types and UUIDs so payloads cache cleanly
+    return json.loads(json.dumps(data, cls=JSONEncoder))
+
+
+def get_project_catalog(project_ids, version):
+    """
+    ProjectCategoryListSerializer payloads for the projects that have
+    categories set up.
+    """
+    catalog = []
+    for project_id in project_ids:
+        def load():
+            projectcategories = ProjectCategory.objects.filter(
+                project_id=project_id).prefetch_related('categories')
+            return plain(ProjectCategoryListSerializer(
+                projectcategories, many=True).data)
+        catalog.extend(cached("reports:catalog:%s:project:%s" % (
+            version, project_id), load))
+    return catalog
+
+
+def get_category(category_id, version):
+    def load():
+        category = get_object_or_404(Category.objects.all(), pk=category_id)
+        return plain(CategorySimpleSerializer(category).data)
+    return cached("reports:catalog:%s:category:%s" % (
+        version, category_id), load)
@@ -0,0 +1,93 @@
+"""
+Report counts for map tiles. Points in a tile are snapped to a grid in
+PostGIS and only the cell counts and centroids are sent back, so a map of a
+whole country costs a few hundred rows rather than every report. Results
+are cached per tile and filter for NIGHTINGALE_CLUSTER_CACHE_TIMEOUT.
+"""
+import hashlib
+import math
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.db import connection
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from accounts.cache import cached
+
+
+MAX_ZOOM = 22
+# cells across (and down) a tile
+GRID_CELLS = 32
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_lon(z, x):
+    return x / float(2 ** z) * 360.0 - 180.0
+
+
+def tile_lat(z, y):
+    n = math.pi * (1 - 2 * y / float(2 ** z))
+    return math.degrees(math.atan(math.sinh(n)))
+
+
+def tile_bbox(z, x, y):
+    """
+    The WGS84 bounding box of web map tile ``z/x/y``.
+    """
+    box = Polygon.from_bbox((tile_lon(z, x), tile_lat(z, y + 1),
+                             tile_lon(z, x + 1), tile_lat(z, y)))
+    box.srid = 4326
+    return box
+
+
+def filter_key(params):
+    digest = hashlib.sha1()
+    for name, value in sorted(params.items()):
+        digest.update(('%s=%s&' % (name, value)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cluster_tile(queryset, z, x, y):
+    """
+    Grid cells for the reports in ``queryset`` that fall in tile ``z/x/y``,
+    as a GeoJSON FeatureCollection of centroids with a ``count`` property.
+    """
+    queryset = queryset.filter(location__point__contained=tile_bbox(z, x, y))
+    try:
+        sql, params = queryset.order_by() \
+            .values_list('location__point').query.sql_with_params()
+    except EmptyResultSet:
+        # the filters can't match anything
+        rows = []
+    else:
+        cell_size = 360.0 / 2 ** z / GRID_CELLS
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT ST_X(centroid), ST_Y(centroid), total FROM ("
+                "SELECT ST_Centroid(ST_Collect(point)) AS centroid, "
+                "count(*) AS total FROM (%s) AS reports "
+                "GROUP BY ST_SnapToGrid(point, %%s)) AS cells" % (sql,),
+                list(params) + [cell_size])
+            rows = cursor.fetchall()
+    return {
+        "type": "FeatureCollection",
+        "features": [{
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {"count": total},
+        } for lon, lat, total in rows],
+    }
+
+
+def get_tile_clusters(queryset, z, x, y, params):
+    """
+    ``cluster_tile`` through the cache, ``params`` being the filters that
+    were applied to ``queryset``.
+    """
+    return cached(
+        "reports:clusters:%s:%s:%s:%s" % (z, x, y, filter_key(params)),
+        lambda: cluster_tile(queryset, z, x, y),
+        settings.NIGHTINGALE_CLUSTER_CACHE_TIMEOUT)
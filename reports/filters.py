@@ -0,0 +1,111 @@
+import django_filters
+from django import forms
+from django.contrib.gis.geos import Polygon
+from rest_framework.exceptions import ParseError
+from rest_framework.filters import BaseFilterBackend
+
+from .models import Location, Report
+
+
+class UUIDFilter(django_filters.Filter):
+    field_class = forms.UUIDField
+
+
+class ReportFilter(django_filters.FilterSet):
+    category = UUIDFilter(name='categories')
+    created_after = django_filters.IsoDateTimeFilter(
+        name='created_at', lookup_type='gte')
+    created_before = django_filters.IsoDateTimeFilter(
+        name='created_at', lookup_type='lt')
+
+    class Meta:
+        model = Report
+        fields = ('project', 'category', 'created_after', 'created_before')
+
+
+class ReportGeoFilter(BaseFilterBackend):
+
+    """
+    Filters reports by where they were made, from the query params:
+
+        ``in_bbox=min_lon,min_lat,max_lon,max_lat``
+            reports inside the box, an index scan on ``location.point``
+        ``point=lon,lat&dist=metres``
+            reports within ``dist`` metres of the point, using ST_DWithin on
+            the geography index so the distance is in metres everywhere
+        ``point=lon,lat&nearest=k``
+            the ``k`` reports closest to the point, nearest first, using the
+            index assisted ``<->`` ordering
+
+    ``nearest`` orders and slices the queryset, so views have to skip
+    pagination for it (see ``is_nearest``).
+    """
+    bbox_param = 'in_bbox'
+    point_param = 'point'
+    dist_param = 'dist'
+    nearest_param = 'nearest'
+    max_nearest = 1000
+
+    @classmethod
+    def is_nearest(cls, request):
+        return cls.nearest_param in request.query_params
+
+    def get_floats(self, request, param, count):
+        value = request.query_params.get(param)
+        if not value:
+            return None
+        try:
+            floats = [float(n) for n in value.split(',')]
+        except ValueError:
+            floats = []
+        if len(floats) != count:
+            raise ParseError(
+                'Invalid value supplied for parameter %s' % (param,))
+        return floats
+
+    def get_positive_number(self, request, param, cast):
+        try:
+            number = cast(request.query_params[param])
+        except ValueError:
+            number = 0
+        if number <= 0:
+            raise ParseError(
+                'Invalid value supplied for parameter %s' % (param,))
+        return number
+
+    def filter_queryset(self, request, queryset, view):
+        bbox = self.get_floats(request, self.bbox_param, 4)
+        if bbox is not None:
+            box = Polygon.from_bbox(bbox)
+            box.srid = 4326
+            queryset = queryset.filter(location__point__contained=box)
+
+        point = self.get_floats(request, self.point_param, 2)
+        has_dist = self.dist_param in request.query_params
+        has_nearest = self.is_nearest(request)
+        if point is None:
+            if has_dist or has_nearest:
+                raise ParseError('%s and %s require the %s parameter' % (
+                    self.dist_param, self.nearest_param, self.point_param))
+            return queryset
+
+        location = Location._meta.db_table
+        if has_dist:
+            dist = self.get_positive_number(request, self.dist_param, float)
+            # matches the reports_location_point_geog GiST index
+            queryset = queryset.filter(location__point__isnull=False).extra(
+                where=['ST_DWithin(geography("%s"."point"), '
+                       'ST_MakePoint(%%s, %%s)::geography, %%s)' % (
+                           location,)],
+                params=point + [dist])
+        if has_nearest:
+            nearest = self.get_positive_number(
+                request, self.nearest_param, int)
+            queryset = queryset.filter(location__point__isnull=False).extra(
+                select={'distance': '"%s"."point" <-> '
+                        'ST_SetSRID(ST_MakePoint(%%s, %%s), 4326)' % (
+                            location,)},
+                select_params=point,
+                order_by=['distance'])
+            queryset = queryset[:min(nearest, self.max_nearest)]
+        return queryset
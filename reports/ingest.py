@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+
+from .models import Location, Report
+from .tiles import forget_tiles
+
+
+def reserve_ids(model, count):
+    """
+    Pull ``count`` primary keys off the model's id sequence in a single
+    round trip so rows can be bulk inserted with known ids (bulk_create
+    does not hand back ids on this version of Django).
+    """
+    if count == 0:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)",
+            [model._meta.db_table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def create_reports(items):
+    """
+    Create reports from a list of ``ReportUserSerializer`` validated data
+    dicts.
+
+    Locations, reports and category links are each written with a single
+    bulk insert inside one transaction. Bulk inserts don't send signals so
+    ``post_save`` is sent once per report, with the categories passed along
+    so receivers don't have to query for them. With NIGHTINGALE_OUTBOX on it
+    is sent inside the transaction so the outbox rows it produces commit
+    with the reports, otherwise after the commit so the tasks it publishes
+    can't run before the reports exist. Cached map tiles with the new
+    points in them are dropped afterwards.
+    """
+    items = [dict(item) for item in items]
+    location_ids = reserve_ids(Location, len(items))
+    report_ids = reserve_ids(Report, len(items))
+    Link = Report.categories.through
+
+    locations = []
+    reports = []
+    links = []
+    categories = {}
+    for location_id, report_id, data in zip(location_ids, report_ids, items):
+        location = Location(id=location_id, **data.pop('location'))
+        report_categories = list(data.pop('categories', []))
+        report = Report(id=report_id, location=location, **data)
+        locations.append(location)
+        reports.append(report)
+        categories[report_id] = report_categories
+        links.extend(Link(report_id=report_id, category_id=category.pk)
+                     for category in report_categories)
+
+    def send_post_save():
+        for report in reports:
+            post_save.send(sender=Report, instance=report, created=True,
+                           update_fields=None, raw=False,
+                           using=connection.alias,
+                           categories=categories[report.id])
+
+    with transaction.atomic():
+        Location.objects.bulk_create(locations)
+        Report.objects.bulk_create(reports)
+        Link.objects.bulk_create(links)
+        if settings.NIGHTINGALE_OUTBOX:
+            send_post_save()
+    if not settings.NIGHTINGALE_OUTBOX:
+        send_post_save()
+    forget_tiles(location.point for location in locations)
+    return reports
+
+
+def create_report(validated_data):
+    """
+    Create a single report the same way as ``create_reports``, so it costs
+    a fixed number of queries and sends ``post_save`` once.
+    """
+    return create_reports([validated_data])[0]
@@ -0,0 +1,51 @@
+"""
+How long reports take to reach Snappy, per priority lane, so the urgent
+lane can be seen to stay bounded while the normal one backs up.
+
+Latency is from a report being created to its Snappy ticket message being
+delivered (Message.delivered_at), including the wait for a description and
+any retries on the way. Messages made before lanes were
+recorded have no priority and aren't counted.
+"""
+from django.db import connection
+
+
+SECONDS = "extract(epoch FROM message.delivered_at - report.created_at)"
+
+LATENCY = (
+    "SELECT message.metadata -> 'priority', "
+    "count(*) FILTER (WHERE message.delivered), "
+    "count(*) FILTER (WHERE NOT message.delivered), "
+    "percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP "
+    "(ORDER BY " + SECONDS + ") FILTER (WHERE message.delivered), "
+    "max(" + SECONDS + ") FILTER (WHERE message.delivered) "
+    "FROM snappy_message AS message "
+    "JOIN reports_report AS report ON report.id = message.report_id "
+    "WHERE message.target = 'SNAPPY' "
+    "AND message.metadata ? 'priority' "
+    "AND report.created_at >= %s AND report.created_at < %s "
+    "GROUP BY 1 ORDER BY 1")
+
+
+def delivery_latency(start, end):
+    """
+    Seconds from creation to delivery of the reports created in
+    [start, end), per lane. Percentiles are None for a lane with nothing
+    delivered yet.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(LATENCY, [start, end])
+        rows = cursor.fetchall()
+    lanes = []
+    for lane, delivered, pending, percentiles, slowest in rows:
+        p50, p90, p99 = percentiles or (None, None, None)
+        lanes.append({
+            "lane": lane,
+            "delivered": delivered,
+            "pending": pending,
+            "p50": p50,
+            "p90": p90,
+            "p99": p99,
+            "max": slowest,
+        })
+    return lanes
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from reports.rollups import rebuild_rollups
+
+
+def parse_when(value):
+    when = parse_datetime(value)
+    if when is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError("Invalid date: %s" % value)
+        when = datetime(day.year, day.month, day.day)
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.utc)
+    return when
+
+
+class Command(BaseCommand):
+    help = ("Recount the report rollups for the hours between --start and "
+            "--end (dates or ISO datetimes, everything by default)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', dest='start', default=None)
+        parser.add_argument('--end', dest='end', default=None)
+
+    def handle(self, *args, **options):
+        start = options['start'] and parse_when(options['start'])
+        end = options['end'] and parse_when(options['end'])
+        rebuild_rollups(start, end)
+        self.stdout.write("Rebuilt report rollups from %s to %s" % (
+            start or "the beginning", end or "the watermark"))
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0006_auto_20150804_1932'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingBounce',
+            fields=[
+                ('report', models.OneToOneField(related_name='pending_bounce', primary_key=True, serialize=False, to='reports.Report')),
+                ('due_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
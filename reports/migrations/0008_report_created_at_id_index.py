@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0007_pendingbounce'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='report',
+            index_together=set([('created_at', 'id')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0008_report_created_at_id_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX reports_location_point_geog "
+            "ON reports_location USING GIST (geography(point));",
+            "DROP INDEX reports_location_point_geog;"),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('reports', '0009_location_point_geography_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('hour', models.DateTimeField()),
+                ('count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(related_name='report_rollups', to='reports.Category', null=True)),
+                ('project', models.ForeignKey(related_name='report_rollups', to='accounts.Project')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('name', models.CharField(max_length=50, serialize=False, primary_key=True)),
+                ('position', models.DateTimeField()),
+            ],
+        ),
+        # one row per project, category (null for the total) and hour, the
+        # conflict target of the fold
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX reports_reportrollup_key "
+            "ON reports_reportrollup "
+            "(project_id, (COALESCE(category_id, "
+            "'00000000-0000-0000-0000-000000000000'::uuid)), hour);",
+            "DROP INDEX reports_reportrollup_key;"),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0010_reportrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='snappy_nonce',
+            field=models.CharField(db_index=True, max_length=255, null=True, blank=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE reports_report SET snappy_nonce = metadata -> 'snappy_nonce' "
+            "WHERE metadata ? 'snappy_nonce';",
+            migrations.RunSQL.noop),
+    ]
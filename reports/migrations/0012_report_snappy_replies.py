@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0011_report_snappy_nonce'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='snappy_replies',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            "UPDATE reports_report "
+            "SET snappy_replies = (metadata -> 'snappy_replies')::integer "
+            "WHERE metadata ? 'snappy_replies';",
+            migrations.RunSQL.noop),
+    ]
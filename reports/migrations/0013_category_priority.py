@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0012_report_snappy_replies'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='priority',
+            field=models.CharField(default='normal', max_length=10, choices=[('normal', 'Normal'), ('urgent', 'Urgent')]),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='bounce_delay',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='pendingbounce',
+            name='urgent',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,8 +1,11 @@
 import uuid
+from datetime import timedelta
 
 from django.contrib.postgres.fields import HStoreField
 from django.contrib.gis.db import models
 from django.conf import settings
+from django.db import connection
+from django.utils import timezone
 from accounts.models import Project
 
 
@@ -20,11 +23,28 @@ class Category(models.Model):
     :param dict metadata:
         A hstore field for unstructured project information.
 
+    :param str priority:
+        'urgent' reports are bounced straight away, without waiting for a
+        description, and delivered ahead of everything else.
+
+    :param int bounce_delay:
+        Optional minutes to wait for a description before bouncing,
+        instead of NIGHTINGALE_BOUNCE_DELAY.
+
     """
+    NORMAL = "normal"
+    URGENT = "urgent"
+    PRIORITY = (
+        (NORMAL, "Normal"),
+        (URGENT, "Urgent"),
+    )
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=100)
     order = models.IntegerField(default=1000)
     metadata = HStoreField(null=True, blank=True)
+    priority = models.CharField(max_length=10, choices=PRIORITY,
+                                default=NORMAL)
+    bounce_delay = models.IntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -103,6 +123,14 @@ class Report(models.Model):
     :param dict metadata:
         A hstore field for unstructured report information.
 
+    :param str snappy_nonce:
+        Nonce of the Snappy ticket opened for the report, also kept in
+        metadata. Indexed for the Snappy webhook.
+
+    :param int snappy_replies:
+        Number of Snappy replies sent on to the reporter, only ever
+        incremented in the database.
+
     """
     contact_key = models.CharField(max_length=36, null=False, blank=False)
     to_addr = models.CharField(max_length=255, null=False, blank=False)
@@ -116,32 +144,189 @@ class Report(models.Model):
     description = models.TextField(null=True, blank=True)
     incident_at = models.DateTimeField(null=True, blank=True)
     metadata = HStoreField(null=True, blank=True, default={})
+    snappy_nonce = models.CharField(max_length=255, null=True, blank=True,
+                                    db_index=True)
+    snappy_replies = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # keyset pagination for the admin listing
+        index_together = [('created_at', 'id')]
+
     def __str__(self):
         return "Incident for %s reported at %s" % (
             self.project.name, self.created_at)
 
+
+class PendingBounce(models.Model):
+
+    """
+    Bounce waiting for a report, one per report however often it is saved
+
+    :param datetime due_at:
+        When the sweeper should bounce the report
+
+    :param bool urgent:
+        Whether the report is in an urgent category, swept first and
+        bounced on the urgent queue
+    """
+    report = models.OneToOneField(Report,
+                                  related_name='pending_bounce',
+                                  primary_key=True)
+    due_at = models.DateTimeField(db_index=True)
+    urgent = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "Bounce for report %s due at %s" % (
+            self.report_id, self.due_at)
+
+
+def schedule_bounce(report_id, countdown, urgent=False):
+    """
+    Make sure a bounce is pending for the report no later than ``countdown``
+    seconds from now. Repeated saves collapse into the one row and only ever
+    bring its deadline forward, so a save with a description makes it due
+    straight away.
+    """
+    due_at = timezone.now() + timedelta(seconds=countdown)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO reports_pendingbounce"
+            " (report_id, due_at, urgent, created_at)"
+            " VALUES (%s, %s, %s, %s)"
+            " ON CONFLICT (report_id) DO UPDATE"
+            " SET due_at = LEAST(reports_pendingbounce.due_at,"
+            " EXCLUDED.due_at),"
+            " urgent = reports_pendingbounce.urgent OR EXCLUDED.urgent",
+            [report_id, due_at, urgent, timezone.now()])
+
+
+def is_urgent(categories):
+    return any(category.priority == Category.URGENT
+               for category in categories)
+
+
+def bounce_delay(categories):
+    """
+    Seconds to wait for a description before bouncing a report in
+    ``categories``, the shortest of their delays
+    """
+    default = int(settings.NIGHTINGALE_BOUNCE_DELAY)
+    return min(
+        default if category.bounce_delay is None else category.bounce_delay
+        for category in categories) * 60
+
+
+class ReportRollup(models.Model):
+
+    """
+    Count of reports made per project, category and hour, folded in from
+    the reports table by reports.rollups
+
+    :param category:
+        The category counted, null for the project's total (reports with
+        several categories are counted once in the total)
+
+    :param datetime hour:
+        Start of the hour the reports were created in
+    """
+    project = models.ForeignKey(Project, related_name='report_rollups')
+    category = models.ForeignKey(Category, related_name='report_rollups',
+                                 null=True)
+    hour = models.DateTimeField()
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "%s reports for %s at %s" % (
+            self.count, self.project_id, self.hour)
+
+
+class RollupWatermark(models.Model):
+
+    """
+    How far reports have been folded into a rollup table
+
+    :param datetime position:
+        Reports created before this are counted
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    position = models.DateTimeField()
+
+    def __str__(self):
+        return "%s folded up to %s" % (self.name, self.position)
+
 # Make sure new messages are sent
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from outbox.dispatch import enqueue
+from outbox.routing import URGENT_QUEUE
 from .tasks import bounce_report
 
 
 @receiver(post_save, sender=Report)
-def fire_bounce_action(sender, instance, created, **kwargs):
+def fire_bounce_action(sender, instance, created, categories=None, **kwargs):
     """
     first check for categories as those are manytomany and applied after 1st
-    creation action.
+    creation action. Bulk creation passes the categories it linked so they
+    don't have to be counted again.
     if description is still None then fire with variable delay to allow for
     user update. bounce_reports is responsible for not firing if already logged
+    With NIGHTINGALE_BOUNCE_SCHEDULER on the bounce is left to the sweeper
+    rather than held by a worker as a countdown task.
+    Reports in an urgent category don't wait for a description and are
+    bounced on the urgent queue.
     """
-    if instance.categories.count() > 0:
-        if instance.description is None:
-            when = int(settings.NIGHTINGALE_BOUNCE_DELAY) * 60
+    if categories is None:
+        categories = list(instance.categories.all())
+    if len(categories) > 0:
+        urgent = is_urgent(categories)
+        if instance.description is None and not urgent:
+            when = bounce_delay(categories)
         else:
             when = 0
 
-        bounce_report.apply_async(kwargs={"report_id": instance.id},
-                                  countdown=when)
+        if settings.NIGHTINGALE_BOUNCE_SCHEDULER:
+            schedule_bounce(instance.id, when, urgent=urgent)
+        else:
+            enqueue(bounce_report, {"report_id": instance.id},
+                    countdown=when, queue=URGENT_QUEUE if urgent else None)
+
+
+# Cached map tiles are dropped when the reports in them change
+from django.db.models.signals import post_delete, m2m_changed
+
+
+@receiver([post_save, post_delete], sender=Location)
+def forget_location_tiles(sender, instance, **kwargs):
+    # bulk created locations are handled by ingest.create_reports
+    from .tiles import forget_tiles
+    forget_tiles([instance.point])
+
+
+@receiver(post_delete, sender=Report)
+def forget_report_tiles(sender, instance, **kwargs):
+    from .tiles import forget_tiles
+    forget_tiles(Location.objects.filter(id=instance.location_id)
+                 .values_list('point', flat=True))
+
+
+@receiver(m2m_changed, sender=Report.categories.through)
+def forget_category_tiles(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    """
+    Tiles are cached per category filter, so recategorised reports drop
+    theirs. ``instance`` is a Category when the change is made from its
+    side, and is cleared before it happens so its reports can be found.
+    """
+    from .tiles import forget_tiles
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        locations = Location.objects.filter(id=instance.location_id)
+    elif action == 'pre_clear':
+        locations = Location.objects.filter(reports__categories=instance)
+    else:
+        locations = Location.objects.filter(reports__id__in=pk_set)
+    forget_tiles(locations.values_list('point', flat=True))
@@ -0,0 +1,107 @@
+"""
+Hourly report counts per project and category for the stats screens.
+
+New reports are folded into ReportRollup by the fold_rollups task, which
+counts the reports created since a watermark. Reports only count once they
+are NIGHTINGALE_ROLLUP_LAG seconds old, so a transaction still open when a
+fold runs isn't skipped. ``rebuild_rollups`` recomputes any range from
+scratch.
+"""
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import ReportRollup, RollupWatermark
+
+
+WATERMARK = "reports"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# the unique index on rollups treats a null (total) category as this one
+ON_CONFLICT = (
+    "ON CONFLICT (project_id, (COALESCE(category_id, "
+    "'00000000-0000-0000-0000-000000000000'::uuid)), hour) "
+    "DO UPDATE SET count = reports_reportrollup.count + EXCLUDED.count")
+
+FOLD_CATEGORIES = (
+    "INSERT INTO reports_reportrollup (project_id, category_id, hour, count) "
+    "SELECT report.project_id, link.category_id, "
+    "date_trunc('hour', report.created_at), count(*) "
+    "FROM reports_report AS report "
+    "JOIN reports_report_categories AS link ON link.report_id = report.id "
+    "WHERE report.created_at >= %s AND report.created_at < %s "
+    "AND report.project_id IS NOT NULL "
+    "GROUP BY 1, 2, 3 " + ON_CONFLICT)
+
+FOLD_TOTALS = (
+    "INSERT INTO reports_reportrollup (project_id, category_id, hour, count) "
+    "SELECT report.project_id, NULL, "
+    "date_trunc('hour', report.created_at), count(*) "
+    "FROM reports_report AS report "
+    "WHERE report.created_at >= %s AND report.created_at < %s "
+    "AND report.project_id IS NOT NULL "
+    "GROUP BY 1, 3 " + ON_CONFLICT)
+
+
+def floor_hour(when):
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(when):
+    hour = floor_hour(when)
+    if hour < when:
+        hour += timedelta(hours=1)
+    return hour
+
+
+def fold_reports(start, end):
+    """
+    Add the reports created in [start, end) to the rollups.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(FOLD_CATEGORIES, [start, end])
+        cursor.execute(FOLD_TOTALS, [start, end])
+
+
+def lock_watermark():
+    RollupWatermark.objects.get_or_create(
+        name=WATERMARK, defaults={"position": EPOCH})
+    return RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+
+
+def advance_rollups():
+    """
+    Fold in the reports created since the watermark, up to
+    NIGHTINGALE_ROLLUP_LAG seconds ago. Returns the new watermark.
+    """
+    end = timezone.now() - timedelta(
+        seconds=int(settings.NIGHTINGALE_ROLLUP_LAG))
+    with transaction.atomic():
+        watermark = lock_watermark()
+        if end > watermark.position:
+            fold_reports(watermark.position, end)
+            watermark.position = end
+            watermark.save()
+    return watermark.position
+
+
+def rebuild_rollups(start=None, end=None):
+    """
+    Recount the rollups for the hours between ``start`` and ``end``
+    (everything by default). Only reports behind the watermark are counted,
+    the rest are left to the next fold.
+    """
+    with transaction.atomic():
+        watermark = lock_watermark()
+        hours = ReportRollup.objects.all()
+        if start is not None:
+            start = floor_hour(start)
+            hours = hours.filter(hour__gte=start)
+        if end is not None:
+            end = ceil_hour(end)
+            hours = hours.filter(hour__lt=end)
+        hours.delete()
+        if end is None or end > watermark.position:
+            end = watermark.position
+        fold_reports(start or EPOCH, end)
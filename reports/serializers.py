@@ -1,13 +1,18 @@
 from rest_framework import serializers
+from rest_framework_gis.serializers import (GeoFeatureModelSerializer,
+                                            GeometryField)
 
+from nightingale.serializers import SparseFieldsMixin
 from .models import Category, ProjectCategory, Report, Location
+from .ingest import create_report
 
 
 class CategorySerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = Category
-        fields = ('url', 'id', 'name', 'order', 'metadata')
+        fields = ('url', 'id', 'name', 'order', 'metadata', 'priority',
+                  'bounce_delay')
 
 
 class ProjectCategorySerializer(serializers.HyperlinkedModelSerializer):
@@ -34,17 +39,30 @@ class ReportSerializer(serializers.HyperlinkedModelSerializer):
         model = Report
         fields = ('url', 'id', 'contact_key', 'to_addr', 'categories',
                   'project', 'location', 'description', 'incident_at',
-                  'metadata')
+                  'metadata', 'snappy_replies')
+        read_only_fields = ('snappy_replies',)
 
     def create(self, validated_data):
-        location_data = validated_data.pop('location')
-        loc = Location.objects.create(**location_data)
-        categories = validated_data.pop('categories')
-        report = Report.objects.create(location=loc, **validated_data)
-        for category in categories:
-            report.categories.add(category)
-        report.save()
-        return report
+        return create_report(validated_data)
+
+
+class ReportReadSerializer(SparseFieldsMixin, ReportSerializer):
+    """
+        Used for listing and retrieving reports, supports ?fields=
+    """
+
+
+class ReportGeoSerializer(GeoFeatureModelSerializer):
+    """
+        Reports as GeoJSON features, used by the geo listing
+    """
+    point = GeometryField(source='location.point', read_only=True)
+
+    class Meta:
+        model = Report
+        geo_field = 'point'
+        fields = ('id', 'point', 'project', 'categories', 'description',
+                  'incident_at', 'created_at')
 
 
 class CategorySimpleSerializer(serializers.ModelSerializer):
@@ -79,11 +97,4 @@ class ReportUserSerializer(serializers.ModelSerializer):
                   'location', 'description', 'incident_at', 'metadata')
 
     def create(self, validated_data):
-        location_data = validated_data.pop('location')
-        loc = Location.objects.create(**location_data)
-        categories = validated_data.pop('categories')
-        report = Report.objects.create(location=loc, **validated_data)
-        for category in categories:
-            report.categories.add(category)
-        report.save()
-        return report
+        return create_report(validated_data)
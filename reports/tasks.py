@@ -3,11 +3,18 @@ from celery.task import Task
 from celery.utils.log import get_task_logger
 from celery.exceptions import SoftTimeLimitExceeded
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.utils import timezone
 
 logger = get_task_logger(__name__)
 
-from .models import Report
+from .models import Category, Report, PendingBounce, is_urgent
+from .rollups import advance_rollups
+from outbox.dispatch import enqueue
+from outbox.routing import URGENT_QUEUE
+from accounts.registry import registry
 from snappy.models import Message
 from ona.models import Submission
 
@@ -34,14 +41,15 @@ class Bounce_Report(Task):
 
         l.info("Loading Report")
         try:
-            report = Report.objects.get(pk=report_id)
-            integrations = report.project.integrations
+            report = Report.objects.select_related('location') \
+                .prefetch_related('categories').get(pk=report_id)
             categories = report.categories.all()
-            active_snappy = integrations.filter(integration_type='Snappy',
-                                                active=True)
-            active_ona = integrations.filter(integration_type='Ona',
-                                             active=True)
-            if active_snappy.count() == 1 and \
+            # carried by what's sent so it can be delivered in its lane
+            priority = Category.URGENT if is_urgent(categories) \
+                else Category.NORMAL
+            active_snappy = registry.active(report.project_id, 'Snappy')
+            active_ona = registry.active(report.project_id, 'Ona')
+            if len(active_snappy) == 1 and \
                     "snappy_nonce" not in report.metadata:
                 # create a snappy message
                 content = "Description: %s \n\n" % report.description
@@ -58,8 +66,9 @@ class Bounce_Report(Task):
                 message.message = content
                 message.contact_key = report.contact_key
                 message.from_addr = report.to_addr
+                message.metadata = {"priority": priority}
                 message.save()
-            if active_ona.count() == 1 and \
+            if len(active_ona) == 1 and \
                     "ona_response" not in report.metadata:
                 # create a json object to send to Ona
                 category_list = []
@@ -77,6 +86,7 @@ class Bounce_Report(Task):
                 submission.integration = active_ona[0]
                 submission.report = report
                 submission.content = json.dumps(content)
+                submission.metadata = {"priority": priority}
                 submission.save()
         except ObjectDoesNotExist:
             logger.error('Missing Report object', exc_info=True)
@@ -88,3 +98,57 @@ class Bounce_Report(Task):
                 exc_info=True)
 
 bounce_report = Bounce_Report()
+
+
+class Sweep_Bounces(Task):
+
+    """
+    Task to bounce reports whose pending bounce has come due
+    """
+    name = "reports.tasks.sweep_bounces"
+
+    def run(self, **kwargs):
+        """
+        Dispatch due bounces a batch at a time, removing their pending rows
+        in the same transaction.
+        """
+        l = self.get_logger(**kwargs)
+
+        batch_size = int(settings.NIGHTINGALE_BOUNCE_BATCH_SIZE)
+        bounced = 0
+        while True:
+            with transaction.atomic():
+                pending = list(
+                    PendingBounce.objects.select_for_update()
+                    .filter(due_at__lte=timezone.now())
+                    .order_by('-urgent', 'due_at')
+                    .values_list('report_id', 'urgent')[:batch_size])
+                for report_id, urgent in pending:
+                    enqueue(bounce_report, {"report_id": report_id},
+                            queue=URGENT_QUEUE if urgent else None)
+                due = [report_id for report_id, _ in pending]
+                PendingBounce.objects.filter(report_id__in=due).delete()
+            bounced += len(due)
+            if len(due) < batch_size:
+                break
+        l.info("Bounced %s reports" % bounced)
+        return bounced
+
+sweep_bounces = Sweep_Bounces()
+
+
+class Fold_Rollups(Task):
+
+    """
+    Task to fold newly created reports into the report rollups
+    """
+    name = "reports.tasks.fold_rollups"
+
+    def run(self, **kwargs):
+        l = self.get_logger(**kwargs)
+
+        position = advance_rollups()
+        l.info("Report rollups folded up to %s" % position)
+        return position.isoformat()
+
+fold_rollups = Fold_Rollups()
@@ -1,19 +1,100 @@
 import json
+import os
 import pytz
+import time
 import responses
 from datetime import datetime
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.contrib.gis.geos import Point
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
 from django.db.models.signals import post_save
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
 
-from .models import Category, ProjectCategory, Report, fire_bounce_action
-from accounts.models import Project, UserProject
+from .models import (Category, ProjectCategory, Report, PendingBounce,
+                     ReportRollup, fire_bounce_action)
+from .latency import delivery_latency
+from .tasks import sweep_bounces, fold_rollups
+from .ingest import create_report, create_reports
+from .tiles import point_tile, tile_dir
+from accounts.models import Project, UserProject, Integration
 from snappy.models import Message, fire_msg_action_if_undelivered
+from outbox.models import OutboxMessage
+from accounts.cache import get_cache
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def read_fields(data):
+    """
+    (field number, value) of each field of a protobuf message, varints as
+    ints and everything else as its bytes
+    """
+    data = bytearray(data)
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + size], pos + size
+        else:
+            size = 8 if wire_type == 1 else 4
+            value, pos = data[pos:pos + size], pos + size
+        yield key >> 3, value
+
+
+def read_tile_attribute(tile, name):
+    """
+    Values of a feature attribute across the layers of a Mapbox Vector Tile
+    """
+    found = []
+    for field, layer in read_fields(tile):
+        if field != 3:
+            continue
+        keys, values, features = [], [], []
+        for layer_field, value in read_fields(layer):
+            if layer_field == 2:
+                features.append(value)
+            elif layer_field == 3:
+                keys.append(bytes(value).decode('utf-8'))
+            elif layer_field == 4:
+                kind, value = next(read_fields(value))
+                if kind == 1:
+                    value = bytes(value).decode('utf-8')
+                elif kind == 6:
+                    value = (value >> 1) ^ -(value & 1)
+                values.append(value)
+        for feature in features:
+            for feature_field, tags in read_fields(feature):
+                if feature_field != 2:
+                    continue
+                pos, indexes = 0, []
+                while pos < len(tags):
+                    index, pos = read_varint(tags, pos)
+                    indexes.append(index)
+                for key, value in zip(indexes[::2], indexes[1::2]):
+                    if keys[key] == name:
+                        found.append(values[value])
+    return found
 
 
 class APITestCase(TestCase):
@@ -207,6 +288,64 @@ class TestReportsAPI(AuthenticatedAPITestCase):
         self.assertEqual(readonly.status_code, status.HTTP_200_OK)
         self.assertEqual(readonly.data["name"], "Test Cat 1")
 
+    def test_project_categories_not_modified(self):
+        category1 = self.make_category(name="Test Cat 1", order=3)
+        post_data = {
+            "project": "/api/v1/sys/projects/%s/" % self.project_id,
+            "categories": ["/api/v1/sys/categories/%s/" % category1]
+        }
+        self.adminclient.post('/api/v1/sys/projectcategories/',
+                              json.dumps(post_data),
+                              content_type='application/json')
+
+        response = self.normalclient.get('/api/v1/category/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data[0]["categories"]), 1)
+        self.assertIn("max-age", response["Cache-Control"])
+        etag = response["ETag"]
+
+        # only the token lookup and the catalog version hit the database
+        with self.assertNumQueries(2):
+            response = self.normalclient.get('/api/v1/category/',
+                                             HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+        # changing a category changes the catalog
+        category = Category.objects.get(id=category1)
+        category.name = "Renamed"
+        category.save()
+        response = self.normalclient.get('/api/v1/category/',
+                                         HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.data[0]["categories"][0]["name"],
+                         "Renamed")
+
+        # as does swapping a project's categories
+        category2 = Category.objects.create(name="Test Cat 2")
+        etag = self.normalclient.get('/api/v1/category/')["ETag"]
+        projectcategory = ProjectCategory.objects.get()
+        projectcategory.categories.remove(category)
+        projectcategory.categories.add(category2)
+        response = self.normalclient.get('/api/v1/category/',
+                                         HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]["categories"][0]["name"],
+                         "Test Cat 2")
+
+    def test_get_category_not_modified(self):
+        category1 = self.make_category(name="Test Cat 1", order=3)
+        response = self.normalclient.get('/api/v1/category/%s/' % category1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(2):
+            response = self.normalclient.get(
+                '/api/v1/category/%s/' % category1,
+                HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
     def test_create_report_data(self):
         category1 = self.make_category(name="Test Cat 1", order=1)
         location1 = Point(18.0000000, -33.0000000)
@@ -268,6 +407,367 @@ class TestReportsAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.incident_at, datetime(2015, 2, 2, 7, 10,
                                                  tzinfo=pytz.utc))
 
+    def test_create_report_batch_normalclient(self):
+        category1 = self.make_category(name="Test Cat 1", order=1)
+        category2 = self.make_category(name="Test Cat 2", order=1)
+        location1 = Point(18.0000000, -33.0000000)
+        post_data = [
+            {
+                "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+                "to_addr": "+27845001001",
+                "categories": [category1, category2],
+                "location": self.make_location(18.0000000, -33.0000000),
+                "description": "Test incident",
+                "incident_at": "2015-02-02 07:10"
+            },
+            {
+                # no location so should be rejected
+                "contact_key": "579ed9e9c0554eeca149d7fccd9b54e6",
+                "to_addr": "+27845001002",
+                "categories": [category1],
+            },
+            {
+                "contact_key": "579ed9e9c0554eeca149d7fccd9b54e7",
+                "to_addr": "+27845001003",
+                "categories": [category2],
+                "location": self.make_location(18.0000000, -33.0000000),
+            },
+        ]
+        response = self.normalclient.post('/api/v1/report/batch/',
+                                          json.dumps(post_data),
+                                          content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(response.data["rejected"], 1)
+        results = response.data["results"]
+        self.assertIn("location", results[1]["errors"])
+        self.assertNotIn("id", results[1])
+
+        # Check DB
+        self.assertEqual(Report.objects.count(), 2)
+        d = Report.objects.get(id=results[0]["id"])
+        self.assertEqual(d.to_addr, '+27845001001')
+        self.assertEqual(d.project.name, 'Test Project 1')
+        self.assertEqual(d.categories.all().count(), 2)
+        self.assertEqual(d.location.point, location1)
+        self.assertEqual(d.description, 'Test incident')
+        d = Report.objects.get(id=results[2]["id"])
+        self.assertEqual(d.to_addr, '+27845001003')
+        self.assertEqual(d.categories.all().count(), 1)
+        self.assertEqual(d.description, None)
+
+    def test_create_report_batch_all_invalid(self):
+        post_data = [{"contact_key": "579ed9e9c0554eeca149d7fccd9b54e5"}]
+        response = self.normalclient.post('/api/v1/report/batch/',
+                                          json.dumps(post_data),
+                                          content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["created"], 0)
+        self.assertEqual(Report.objects.count(), 0)
+
+    @override_settings(NIGHTINGALE_INGEST_CHUNK_SIZE=2)
+    def test_create_report_stream_normalclient(self):
+        category1 = self.make_category(name="Test Cat 1", order=1)
+        report = {
+            "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+            "to_addr": "+27845001001",
+            "categories": [category1],
+            "location": self.make_location(18.0000000, -33.0000000),
+        }
+        lines = [json.dumps(report), "{not json", "",
+                 json.dumps(report), json.dumps({"to_addr": "+27845001002"})]
+        response = self.normalclient.post('/api/v1/report/stream/',
+                                          "\n".join(lines),
+                                          content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        progress = [json.loads(line.decode('utf-8')) for line in
+                    b"".join(response.streaming_content).splitlines()]
+
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(progress[0]["first_line"], 1)
+        self.assertEqual(progress[0]["last_line"], 2)
+        self.assertEqual(progress[0]["accepted"], 1)
+        self.assertEqual(progress[0]["rejected"], 1)
+        self.assertEqual(progress[0]["errors"][0]["line"], 2)
+        self.assertEqual(progress[1]["first_line"], 4)
+        self.assertEqual(progress[1]["last_line"], 5)
+        self.assertEqual(progress[1]["accepted"], 1)
+        self.assertEqual(progress[1]["errors"][0]["line"], 5)
+        self.assertEqual(progress[2], {"done": True,
+                                       "accepted": 2, "rejected": 2})
+
+        # Check DB
+        self.assertEqual(Report.objects.count(), 2)
+        d = Report.objects.last()
+        self.assertEqual(d.project.name, 'Test Project 1')
+        self.assertEqual(d.categories.all().count(), 1)
+
+    def make_report_data(self):
+        return {
+            "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+            "to_addr": "+27845001001",
+            "project": Project.objects.get(id=self.project_id),
+            "categories": [Category.objects.create(name="Test Cat 1"),
+                           Category.objects.create(name="Test Cat 2")],
+            "location": {"point": Point(18.0000000, -33.0000000)},
+            "description": "Test incident",
+        }
+
+    def test_create_report_query_count(self):
+        data = self.make_report_data()
+        # reserve location and report ids, savepoint, insert location,
+        # report and category links, release savepoint
+        with self.assertNumQueries(7):
+            report = create_report(data)
+        d = Report.objects.get(id=report.id)
+        self.assertEqual(d.categories.all().count(), 2)
+        self.assertEqual(d.location.point, Point(18.0000000, -33.0000000))
+
+        # a batch costs the same as a single report
+        with self.assertNumQueries(7):
+            reports = create_reports([data, data, data])
+        self.assertEqual(len(set(report.id for report in reports)), 3)
+        self.assertEqual(Report.objects.count(), 4)
+
+    def test_list_reports_cursor_pagination(self):
+        data = self.make_report_data()
+        created = create_reports([data, data, data])
+        response = self.adminclient.get('/api/v1/sys/reports/?page_size=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertIsNotNone(response.data["next"])
+        ids = [report["id"] for report in response.data["results"]]
+
+        # a report arriving between pages doesn't shift the next page
+        create_reports([data])
+        response = self.adminclient.get(response.data["next"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertIsNone(response.data["next"])
+        ids += [report["id"] for report in response.data["results"]]
+        self.assertEqual(sorted(ids),
+                         sorted(report.id for report in created))
+
+    def count_list_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.adminclient.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries), response.data["results"]
+
+    def test_list_reports_constant_queries(self):
+        data = self.make_report_data()
+        url = '/api/v1/sys/reports/?page_size=1000'
+        create_reports([data] * 10)
+        few, results = self.count_list_queries(url)
+        self.assertEqual(len(results), 10)
+        create_reports([data] * 990)
+        many, results = self.count_list_queries(url)
+        self.assertEqual(len(results), 1000)
+        self.assertEqual(len(results[0]["categories"]), 2)
+        self.assertEqual(few, many)
+
+    def test_list_reports_sparse_fields(self):
+        create_reports([self.make_report_data()])
+        response = self.adminclient.get(
+            '/api/v1/sys/reports/?fields=id,to_addr')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data["results"][0].keys()),
+                         set(["id", "to_addr"]))
+
+    def test_list_reports_invalid_cursor(self):
+        response = self.adminclient.get('/api/v1/sys/reports/?cursor=nope')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def make_geo_reports(self):
+        reports = {}
+        for name, x, y in (("cpt", 18.42, -33.92),
+                           ("stb", 18.86, -33.93),
+                           ("jhb", 28.04, -26.20)):
+            data = self.make_report_data()
+            data["location"] = {"point": Point(x, y)}
+            reports[name] = create_report(data)
+        return reports
+
+    def get_report_ids(self, url):
+        response = self.adminclient.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [report["id"] for report in response.data["results"]]
+
+    def test_list_reports_geo_filters(self):
+        reports = self.make_geo_reports()
+        ids = self.get_report_ids(
+            '/api/v1/sys/reports/?in_bbox=18,-34.5,19,-33')
+        self.assertEqual(sorted(ids),
+                         sorted([reports["cpt"].id, reports["stb"].id]))
+
+        # Stellenbosch is about 40km from Cape Town
+        ids = self.get_report_ids(
+            '/api/v1/sys/reports/?point=18.42,-33.92&dist=10000')
+        self.assertEqual(ids, [reports["cpt"].id])
+        ids = self.get_report_ids(
+            '/api/v1/sys/reports/?point=18.42,-33.92&dist=50000')
+        self.assertEqual(len(ids), 2)
+
+        # combined with the other filters
+        ids = self.get_report_ids(
+            '/api/v1/sys/reports/?in_bbox=18,-34.5,19,-33&category=%s' % (
+                reports["stb"].categories.all()[0].id,))
+        self.assertEqual(ids, [reports["stb"].id])
+
+    def test_list_reports_nearest(self):
+        reports = self.make_geo_reports()
+        response = self.adminclient.get(
+            '/api/v1/sys/reports/?point=28,-26&nearest=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([report["id"] for report in response.data],
+                         [reports["jhb"].id, reports["stb"].id])
+
+    def test_list_reports_geo_invalid(self):
+        for query in ('in_bbox=1,2,3', 'point=a,b&dist=10',
+                      'point=1,2&dist=-1', 'dist=10'):
+            response = self.adminclient.get('/api/v1/sys/reports/?' + query)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+    def test_list_reports_geojson(self):
+        reports = self.make_geo_reports()
+        response = self.adminclient.get(
+            '/api/v1/sys/reports/geo/?point=18.42,-33.92&dist=10000')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["type"], "FeatureCollection")
+        self.assertIsNone(response.data["next"])
+        feature, = response.data["features"]
+        self.assertEqual(feature["id"], reports["cpt"].id)
+        self.assertEqual(feature["geometry"]["coordinates"], [18.42, -33.92])
+
+    def get_clusters(self, url):
+        response = self.adminclient.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted((feature["properties"]["count"],
+                       feature["geometry"]["coordinates"])
+                      for feature in response.data["features"])
+
+    def test_report_clusters(self):
+        get_cache().clear()
+        reports = self.make_geo_reports()
+        clusters = self.get_clusters('/api/v1/sys/clusters/0/0/0/')
+        self.assertEqual([count for count, _ in clusters], [1, 2])
+        # the two Cape Town reports cluster around their centroid
+        lon, lat = clusters[1][1]
+        self.assertAlmostEqual(lon, 18.64)
+        self.assertAlmostEqual(lat, -33.925)
+
+        clusters = self.get_clusters(
+            '/api/v1/sys/clusters/0/0/0/?category=%s' % (
+                reports["jhb"].categories.all()[0].id,))
+        self.assertEqual(clusters, [(1, [28.04, -26.2])])
+
+        # tile z1 1/1 is the south eastern quarter of the world
+        self.assertEqual(
+            len(self.get_clusters('/api/v1/sys/clusters/1/1/1/')), 2)
+        self.assertEqual(self.get_clusters('/api/v1/sys/clusters/1/0/0/'), [])
+
+    def test_report_clusters_cached(self):
+        get_cache().clear()
+        self.make_geo_reports()
+        url = '/api/v1/sys/clusters/0/0/0/'
+        clusters = self.get_clusters(url)
+        self.make_geo_reports()
+        self.assertEqual(self.get_clusters(url), clusters)
+
+    def test_report_clusters_invalid_tile(self):
+        response = self.adminclient.get('/api/v1/sys/clusters/1/2/0/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_report_tile(self):
+        self.make_geo_reports()
+        x, y = point_tile(10, 18.42, -33.92)
+        url = '/api/v1/tiles/10/%s/%s.mvt' % (x, y)
+        response = self.adminclient.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"],
+                         "application/vnd.mapbox-vector-tile")
+        tile = response.content
+        self.assertTrue(tile)
+        self.assertEqual(len(os.listdir(tile_dir(10, x, y))), 1)
+
+        # served from disk until a report lands in the tile
+        response = self.adminclient.get(url)
+        self.assertEqual(response.content, tile)
+        self.make_geo_reports()
+        self.assertFalse(os.path.exists(tile_dir(10, x, y)))
+        response = self.adminclient.get(url)
+        self.assertNotEqual(response.content, tile)
+
+    def test_report_tile_forgotten(self):
+        reports = self.make_geo_reports()
+        x, y = point_tile(10, 18.42, -33.92)
+        url = '/api/v1/tiles/10/%s/%s.mvt' % (x, y)
+
+        # recategorised, from either side
+        self.adminclient.get(url)
+        category = Category.objects.create(name="Test Cat 9")
+        reports["cpt"].categories.add(category)
+        self.assertFalse(os.path.exists(tile_dir(10, x, y)))
+        self.adminclient.get(url)
+        category.report_set.clear()
+        self.assertFalse(os.path.exists(tile_dir(10, x, y)))
+
+        # deleted
+        self.adminclient.get(url)
+        reports["cpt"].delete()
+        self.assertFalse(os.path.exists(tile_dir(10, x, y)))
+
+    def test_report_tile_max_age(self):
+        self.make_geo_reports()
+        x, y = point_tile(10, 18.42, -33.92)
+        url = '/api/v1/tiles/10/%s/%s.mvt' % (x, y)
+        self.adminclient.get(url)
+        path = os.path.join(tile_dir(10, x, y),
+                            os.listdir(tile_dir(10, x, y))[0])
+        old = time.time() - 7200
+        os.utime(path, (old, old))
+        with override_settings(NIGHTINGALE_TILE_CACHE_MAX_AGE=3600):
+            self.adminclient.get(url)
+        self.assertGreater(os.path.getmtime(path), old)
+
+    def test_report_tile_contents(self):
+        reports = self.make_geo_reports()
+        x, y = point_tile(10, 18.42, -33.92)
+        response = self.adminclient.get('/api/v1/tiles/10/%s/%s.mvt' % (
+            x, y))
+        self.assertEqual(read_tile_attribute(response.content, "id"),
+                         [reports["cpt"].id])
+        # the whole world has all of them
+        response = self.adminclient.get('/api/v1/tiles/0/0/0.mvt')
+        self.assertEqual(
+            sorted(read_tile_attribute(response.content, "id")),
+            sorted(report.id for report in reports.values()))
+
+    def test_report_tile_empty(self):
+        self.make_geo_reports()
+        response = self.adminclient.get('/api/v1/tiles/10/0/0.mvt')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, b'')
+
+    def test_report_tile_denied_normaluser(self):
+        response = self.normalclient.get('/api/v1/tiles/0/0/0.mvt')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_create_report_fires_post_save_once(self):
+        calls = []
+
+        def listener(sender, instance, created, **kwargs):
+            calls.append((instance.id, created, kwargs["categories"]))
+
+        post_save.connect(listener, sender=Report)
+        try:
+            data = self.make_report_data()
+            report = create_report(data)
+        finally:
+            post_save.disconnect(listener, sender=Report)
+        self.assertEqual(calls, [(report.id, True, data["categories"])])
+
     def test_update_report_data_normalclient(self):
         category1 = self.make_category(name="Test Cat 1", order=1)
         category2 = self.make_category(name="Test Cat 2", order=1)
@@ -345,3 +845,249 @@ class TestReportsAPI(AuthenticatedAPITestCase):
             'Location: https://www.google.co.za/maps/@-33.0,18.0,13z')
         # remove to stop tearDown errors
         post_save.disconnect(fire_bounce_action, sender=Report)
+
+
+class TestIngestCommit(TransactionTestCase):
+
+    def create_report(self):
+        seen = []
+
+        def listener(sender, instance, **kwargs):
+            seen.append(connection.in_atomic_block)
+
+        post_save.connect(listener, sender=Report)
+        try:
+            create_report({
+                "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+                "to_addr": "+27845001001",
+                "project": Project.objects.create(
+                    code="TESTPROJ1", name="Test Project 1"),
+                "location": {"point": Point(18.0000000, -33.0000000)},
+            })
+        finally:
+            post_save.disconnect(listener, sender=Report)
+        return seen
+
+    @override_settings(NIGHTINGALE_OUTBOX=False)
+    def test_post_save_after_commit_without_outbox(self):
+        # tasks are published straight away, so not before the commit
+        self.assertEqual(self.create_report(), [False])
+
+    @override_settings(NIGHTINGALE_OUTBOX=True)
+    def test_post_save_in_transaction_with_outbox(self):
+        self.assertEqual(self.create_report(), [True])
+
+
+@override_settings(NIGHTINGALE_BOUNCE_SCHEDULER=True, NIGHTINGALE_OUTBOX=True)
+class TestBounceScheduler(TestCase):
+
+    def make_report(self, **category):
+        project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        return create_report({
+            "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+            "to_addr": "+27845001001",
+            "project": project,
+            "categories": [
+                Category.objects.create(name="Test Cat 1", **category)],
+            "location": {"point": Point(18.0000000, -33.0000000)},
+        })
+
+    def test_repeated_saves_collapse_into_one_bounce(self):
+        report = self.make_report()
+        pending = PendingBounce.objects.get()
+        self.assertEqual(pending.report_id, report.id)
+        self.assertTrue(pending.due_at > timezone.now())
+
+        report.save()
+        report.save()
+        self.assertEqual(PendingBounce.objects.get().due_at, pending.due_at)
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+
+        # nothing is due yet
+        self.assertEqual(sweep_bounces.apply().get(), 0)
+        self.assertEqual(PendingBounce.objects.count(), 1)
+
+    def test_description_makes_bounce_due(self):
+        report = self.make_report()
+        report.description = "Added after"
+        report.save()
+        self.assertTrue(PendingBounce.objects.get().due_at <= timezone.now())
+
+        self.assertEqual(sweep_bounces.apply().get(), 1)
+        self.assertEqual(PendingBounce.objects.count(), 0)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task, "reports.tasks.bounce_report")
+        self.assertEqual(json.loads(message.kwargs),
+                         {"report_id": report.id})
+        self.assertIsNone(message.queue)
+
+    def test_urgent_category_skips_description_wait(self):
+        self.make_report(priority="urgent")
+        pending = PendingBounce.objects.get()
+        self.assertTrue(pending.urgent)
+        self.assertTrue(pending.due_at <= timezone.now())
+
+        self.assertEqual(sweep_bounces.apply().get(), 1)
+        self.assertEqual(OutboxMessage.objects.get().queue, "urgent")
+
+    def test_category_bounce_delay(self):
+        self.make_report(bounce_delay=1)
+        pending = PendingBounce.objects.get()
+        self.assertFalse(pending.urgent)
+        wait = (pending.due_at - timezone.now()).total_seconds()
+        self.assertTrue(0 < wait <= 60)
+
+
+class TestDeliveryLatency(TestCase):
+
+    def setUp(self):
+        project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        self.snappy = Integration.objects.create(
+            project=project, integration_type="Snappy", details={},
+            active=True)
+        # no categories, so no bounce
+        self.report = create_report({
+            "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+            "to_addr": "+27845001001",
+            "project": project,
+            "location": {"point": Point(18.0000000, -33.0000000)},
+        })
+
+    def make_message(self, priority, delivered=True):
+        return Message.objects.create(
+            integration=self.snappy, report=self.report, target="SNAPPY",
+            message="Test", delivered=delivered,
+            delivered_at=timezone.now() if delivered else None,
+            metadata={"priority": priority})
+
+    def test_delivery_latency(self):
+        message = self.make_message("urgent")
+        self.make_message("normal")
+        self.make_message("normal", delivered=False)
+        start = self.report.created_at
+        urgent, normal = sorted(
+            delivery_latency(start, timezone.now()),
+            key=lambda lane: lane["lane"], reverse=True)
+        self.assertEqual((urgent["lane"], urgent["delivered"],
+                          urgent["pending"]), ("urgent", 1, 0))
+        self.assertEqual((normal["lane"], normal["delivered"],
+                          normal["pending"]), ("normal", 1, 1))
+        self.assertTrue(0 <= urgent["p50"] <= urgent["max"])
+
+        # later updates of a message don't move its delivery
+        message.metadata["note"] = "updated"
+        message.save()
+        self.assertEqual(
+            delivery_latency(start, timezone.now())[1]["max"],
+            urgent["max"])
+
+        # reports created outside the range aren't counted
+        self.assertEqual(delivery_latency(
+            datetime(2000, 1, 1, tzinfo=pytz.utc),
+            datetime(2000, 1, 2, tzinfo=pytz.utc)), [])
+
+    def test_latency_api(self):
+        self.make_message("urgent")
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_user(
+            'testnormaluser', 'testnormaluser@example.com',
+            'testnormalpass'))
+        response = client.get('/api/v1/sys/latency/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        client.force_authenticate(user=User.objects.create_superuser(
+            'testadminuser', 'testadminuser@example.com', 'testadminpass'))
+        response = client.get('/api/v1/sys/latency/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lane, = response.data["lanes"]
+        self.assertEqual((lane["lane"], lane["delivered"]), ("urgent", 1))
+
+        response = client.get('/api/v1/sys/latency/', {"start": "soon"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(NIGHTINGALE_ROLLUP_LAG=0)
+class TestReportRollups(TestCase):
+
+    def setUp(self):
+        self.project = Project.objects.create(
+            code="TESTPROJ1", name="Test Project 1")
+        self.category1 = Category.objects.create(name="Test Cat 1")
+        self.category2 = Category.objects.create(name="Test Cat 2")
+
+    def make_reports(self, count, categories):
+        return create_reports([{
+            "contact_key": "579ed9e9c0554eeca149d7fccd9b54e5",
+            "to_addr": "+27845001001",
+            "project": self.project,
+            "categories": categories,
+            "location": {"point": Point(18.0000000, -33.0000000)},
+            "description": "Test incident",
+        }] * count)
+
+    def get_counts(self):
+        return dict(((rollup.category_id, rollup.hour), rollup.count)
+                    for rollup in ReportRollup.objects.all())
+
+    def test_fold_rollups(self):
+        self.make_reports(2, [self.category1, self.category2])
+        self.make_reports(1, [self.category1])
+        fold_rollups.apply()
+        hour = Report.objects.first().created_at.replace(
+            minute=0, second=0, microsecond=0)
+        self.assertEqual(self.get_counts(), {
+            (None, hour): 3,
+            (self.category1.id, hour): 3,
+            (self.category2.id, hour): 2,
+        })
+
+        # only reports since the last fold are added
+        self.make_reports(1, [self.category2])
+        fold_rollups.apply()
+        self.assertEqual(self.get_counts(), {
+            (None, hour): 4,
+            (self.category1.id, hour): 3,
+            (self.category2.id, hour): 3,
+        })
+
+    def test_rebuild_rollups(self):
+        self.make_reports(2, [self.category1])
+        fold_rollups.apply()
+        counts = self.get_counts()
+        ReportRollup.objects.update(count=100)
+        out = StringIO()
+        call_command('rebuild_report_rollups', stdout=out)
+        self.assertEqual(self.get_counts(), counts)
+
+        # a range that misses the reports leaves their hour alone
+        ReportRollup.objects.update(count=100)
+        call_command('rebuild_report_rollups', start='2000-01-01',
+                     end='2000-01-02', stdout=out)
+        self.assertEqual(set(self.get_counts().values()), set([100]))
+
+    def test_rollup_api(self):
+        self.make_reports(2, [self.category1])
+        fold_rollups.apply()
+        admin = User.objects.create_superuser(
+            'testadminuser', 'testadminuser@example.com', 'testadminpass')
+        client = APIClient()
+        client.force_authenticate(user=admin)
+
+        response = client.get('/api/v1/sys/rollups/', {
+            "project": str(self.project.id), "interval": "day"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rollup, = response.data
+        self.assertEqual(rollup["count"], 2)
+        self.assertIsNone(rollup["category"])
+        self.assertEqual(rollup["period"],
+                         Report.objects.first().created_at.replace(
+                             hour=0, minute=0, second=0, microsecond=0))
+
+        response = client.get('/api/v1/sys/rollups/', {
+            "category": self.category2.id})
+        self.assertEqual(response.data, [])
+
+        response = client.get('/api/v1/sys/rollups/', {"interval": "week"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
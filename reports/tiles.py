@@ -0,0 +1,125 @@
+"""
+Mapbox Vector Tiles of report points, built by PostGIS with ST_AsMVT so
+points never pass through a serializer. Tiles up to
+NIGHTINGALE_TILE_CACHE_MAX_ZOOM are cached on disk under
+NIGHTINGALE_TILE_CACHE_DIR/z/x/y/<filters>.mvt, and ``forget_tiles`` drops
+every cached tile a new, deleted or recategorised report falls in. Cached
+tiles are also rebuilt once they are NIGHTINGALE_TILE_CACHE_MAX_AGE seconds
+old, for changes that aren't caught, like a report moved to another
+location.
+"""
+import errno
+import math
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from .clusters import tile_bbox, filter_key
+
+
+# half the width of the web mercator world, in metres
+MERCATOR_EXTENT = 20037508.342789244
+MERCATOR_MAX_LAT = 85.0511287798
+EXTENT = 4096
+BUFFER = 64
+
+
+def tile_envelope(z, x, y):
+    """
+    The EPSG:3857 bounds of tile ``z/x/y`` as (xmin, ymin, xmax, ymax).
+    """
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    return (-MERCATOR_EXTENT + x * size, MERCATOR_EXTENT - (y + 1) * size,
+            -MERCATOR_EXTENT + (x + 1) * size, MERCATOR_EXTENT - y * size)
+
+
+def point_tile(z, lon, lat):
+    """
+    The x, y of the tile at zoom ``z`` that has the point in it.
+    """
+    n = 2 ** z
+    lat = math.radians(max(-MERCATOR_MAX_LAT, min(MERCATOR_MAX_LAT, lat)))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi)
+            / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def render_tile(queryset, z, x, y):
+    """
+    The MVT for the reports in ``queryset`` that fall in tile ``z/x/y``,
+    one ``reports`` layer with the report id and project as attributes.
+    """
+    queryset = queryset.filter(location__point__contained=tile_bbox(z, x, y))
+    try:
+        sql, params = queryset.order_by().values_list(
+            'id', 'project_id', 'location__point').query.sql_with_params()
+    except EmptyResultSet:
+        return b''
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT ST_AsMVT(tile, 'reports', %%s, 'geom') FROM ("
+            "SELECT id, project_id::text AS project, ST_AsMVTGeom("
+            "ST_Transform(point, 3857), "
+            "ST_MakeEnvelope(%%s, %%s, %%s, %%s, 3857), %%s, %%s, true) "
+            "AS geom FROM (%s) AS reports) AS tile "
+            "WHERE geom IS NOT NULL" % (sql,),
+            # in the order the placeholders appear, the report query last
+            [EXTENT] + list(tile_envelope(z, x, y)) + [EXTENT, BUFFER] +
+            list(params))
+        tile = cursor.fetchone()[0]
+    return bytes(tile or b'')
+
+
+def tile_dir(z, x, y):
+    return os.path.join(
+        settings.NIGHTINGALE_TILE_CACHE_DIR, str(z), str(x), str(y))
+
+
+def get_tile(queryset, z, x, y, params):
+    """
+    ``render_tile`` through the disk cache, ``params`` being the filters
+    that were applied to ``queryset``.
+    """
+    if z > int(settings.NIGHTINGALE_TILE_CACHE_MAX_ZOOM):
+        return render_tile(queryset, z, x, y)
+    directory = tile_dir(z, x, y)
+    path = os.path.join(directory, '%s.mvt' % (filter_key(params),))
+    max_age = int(settings.NIGHTINGALE_TILE_CACHE_MAX_AGE)
+    try:
+        if time.time() - os.path.getmtime(path) < max_age:
+            with open(path, 'rb') as cached_tile:
+                return cached_tile.read()
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    tile = render_tile(queryset, z, x, y)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # write then rename so readers never see half a tile
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(tile)
+    os.rename(tmp_path, path)
+    return tile
+
+
+def forget_tiles(points):
+    """
+    Drop the cached tiles, at every cached zoom, that contain any of
+    ``points``.
+    """
+    tiles = set()
+    for point in points:
+        for z in range(int(settings.NIGHTINGALE_TILE_CACHE_MAX_ZOOM) + 1):
+            tiles.add((z,) + point_tile(z, point.x, point.y))
+    for z, x, y in tiles:
+        shutil.rmtree(tile_dir(z, x, y), ignore_errors=True)
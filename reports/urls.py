@@ -10,10 +10,18 @@ router.register(r'reports', views.ReportViewSet)
 
 # Wire up our API using automatic URL routing.
 urlpatterns = [
+    url(r'^sys/clusters/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)/$',
+        views.ReportClusterView.as_view()),
+    url(r'^sys/rollups/$', views.ReportRollupView.as_view()),
+    url(r'^sys/latency/$', views.ReportLatencyView.as_view()),
     url(r'^sys/', include(router.urls)),
+    url(r'^tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$',
+        views.ReportTileView.as_view()),
     url('^category/$',
         views.FilteredCategoriesList.as_view()),
     url(r'^category/(?P<pk>.+)/', views.CategoryItemViewSet.as_view()),
+    url(r'^report/batch/$', views.ReportBatchPost.as_view()),
+    url(r'^report/stream/$', views.ReportStreamPost.as_view()),
     url(r'^report/(?P<pk>.+)/', views.ReportPatch.as_view()),
     url(r'^report/', views.ReportPost.as_view()),
 
@@ -1,14 +1,41 @@
-from .models import Category, ProjectCategory, Report
-from accounts.models import UserProject
-from rest_framework import viewsets, generics, mixins
+import json
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Sum
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
+from .models import Category, ProjectCategory, Report, ReportRollup
+from accounts.cache import get_posting_project_id, get_user_project_ids
+from rest_framework import viewsets, generics, mixins, status
+from rest_framework.decorators import list_route
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.filters import DjangoFilterBackend
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.views import APIView
+from rest_framework.utils.encoders import JSONEncoder
 from .serializers import (CategorySerializer,
                           CategorySimpleSerializer,
                           ProjectCategorySerializer,
                           ProjectCategoryListSerializer,
                           ReportSerializer,
+                          ReportGeoSerializer,
+                          ReportReadSerializer,
                           ReportUserSerializer)
+from .ingest import create_reports
+from .latency import delivery_latency
+from .filters import ReportFilter, ReportGeoFilter
+from .clusters import valid_tile, get_tile_clusters
+from .tiles import get_tile
+from nightingale.pagination import CreatedCursorPagination
+from .catalog import (get_catalog_version, catalog_etag,
+                      get_project_catalog, get_category)
 
 
 class CategoryViewSet(viewsets.ModelViewSet):
@@ -39,6 +66,189 @@ class ReportViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAdminUser,)
     queryset = Report.objects.all()
     serializer_class = ReportSerializer
+    pagination_class = CreatedCursorPagination
+    filter_backends = (DjangoFilterBackend, ReportGeoFilter)
+    filter_class = ReportFilter
+
+    def get_queryset(self):
+        # location is nested and categories are listed on every report
+        return self.queryset.select_related('location') \
+            .prefetch_related('categories')
+
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return ReportReadSerializer
+        return self.serializer_class
+
+    def paginate_queryset(self, queryset):
+        # nearest results are already ordered by distance and limited
+        if ReportGeoFilter.is_nearest(self.request):
+            return None
+        return super(ReportViewSet, self).paginate_queryset(queryset)
+
+    @list_route()
+    def geo(self, request):
+        """
+        The report listing as a GeoJSON FeatureCollection, with the same
+        filters and paging.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(ReportGeoSerializer(queryset, many=True).data)
+        data = ReportGeoSerializer(page, many=True).data
+        data['next'] = self.paginator.get_next_link()
+        return Response(data)
+
+
+def report_filter_params(request):
+    return dict((name, request.query_params[name])
+                for name in ReportFilter.base_filters
+                if name in request.query_params)
+
+
+class ReportClusterView(APIView):
+
+    """
+    Report counts on a grid over web map tile z/x/y, as GeoJSON points with
+    a count. Takes the same project, category and created_at filters as
+    the report listing.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, z, x, y):
+        z, x, y = int(z), int(x), int(y)
+        if not valid_tile(z, x, y):
+            raise NotFound('Invalid tile')
+        params = report_filter_params(request)
+        queryset = ReportFilter(params, queryset=Report.objects.all()).qs
+        return Response(get_tile_clusters(queryset, z, x, y, params))
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+
+    """
+    Map clients ask for tiles by media type, errors are sent as JSON anyway.
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
+
+class ReportTileView(APIView):
+
+    """
+    Report points in web map tile z/x/y as a Mapbox Vector Tile, with the
+    same filters as the report listing.
+    """
+    permission_classes = (IsAdminUser,)
+    content_negotiation_class = IgnoreClientContentNegotiation
+
+    def get(self, request, z, x, y):
+        z, x, y = int(z), int(x), int(y)
+        if not valid_tile(z, x, y):
+            raise NotFound('Invalid tile')
+        params = report_filter_params(request)
+        queryset = ReportFilter(params, queryset=Report.objects.all()).qs
+        return HttpResponse(get_tile(queryset, z, x, y, params),
+                            content_type='application/vnd.mapbox-vector-tile')
+
+
+def get_datetime(request, param):
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+    when = parse_datetime(value)
+    if when is None:
+        raise ParseError('Invalid datetime for parameter %s' % (param,))
+    return when
+
+
+class ReportRollupView(APIView):
+
+    """
+    Report counts per hour or day from the report rollups, for a
+    ``category`` or, without one, for all reports. Filter with ``project``
+    and ``start``/``end`` ISO datetimes, ``interval`` is hour (the default)
+    or day.
+    """
+    permission_classes = (IsAdminUser,)
+    intervals = ('hour', 'day')
+
+    def get(self, request):
+        interval = request.query_params.get('interval', 'hour')
+        if interval not in self.intervals:
+            raise ParseError('interval must be one of %s' % (
+                ', '.join(self.intervals),))
+        rollups = ReportRollup.objects.all()
+        try:
+            if 'project' in request.query_params:
+                rollups = rollups.filter(
+                    project_id=uuid.UUID(request.query_params['project']))
+            category = request.query_params.get('category')
+            if category is None:
+                rollups = rollups.filter(category__isnull=True)
+            else:
+                rollups = rollups.filter(category_id=uuid.UUID(category))
+        except ValueError:
+            raise ParseError('Invalid project or category')
+        start = get_datetime(request, 'start')
+        if start is not None:
+            rollups = rollups.filter(hour__gte=start)
+        end = get_datetime(request, 'end')
+        if end is not None:
+            rollups = rollups.filter(hour__lt=end)
+        rollups = rollups.extra(
+            select={'period': "date_trunc(%s, hour)"},
+            select_params=[interval]) \
+            .values('project', 'category', 'period') \
+            .annotate(total=Sum('count')) \
+            .order_by('period', 'project')
+        return Response([{
+            "project": rollup["project"],
+            "category": rollup["category"],
+            "period": rollup["period"],
+            "count": rollup["total"],
+        } for rollup in rollups])
+
+
+class ReportLatencyView(APIView):
+
+    """
+    Seconds from report to delivered Snappy ticket per priority lane, for
+    reports created between the ``start`` and ``end`` ISO datetimes (the
+    last hour by default).
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        end = get_datetime(request, 'end') or timezone.now()
+        start = get_datetime(request, 'start') or end - timedelta(hours=1)
+        return Response({
+            "start": start,
+            "end": end,
+            "lanes": delivery_latency(start, end),
+        })
+
+
+def catalog_response(request, version, keys, load):
+    """
+    Response for a cached catalog payload, a 304 if the client's
+    If-None-Match already has the current ETag.
+    """
+    etag = catalog_etag(version, keys)
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in etags or '*' in etags:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(load())
+    response['ETag'] = quote_etag(etag)
+    response['Cache-Control'] = 'private, max-age=%s' % (
+        settings.NIGHTINGALE_CATALOG_MAX_AGE,)
+    return response
 
 
 class FilteredCategoriesList(generics.ListCreateAPIView):
@@ -46,15 +256,16 @@ class FilteredCategoriesList(generics.ListCreateAPIView):
     serializer_class = ProjectCategoryListSerializer
 
     def get_queryset(self):
-        userprojects = UserProject.objects.get(user=self.request.user)
         queryset = ProjectCategory.objects.filter(
-            project__in=userprojects.projects.all())
+            project__in=get_user_project_ids(self.request.user))
         return queryset
 
     def list(self, request):
-        queryset = self.get_queryset()
-        serializer = ProjectCategoryListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        project_ids = get_user_project_ids(request.user)
+        version = get_catalog_version()
+        return catalog_response(
+            request, version, project_ids,
+            lambda: get_project_catalog(project_ids, version))
 
 
 class CategoryItemViewSet(generics.RetrieveAPIView):
@@ -67,6 +278,12 @@ class CategoryItemViewSet(generics.RetrieveAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySimpleSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        version = get_catalog_version()
+        return catalog_response(
+            request, version, [kwargs["pk"]],
+            lambda: get_category(kwargs["pk"], version))
+
 
 class ReportPost(mixins.CreateModelMixin,  generics.GenericAPIView):
     permission_classes = (IsAuthenticated,)
@@ -74,10 +291,7 @@ class ReportPost(mixins.CreateModelMixin,  generics.GenericAPIView):
     serializer_class = ReportUserSerializer
 
     def post(self, request, *args, **kwargs):
-        # load the users project - posting users should only have one project
-        userprojects = UserProject.objects.get(user=self.request.user)
-        project = userprojects.projects.all()[0]
-        request.data["project"] = project.id
+        request.data["project"] = get_posting_project_id(self.request.user)
         return self.create(request, *args, **kwargs)
 
 
@@ -88,3 +302,133 @@ class ReportPatch(mixins.UpdateModelMixin,  generics.GenericAPIView):
 
     def patch(self, request, *args, **kwargs):
         return self.partial_update(request, *args, **kwargs)
+
+
+def validate_reports(items, project_id):
+    """
+    Validate each item with ReportUserSerializer. Returns a result per item
+    (errors for the rejected ones) and the validated data of the accepted
+    ones, each paired with its index in ``items``.
+    """
+    results = []
+    accepted = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({"index": index, "errors": {
+                "non_field_errors": ["Expected a report object."]}})
+            continue
+        # the project always comes from the posting user
+        item = dict(item)
+        item.pop("project", None)
+        serializer = ReportUserSerializer(data=item)
+        if serializer.is_valid():
+            data = dict(serializer.validated_data)
+            data["project_id"] = project_id
+            results.append({"index": index})
+            accepted.append((index, data))
+        else:
+            results.append({"index": index, "errors": serializer.errors})
+    return results, accepted
+
+
+class ReportBatchPost(generics.GenericAPIView):
+
+    """
+    API endpoint that accepts a list of reports in one request. Valid reports
+    are created in bulk, invalid ones are returned with their errors so only
+    those need to be resent.
+    """
+    permission_classes = (IsAuthenticated,)
+    queryset = Report.objects.all()
+    serializer_class = ReportUserSerializer
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response({"detail": "Expected a list of reports."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        project_id = get_posting_project_id(self.request.user)
+        results, accepted = validate_reports(request.data, project_id)
+        reports = create_reports([data for index, data in accepted])
+        for (index, data), report in zip(accepted, reports):
+            results[index]["id"] = report.id
+
+        # only fail the request outright if nothing could be created
+        if results and not accepted:
+            response_status = status.HTTP_400_BAD_REQUEST
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response({"created": len(accepted),
+                         "rejected": len(results) - len(accepted),
+                         "results": results},
+                        status=response_status)
+
+
+def line_chunks(lines, size):
+    """
+    Group the non-blank lines of ``lines`` into lists of at most ``size``
+    (line number, line) pairs. Lines are only pulled as chunks are needed.
+    """
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        chunk.append((number, line))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ReportStreamPost(APIView):
+
+    """
+    API endpoint that accepts newline delimited JSON reports. The body is read
+    and committed a chunk at a time and a line of JSON is streamed back for
+    each committed chunk, so an interrupted upload can be resumed from the
+    line after ``last_line`` of the last progress line received.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        project_id = get_posting_project_id(self.request.user)
+        lines = request.stream if request.stream is not None else []
+        progress = self.ingest(lines, project_id,
+                               int(settings.NIGHTINGALE_INGEST_CHUNK_SIZE))
+        return StreamingHttpResponse(progress,
+                                     content_type='application/x-ndjson')
+
+    def ingest(self, lines, project_id, chunk_size):
+        accepted_total = 0
+        rejected_total = 0
+        for chunk_number, chunk in enumerate(
+                line_chunks(lines, chunk_size), 1):
+            errors = []
+            items = []
+            for number, line in chunk:
+                try:
+                    items.append((number, json.loads(line.decode('utf-8'))))
+                except ValueError:
+                    errors.append({"line": number, "errors": {
+                        "non_field_errors": ["Invalid JSON."]}})
+            results, accepted = validate_reports(
+                [item for number, item in items], project_id)
+            create_reports([data for index, data in accepted])
+            for result in results:
+                if "errors" in result:
+                    errors.append({"line": items[result["index"]][0],
+                                   "errors": result["errors"]})
+            accepted_total += len(accepted)
+            rejected_total += len(errors)
+            yield json.dumps({
+                "chunk": chunk_number,
+                "first_line": chunk[0][0],
+                "last_line": chunk[-1][0],
+                "accepted": len(accepted),
+                "rejected": len(errors),
+                "errors": sorted(errors, key=lambda error: error["line"]),
+            }, cls=JSONEncoder) + "\n"
+        yield json.dumps({"done": True,
+                          "accepted": accepted_total,
+                          "rejected": rejected_total}) + "\n"
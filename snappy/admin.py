@@ -1,5 +1,7 @@
 from django.contrib import admin
 
-from .models import Message
+from .models import Message, InboxEvent, ProcessedEvent
 
 admin.site.register(Message)
+admin.site.register(InboxEvent)
+admin.site.register(ProcessedEvent)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snappy', '0005_processedevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='claimed_until',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        # the delivery engine claims from the undelivered messages only
+        migrations.RunSQL(
+            "CREATE INDEX snappy_message_undelivered "
+            "ON snappy_message (id) WHERE NOT delivered;",
+            "DROP INDEX snappy_message_undelivered;"),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snappy', '0007_message_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='delivered_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        # the best guess for messages delivered before it was recorded
+        migrations.RunSQL(
+            "UPDATE snappy_message SET delivered_at = updated_at "
+            "WHERE delivered;",
+            migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snappy', '0008_message_delivered_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboxevent',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='inboxevent',
+            name='last_error',
+            field=models.TextField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='inboxevent',
+            name='due_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, null=True, blank=True, db_index=True),
+        ),
+    ]
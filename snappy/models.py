@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.contrib.postgres.fields import HStoreField
 from django.db import models
+from django.utils import timezone
 from accounts.models import Integration
 from reports.models import Report
 
@@ -33,6 +35,15 @@ class Message(models.Model):
     :param dict metadata:
         A hstore field for semi-structured message information like nonce/mID
 
+    :param datetime claimed_until:
+        Set while the delivery engine is sending the message
+
+    :param int attempts:
+        Failed delivery engine sends, for its backoff
+
+    :param datetime delivered_at:
+        When the message was delivered
+
     """
     TARGET = (
         ('VUMI', 'Vumi'),
@@ -53,19 +64,79 @@ class Message(models.Model):
     to_addr = models.CharField(max_length=255, null=True, blank=True)
     delivered = models.BooleanField(default=False)
     metadata = HStoreField(null=True, blank=True, default={})
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    delivered_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # keyset pagination for the admin listing
+        index_together = [('created_at', 'id')]
+
     def __str__(self):
         return "%s to %s" % (self.message, self.target)
 
+
+class InboxEvent(models.Model):
+
+    """
+    Snappy webhook event stored as received, waiting for
+    snappy.tasks.process_webhook_inbox
+
+    :param str event:
+        Snappy event name, e.g. message.outgoing
+
+    :param str data:
+        The event's JSON encoded data
+
+    :param int attempts:
+        Failed tries at handling the event
+
+    :param str last_error:
+        What the last failed try raised
+
+    :param datetime due_at:
+        When the event is next tried, None once it has been given up on
+    """
+    event = models.CharField(max_length=50)
+    data = models.TextField()
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    due_at = models.DateTimeField(null=True, blank=True, db_index=True,
+                                  default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "%s received at %s" % (self.event, self.created_at)
+
+
+class ProcessedEvent(models.Model):
+
+    """
+    Snappy webhook event that has been handled, so redeliveries can be
+    ignored. Purged after NIGHTINGALE_SNAPPY_EVENT_TTL.
+
+    :param str key:
+        Identifies the event, see snappy.webhooks.event_key
+    """
+    key = models.CharField(max_length=255, unique=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return "%s processed at %s" % (self.key, self.created_at)
+
 # Make sure new messages are sent
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from outbox.dispatch import enqueue
+from outbox.routing import message_queue
 from .tasks import send_message
 
 
 @receiver(post_save, sender=Message)
 def fire_msg_action_if_undelivered(sender, instance, created, **kwargs):
-    if not instance.delivered:
-        send_message.delay(str(instance.id))
+    # the delivery engine picks undelivered messages up itself
+    if not instance.delivered and not settings.NIGHTINGALE_DELIVERY_ENGINE:
+        enqueue(send_message, {"message_id": str(instance.id)},
+                queue=message_queue(instance))
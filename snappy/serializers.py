@@ -1,5 +1,6 @@
 from rest_framework import serializers
 
+from nightingale.serializers import SparseFieldsMixin
 from .models import Message
 
 
@@ -12,6 +13,12 @@ class MessageSerializer(serializers.HyperlinkedModelSerializer):
                   'delivered', 'metadata')
 
 
+class MessageReadSerializer(SparseFieldsMixin, MessageSerializer):
+    """
+        Used for listing and retrieving messages, supports ?fields=
+    """
+
+
 class InboundMessageSerializer(serializers.ModelSerializer):
     """
         Only used for posting from normal users to the default snappy
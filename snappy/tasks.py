@@ -1,13 +1,24 @@
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
 from go_http.send import HttpApiSender
 from besnappy import SnappyApiSender
-import requests
 import json
-from requests.exceptions import HTTPError
-from .models import Message
+from functools import partial
+from requests.exceptions import HTTPError, ConnectionError, Timeout
+from .models import Message, InboxEvent, ProcessedEvent
+from .webhooks import event_key, claim_event, handle_event
+from accounts.registry import registry
+from accounts.http import sessions
+from accounts.ratelimit import limiter, RateLimited
+from accounts.breaker import breakers
+from delivery.policy import retry_delay, dead_letter, backoff
+from outbox.routing import message_queue
 
 try:
     from HTMLParser import HTMLParser
@@ -42,12 +53,23 @@ def strip_tags(html):
     return s.get_data()
 
 
+def park_message(message):
+    """
+    Hold a message back while its integration's breaker is open, for
+    delivery.tasks.release_parked (or the delivery engine) to pick up
+    """
+    Message.objects.filter(pk=message.pk).update(
+        claimed_until=breakers.parked_until(message.integration_id))
+
+
 class Send_Message(Task):
 
     """
     Task to load and contruct message and send them off
     """
     name = "snappy.tasks.send_message"
+    # delivery.policy decides when to give up
+    max_retries = None
 
     class FailedEventRequest(Exception):
 
@@ -56,20 +78,41 @@ class Send_Message(Task):
         code.
         """
 
-    def vumi_client(self, vumisettings):
+    def vumi_client(self, vumisettings, session=None):
         return HttpApiSender(
             api_url=vumisettings["vumi_api_url"],
             account_key=vumisettings["vumi_account_key"],
             conversation_key=vumisettings["vumi_conversation_key"],
-            conversation_token=vumisettings["vumi_conversation_token"]
+            conversation_token=vumisettings["vumi_conversation_token"],
+            session=session
         )
 
-    def snappy_client(self, snappysettings):
+    def snappy_client(self, snappysettings, session=None):
         return SnappyApiSender(
             api_key=snappysettings["snappy_api_key"],
-            api_url=snappysettings["snappy_api_url"]
+            api_url=snappysettings["snappy_api_url"],
+            session=session
         )
 
+    def failed(self, message, exc):
+        """
+        Record a failed send with the integration's breaker. Parks the
+        message if that opened it, otherwise retries outages with backoff
+        and dead letters the rest.
+        """
+        if breakers.record(message.integration_id, exc):
+            logger.warning("Breaker open for integration %s, parking message"
+                           " %s" % (message.integration_id, message.id))
+            park_message(message)
+            return
+        attempts = self.request.retries + 1
+        delay = retry_delay(exc, attempts)
+        if delay is not None:
+            raise self.retry(exc=exc, countdown=delay)
+        logger.error("Giving up on message %s" % message.id, exc_info=True)
+        dead_letter("message", self, {"message_id": message.id}, exc,
+                    attempts, object_id=message.id)
+
     def run(self, message_id, **kwargs):
         """
         Load and contruct message and send them off
@@ -80,9 +123,27 @@ class Send_Message(Task):
         try:
             message = Message.objects.get(pk=message_id)
             if message.delivered is False:  # Don't attempt to redeliver
-                integration = message.integration.details
+                integration_model = registry.get(message.integration_id) or \
+                    message.integration
+                integration = integration_model.details
+                session = sessions.get(message.integration_id)
+                if not breakers.allow(message.integration_id):
+                    # the integration is down, don't tie up a worker on it
+                    park_message(message)
+                    return
+                try:
+                    limiter.acquire(message.integration_id, integration)
+                except RateLimited as e:
+                    # come back when a token is due rather than spend a retry
+                    l.info("Rate limited, sending in %.1fs" % e.wait)
+                    self.apply_async(kwargs={"message_id": message_id},
+                                     countdown=e.wait,
+                                     queue=message_queue(message))
+                    return
                 if message.target == "VUMI":
-                    vumiapi = self.vumi_client(integration)
+                    vumiapi = registry.sender(
+                        integration_model,
+                        partial(self.vumi_client, session=session))
                     try:
                             # Plain content
                         vumiresponse = vumiapi.send_text(
@@ -92,17 +153,16 @@ class Send_Message(Task):
                         message.metadata["vumi_message_id"] = \
                             vumiresponse["message_id"]
                         message.delivered = True
+                        message.delivered_at = timezone.now()
                         message.save()
-                    except HTTPError as e:
-                        # retry message sending if in 500 range (3 default
-                        # retries)
-                        if 500 < e.response.status_code < 599:
-                            raise self.retry(exc=e)
-                        else:
-                            raise e
+                        breakers.record(message.integration_id)
+                    except (HTTPError, ConnectionError, Timeout) as e:
+                        return self.failed(message, e)
                     return vumiresponse
                 else:
-                    snappyapi = self.snappy_client(integration)
+                    snappyapi = registry.sender(
+                        integration_model,
+                        partial(self.snappy_client, session=session))
                     try:
                         report = message.report
                         # from_email should be "user+%s@domain.org"
@@ -123,10 +183,16 @@ class Send_Message(Task):
                             # Add tags
                             categories = report.categories.all()
                             tags = list(cat.name for cat in categories)
-                            add_tags.delay(integration, snappy_ticket, tags)
+                            add_tags.delay(
+                                integration, snappy_ticket, tags,
+                                integration_id=str(message.integration_id))
                             # Log the snappy ticket on the report
                             report.metadata["snappy_nonce"] = snappy_ticket
-                            report.save()  # save the upstream report
+                            report.snappy_nonce = snappy_ticket
+                            # save the upstream report, leaving
+                            # snappy_replies to the webhook's increments
+                            report.save(update_fields=[
+                                'metadata', 'snappy_nonce', 'updated_at'])
                         else:
                             # this is a reply to an open ticket
                             subject = "Update from %s" % (message.from_addr)
@@ -141,14 +207,11 @@ class Send_Message(Task):
                                      "address": from_addr}]
                             )
                         message.delivered = True
+                        message.delivered_at = timezone.now()
                         message.save()  # save the message
-                    except HTTPError as e:
-                        # retry message sending if in 500 range (3 default
-                        # retries)
-                        if 500 < e.response.status_code < 599:
-                            raise self.retry(exc=e)
-                        else:
-                            raise e
+                        breakers.record(message.integration_id)
+                    except (HTTPError, ConnectionError, Timeout) as e:
+                        return self.failed(message, e)
         except ObjectDoesNotExist:
             logger.error('Missing Message object', exc_info=True)
 
@@ -161,12 +224,29 @@ class Send_Message(Task):
 send_message = Send_Message()
 
 
+def post_tags(session, snappysettings, snappynonce, tags):
+    """
+    Tag a Snappy ticket, returns Snappy's response text ("OK")
+    """
+    url = "%s/ticket/%s/tags" % (
+        snappysettings["snappy_api_url"], snappynonce)
+    data = json.dumps({"tags": tags})
+    headers = {'content-type': 'application/json; charset=utf-8'}
+    auth = (snappysettings["snappy_api_key"], 'x')
+    result = session.post(
+        url, auth=auth, data=data, headers=headers, verify=False)
+    result.raise_for_status()
+    return result.text
+
+
 class Add_Tags(Task):
 
     """
     Task to add tags to tickets in Snappy
     """
     name = "snappy.tasks.add_tags"
+    # delivery.policy decides when to give up
+    max_retries = None
 
     class FailedEventRequest(Exception):
 
@@ -181,30 +261,47 @@ class Add_Tags(Task):
             api_url=snappysettings["snappy_api_url"]
         )
 
-    def run(self, snappysettings, snappynonce, tags, **kwargs):
+    def run(self, snappysettings, snappynonce, tags, integration_id=None,
+            **kwargs):
         """
         Load and contruct message and send them off
         """
         l = self.get_logger(**kwargs)
 
         l.info("Adding tags")
+        again = {"snappysettings": snappysettings, "snappynonce": snappynonce,
+                 "tags": tags, "integration_id": integration_id}
+        if integration_id is not None and not breakers.allow(integration_id):
+            # the integration is down, come back once it may be up again
+            self.apply_async(kwargs=again,
+                             eta=breakers.parked_until(integration_id))
+            return
+        try:
+            limiter.acquire(integration_id, snappysettings)
+        except RateLimited as e:
+            # come back when a token is due rather than spend a retry
+            l.info("Rate limited, tagging in %.1fs" % e.wait)
+            self.apply_async(kwargs=again, countdown=e.wait)
+            return
         try:
-            url = "%s/ticket/%s/tags" % (
-                snappysettings["snappy_api_url"], snappynonce)
-            data = json.dumps({"tags": tags})
-            headers = {'content-type': 'application/json; charset=utf-8'}
-            auth = (snappysettings["snappy_api_key"], 'x')
-            result = requests.post(url, auth=auth, data=data,
-                                   headers=headers, verify=False)
-            result.raise_for_status()
-            return result.text  # should be "OK"
-        except HTTPError as e:
-            # retry message sending if in 500 range (3 default
-            # retries)
-            if 500 < e.response.status_code < 599:
-                raise self.retry(exc=e)
-            else:
-                raise e
+            result = post_tags(sessions.get(integration_id), snappysettings,
+                               snappynonce, tags)
+            if integration_id is not None:
+                breakers.record(integration_id)
+            return result
+        except (HTTPError, ConnectionError, Timeout) as e:
+            if integration_id is not None and \
+                    breakers.record(integration_id, e):
+                self.apply_async(kwargs=again,
+                                 eta=breakers.parked_until(integration_id))
+                return
+            attempts = self.request.retries + 1
+            delay = retry_delay(e, attempts)
+            if delay is not None:
+                raise self.retry(exc=e, countdown=delay)
+            logger.error("Giving up on tagging %s" % snappynonce,
+                         exc_info=True)
+            dead_letter("tags", self, again, e, attempts)
 
         except SoftTimeLimitExceeded:
             logger.error(
@@ -213,3 +310,104 @@ class Add_Tags(Task):
                 exc_info=True)
 
 add_tags = Add_Tags()
+
+
+class Process_Webhook_Inbox(Task):
+
+    """
+    Task to handle the webhook events stored in the inbox
+    """
+    name = "snappy.tasks.process_webhook_inbox"
+
+    def run(self, **kwargs):
+        """
+        Handle the due inbox events a batch at a time, oldest first, and
+        return how many were removed. Redeliveries of an event handled
+        before are dropped without being handled again. Each event is
+        claimed, handled and removed in a transaction of its own, so what it
+        sends isn't published long before it commits.
+
+        An event that fails is kept and tried again with backoff, the way
+        Snappy retries a webhook answered with an error. After
+        NIGHTINGALE_RETRY_ATTEMPTS failed tries it is given up on and left
+        in the inbox, with its last error, to be looked at.
+        """
+        l = self.get_logger(**kwargs)
+
+        batch_size = int(settings.NIGHTINGALE_SNAPPY_INBOX_BATCH_SIZE)
+        # events retried later in this run aren't picked up again
+        now = timezone.now()
+        processed = 0
+        while True:
+            due = list(InboxEvent.objects.filter(due_at__lte=now)
+                       .order_by('id')
+                       .values_list('id', flat=True)[:batch_size])
+            for inbox_event_id in due:
+                if self.process(inbox_event_id, now):
+                    processed += 1
+            if len(due) < batch_size:
+                break
+        l.info("Processed %s webhook events" % processed)
+        return processed
+
+    def process(self, inbox_event_id, now):
+        """
+        Handle an inbox event, or drop it as a redelivery, and remove it.
+        Returns False if it was left in the inbox.
+        """
+        with transaction.atomic():
+            inbox_event = InboxEvent.objects.select_for_update() \
+                .filter(id=inbox_event_id, due_at__lte=now).first()
+            if inbox_event is None:
+                # handled by another worker meanwhile
+                return False
+            try:
+                # claimed with the handling, so a failure leaves it unclaimed
+                with transaction.atomic():
+                    event = inbox_event.event
+                    data = json.loads(inbox_event.data)
+                    key = event_key(event, data)
+                    if key is None or claim_event(key):
+                        handle_event(event, data)
+            except Exception as e:
+                self.failed(inbox_event, e)
+                return False
+            inbox_event.delete()
+            return True
+
+    def failed(self, inbox_event, exc):
+        inbox_event.attempts += 1
+        inbox_event.last_error = "%s: %s" % (type(exc).__name__, exc)
+        if inbox_event.attempts >= int(settings.NIGHTINGALE_RETRY_ATTEMPTS):
+            logger.error('Giving up on inbox event %s' % (inbox_event.id,),
+                         exc_info=True)
+            inbox_event.due_at = None
+        else:
+            logger.error('Failed handling inbox event %s' % (
+                inbox_event.id,), exc_info=True)
+            inbox_event.due_at = timezone.now() + timedelta(
+                seconds=backoff(inbox_event.attempts - 1))
+        inbox_event.save(update_fields=['attempts', 'last_error', 'due_at'])
+
+process_webhook_inbox = Process_Webhook_Inbox()
+
+
+class Purge_Processed_Events(Task):
+
+    """
+    Task to forget webhook events old enough that Snappy won't redeliver them
+    """
+    name = "snappy.tasks.purge_processed_events"
+
+    def run(self, **kwargs):
+        l = self.get_logger(**kwargs)
+
+        cutoff = timezone.now() - timedelta(
+            seconds=int(settings.NIGHTINGALE_SNAPPY_EVENT_TTL))
+        purged = ProcessedEvent.objects.filter(created_at__lt=cutoff)
+        count = purged.count()
+        purged.delete()
+        l.info("Purged %s processed webhook events" % count)
+        return count
+
+purge_processed_events = Purge_Processed_Events()
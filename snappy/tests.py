@@ -1,15 +1,22 @@
 import json
 import responses
 from django.contrib.auth.models import User
-from django.test import TestCase
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.db.models import F
 from django.db.models.signals import post_save
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
 from reports.models import Report
+from delivery.models import DeadLetter
 from accounts.models import Project, UserProject
-from .models import Message, fire_msg_action_if_undelivered
+from .models import (Message, InboxEvent, ProcessedEvent,
+                     fire_msg_action_if_undelivered)
+from .tasks import (process_webhook_inbox, purge_processed_events,
+                    send_message)
 
 
 class APITestCase(TestCase):
@@ -201,6 +208,7 @@ class TestMessagesAPI(AuthenticatedAPITestCase):
 
         d = Message.objects.last()
         self.assertEqual(d.report.metadata["snappy_nonce"], 'nonce')
+        self.assertEqual(d.report.snappy_nonce, 'nonce')
         self.assertEqual(len(responses.calls), 2)
         # remove to stop tearDown errors
         post_save.disconnect(fire_msg_action_if_undelivered, sender=Message)
@@ -252,6 +260,7 @@ class TestMessagesAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.message, 'This is a reply\n')
         self.assertEqual(d.target, 'VUMI')
         self.assertEqual(d.to_addr, '+27845001001')
+        self.assertEqual(d.report.snappy_replies, 1)
 
     @responses.activate
     def test_create_message_reply_fire_task(self):
@@ -280,8 +289,167 @@ class TestMessagesAPI(AuthenticatedAPITestCase):
 
         d = Message.objects.last()
         self.assertEqual(d.delivered, True)
+        self.assertIsNotNone(d.delivered_at)
         # not updated to nonce2 because update
         self.assertEqual(d.report.metadata["snappy_nonce"], 'nonce')
         self.assertEqual(len(responses.calls), 1)
         # remove to stop tearDown errors
         post_save.disconnect(fire_msg_action_if_undelivered, sender=Message)
+
+    @override_settings(NIGHTINGALE_SNAPPY_WEBHOOK_INBOX=True)
+    def test_webhook_inbox(self):
+        Report.objects.filter(id=self.report_id).update(snappy_nonce="nonce")
+        data = {"note": {"content": "This is a reply\n",
+                         "ticket": {"nonce": "nonce"}}}
+        response = self.adminclient.post(
+            '/api/v1/snappywebhook/',
+            {"event": "message.outgoing", "data": json.dumps(data)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # only stored until the inbox is processed
+        self.assertEqual(InboxEvent.objects.count(), 1)
+        self.assertEqual(Message.objects.count(), 0)
+
+        # a broken event doesn't hold up the rest, and is kept to retry
+        InboxEvent.objects.create(event="message.outgoing", data="{")
+        self.assertEqual(process_webhook_inbox.apply().get(), 1)
+        d = Message.objects.get()
+        self.assertEqual(d.message, 'This is a reply\n')
+        self.assertEqual(d.target, 'VUMI')
+        self.assertEqual(d.report.snappy_replies, 1)
+        broken = InboxEvent.objects.get()
+        self.assertEqual(broken.attempts, 1)
+        self.assertTrue(broken.last_error.startswith("ValueError"))
+        self.assertGreaterEqual(broken.due_at, d.created_at)
+
+        # not tried again until due, then given up on
+        self.assertEqual(process_webhook_inbox.apply().get(), 0)
+        self.assertEqual(InboxEvent.objects.get().attempts, 1)
+        with self.settings(NIGHTINGALE_RETRY_ATTEMPTS=2):
+            InboxEvent.objects.update(due_at=timezone.now())
+            self.assertEqual(process_webhook_inbox.apply().get(), 0)
+        broken = InboxEvent.objects.get()
+        self.assertEqual(broken.attempts, 2)
+        self.assertIsNone(broken.due_at)
+
+    @override_settings(NIGHTINGALE_SNAPPY_WEBHOOK_INBOX=True)
+    def test_webhook_inbox_redelivery(self):
+        Report.objects.filter(id=self.report_id).update(snappy_nonce="nonce")
+        data = {"note": {"id": 101, "content": "This is a reply\n",
+                         "ticket": {"nonce": "nonce"}}}
+        for _ in range(2):
+            response = self.adminclient.post(
+                '/api/v1/snappywebhook/',
+                {"event": "message.outgoing", "data": json.dumps(data)})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # not claimed until handled
+        self.assertEqual(InboxEvent.objects.count(), 2)
+        self.assertEqual(ProcessedEvent.objects.count(), 0)
+
+        # a failed handling leaves the event to be handled on redelivery
+        def fail(sender, instance, **kwargs):
+            raise ValueError("boom")
+        post_save.connect(fail, sender=Message)
+        try:
+            self.assertEqual(process_webhook_inbox.apply().get(), 0)
+        finally:
+            post_save.disconnect(fail, sender=Message)
+        self.assertEqual(InboxEvent.objects.filter(attempts=1).count(), 2)
+        self.assertEqual(ProcessedEvent.objects.count(), 0)
+        self.assertEqual(Message.objects.count(), 0)
+
+        InboxEvent.objects.update(due_at=timezone.now())
+        self.assertEqual(process_webhook_inbox.apply().get(), 2)
+        self.assertEqual(InboxEvent.objects.count(), 0)
+        self.assertEqual(ProcessedEvent.objects.count(), 1)
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(Report.objects.get(
+            id=self.report_id).snappy_replies, 1)
+
+    def test_webhook_redelivery(self):
+        Report.objects.filter(id=self.report_id).update(snappy_nonce="nonce")
+        data = {"note": {"id": 101, "content": "This is a reply\n",
+                         "ticket": {"nonce": "nonce"}}}
+        for _ in range(2):
+            response = self.adminclient.post(
+                '/api/v1/snappywebhook/',
+                {"event": "message.outgoing", "data": json.dumps(data)})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(Report.objects.get(
+            id=self.report_id).snappy_replies, 1)
+
+        # forgotten once old enough
+        self.assertEqual(purge_processed_events.apply().get(), 0)
+        ProcessedEvent.objects.update(
+            created_at=timezone.now() - timedelta(days=8))
+        self.assertEqual(purge_processed_events.apply().get(), 1)
+
+    @responses.activate
+    def test_new_ticket_keeps_concurrent_replies(self):
+        def create_note(request):
+            # a reply counted by the webhook while the ticket is opened
+            Report.objects.filter(id=self.report_id).update(
+                snappy_replies=F('snappy_replies') + 1)
+            return (200, {}, "nonce")
+
+        responses.add_callback(responses.POST,
+                               "https://app.besnappy.com/api/v1/note",
+                               callback=create_note)
+        responses.add(responses.POST,
+                      "https://app.besnappy.com/api/v1/ticket/nonce/tags",
+                      body="OK", status=200)
+        message = Message.objects.create(
+            integration_id=self.snappy_id, report_id=self.report_id,
+            target="SNAPPY", message="This is a test",
+            from_addr="+27845001001")
+        send_message.apply(kwargs={"message_id": message.id})
+        report = Report.objects.get(id=self.report_id)
+        self.assertEqual(report.snappy_nonce, "nonce")
+        self.assertEqual(report.snappy_replies, 1)
+
+    @responses.activate
+    @override_settings(NIGHTINGALE_BREAKER_THRESHOLD=1)
+    def test_breaker_parks_message(self):
+        responses.add(responses.POST,
+                      "https://app.besnappy.com/api/v1/note",
+                      body="Service Unavailable", status=503)
+        message = Message.objects.create(
+            integration_id=self.snappy_id, report_id=self.report_id,
+            target="SNAPPY", message="This is a test",
+            from_addr="+27845001001")
+
+        # the failure opens the breaker, so the message is parked rather
+        # than retried
+        send_message.apply(kwargs={"message_id": message.id})
+        self.assertEqual(len(responses.calls), 1)
+        message = Message.objects.get(pk=message.pk)
+        self.assertFalse(message.delivered)
+        self.assertGreater(message.claimed_until, timezone.now())
+
+        # and stays parked without calling Snappy while it's open
+        Message.objects.filter(pk=message.pk).update(claimed_until=None)
+        send_message.apply(kwargs={"message_id": message.id})
+        self.assertEqual(len(responses.calls), 1)
+        self.assertIsNotNone(Message.objects.get(pk=message.pk).claimed_until)
+
+    @responses.activate
+    @override_settings(NIGHTINGALE_RETRY_ATTEMPTS=2)
+    def test_send_message_dead_letters(self):
+        responses.add(responses.POST,
+                      "https://app.besnappy.com/api/v1/note",
+                      body="Internal Server Error", status=500)
+        message = Message.objects.create(
+            integration_id=self.snappy_id, report_id=self.report_id,
+            target="SNAPPY", message="This is a test",
+            from_addr="+27845001001")
+
+        # a plain 500 is retried, then given up on
+        send_message.apply(kwargs={"message_id": message.id})
+        self.assertEqual(len(responses.calls), 2)
+        dead = DeadLetter.objects.get()
+        self.assertEqual(dead.kind, "message")
+        self.assertEqual(dead.object_id, message.id)
+        self.assertEqual(dead.task, "snappy.tasks.send_message")
+        self.assertEqual(dead.status_code, 500)
+        self.assertEqual(dead.attempts, 2)
+        self.assertFalse(Message.objects.get(pk=message.pk).delivered)
@@ -1,13 +1,17 @@
 import json
-from .models import Message
-from reports.models import Report
-from accounts.models import UserProject, Integration
+from django.conf import settings
+from django.db import transaction
+from .models import Message, InboxEvent
+from .webhooks import ALLOWED_EVENTS, event_key, claim_event, handle_event
+from accounts.cache import get_posting_project_id, get_integration_id
 from rest_framework import viewsets, generics, mixins
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.views import APIView
 from .serializers import (MessageSerializer,
+                          MessageReadSerializer,
                           InboundMessageSerializer)
+from nightingale.pagination import CreatedCursorPagination
 
 
 class MessageViewSet(viewsets.ModelViewSet):
@@ -18,6 +22,14 @@ class MessageViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAdminUser,)
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
+    pagination_class = CreatedCursorPagination
+
+    def get_serializer_class(self):
+        # integration and report are hyperlinked from their ids so listing
+        # needs no joins
+        if self.request.method == 'GET':
+            return MessageReadSerializer
+        return self.serializer_class
 
 
 class SnappyMessagePost(mixins.CreateModelMixin, generics.GenericAPIView):
@@ -26,13 +38,9 @@ class SnappyMessagePost(mixins.CreateModelMixin, generics.GenericAPIView):
     serializer_class = InboundMessageSerializer
 
     def post(self, request, *args, **kwargs):
-        # load the users project - posting users should only have one project
-        userprojects = UserProject.objects.get(user=self.request.user)
-        project = userprojects.projects.all()[0]
+        project_id = get_posting_project_id(self.request.user)
         # load the snappy integration - should only be one per project
-        integration = Integration.objects.get(project=project,
-                                              integration_type='Snappy')
-        request.data["integration"] = integration.id
+        request.data["integration"] = get_integration_id(project_id, 'Snappy')
         request.data["target"] = "SNAPPY"
         return self.create(request, *args, **kwargs)
 
@@ -46,46 +54,28 @@ class SnappyWebhookListener(APIView):
 
     def post(self, request, *args, **kwargs):
         """
-        Validates webhook data before creating Outbound message
+        Validates webhook data before creating Outbound message. With
+        NIGHTINGALE_SNAPPY_WEBHOOK_INBOX on the event is only stored, for
+        snappy.tasks.process_webhook_inbox to handle, which skips the ones
+        seen before. Otherwise events seen before are accepted without doing
+        anything.
         """
-        allowed_events = ['message.outgoing']
         # Look up action first
         event = request.data["event"]
-        if event in allowed_events:
-            if event == "message.outgoing":
-                data = json.loads(request.data["data"])
-                # create Vumi bound message if we can find related inbound
-                nonce = data["note"]["ticket"]["nonce"]
-                # should only be one with this nonce, but lets be liberal
-                reports = Report.objects.filter(
-                    metadata__contains={"snappy_nonce": nonce})
-                if reports.count() > 0:
-                    report = reports[0]  # if more than one, just use 1st
-                    active_vumi = report.project.integrations.filter(
-                        integration_type='Vumi', active=True)
-                    message = Message()
-                    message.integration = active_vumi[0]
-                    message.report = report
-                    message.target = "VUMI"
-                    message.message = data["note"]["content"]
-                    message.contact_key = report.contact_key
-                    message.to_addr = report.to_addr
-                    message.save()
-                    # increment the replies
-                    if "snappy_replies" in report.metadata:
-                        report.metadata["snappy_replies"] = str(int(
-                            report.metadata["snappy_replies"]) + 1)
-                    else:
-                        report.metadata["snappy_replies"] = "1"
-                    report.save()
-                    # Return
-                    status = 200
-                    accepted = {"accepted": True}
-                else:
-                    # Accept it to stop Snappy retries but do nothing ATM
-                    # TODO: log failure of match
-                    status = 200
-                    accepted = {"accepted": True}
+        if event in ALLOWED_EVENTS:
+            raw = request.data["data"]
+            data = json.loads(raw)
+            if settings.NIGHTINGALE_SNAPPY_WEBHOOK_INBOX:
+                InboxEvent.objects.create(event=event, data=raw)
+            else:
+                key = event_key(event, data)
+                with transaction.atomic():
+                    # redeliveries of an event we already have are skipped
+                    if key is None or claim_event(key):
+                        handle_event(event, data)
+            # Accept unmatched replies too, to stop Snappy retries
+            status = 200
+            accepted = {"accepted": True}
         else:
             # not a hook we listen to at the moment
             status = 400
@@ -0,0 +1,77 @@
+"""
+Handling of Snappy webhook events, shared by the webhook view and the
+inbox task that processes events the view has only stored. Snappy redelivers
+events it thinks we missed, so each event is claimed in ProcessedEvent
+before anything is done with it.
+"""
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from accounts.cache import get_active_integration_ids
+from reports.models import Report
+from .models import Message
+
+
+ALLOWED_EVENTS = ['message.outgoing']
+
+
+def handle_message_outgoing(data):
+    """
+    Send a Snappy reply on to the reporter through Vumi. Returns whether
+    the reply matched a report.
+    """
+    # create Vumi bound message if we can find related inbound
+    nonce = data["note"]["ticket"]["nonce"]
+    # should only be one with this nonce, but lets be liberal
+    report = Report.objects.filter(snappy_nonce=nonce).first()
+    if report is None:
+        # TODO: log failure of match
+        return False
+    message = Message()
+    message.integration_id = get_active_integration_ids(
+        report.project_id, 'Vumi')[0]
+    message.report = report
+    message.target = "VUMI"
+    message.message = data["note"]["content"]
+    message.contact_key = report.contact_key
+    message.to_addr = report.to_addr
+    message.save()
+    # increment the replies in the database so concurrent
+    # webhooks don't lose counts or re-fire the bounce
+    Report.objects.filter(pk=report.pk).update(
+        snappy_replies=F('snappy_replies') + 1)
+    return True
+
+
+def handle_event(event, data):
+    """
+    Handle an allowed webhook event with its decoded data.
+    """
+    if event == "message.outgoing":
+        return handle_message_outgoing(data)
+
+
+def event_key(event, data):
+    """
+    Key Snappy deliveries of the same event share, None if there is nothing
+    to tell them apart by.
+    """
+    try:
+        return "%s:note:%s" % (event, data["note"]["id"])
+    except (KeyError, TypeError):
+        return None
+
+
+def claim_event(key):
+    """
+    Record that the event is being handled. Returns False if it already
+    was, in which case it is a redelivery to be ignored. Claim in the same
+    transaction as the handling so a failure leaves the event unclaimed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO snappy_processedevent (key, created_at)"
+            " VALUES (%s, %s) ON CONFLICT (key) DO NOTHING",
+            [key, timezone.now()])
+        return cursor.rowcount == 1